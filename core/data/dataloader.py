@@ -2,16 +2,13 @@
 
 """
 
-import os
-
-import numpy as np
-import pandas as pd
 import torch
 import torch.utils.data as data
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as F
 
 from core.data.d_util import Transform, preprocess, read_image
+from data.annotation_index import load_split
 from utils.constants import *
 
 
@@ -34,10 +31,8 @@ class FastTrackDataset(object):
     """
     def __init__(self, data_dir, mode, set_id):
         self.mode = mode
-        csv_file = os.path.join(data_dir, 'data_{}.csv'.format(self.mode))
-        data = pd.read_csv(csv_file)
-        data = data[data[Col.SET] == set_id]
-        self.data = data[data[Col.N_LABELS] != 0].reset_index(drop=True)
+        self.index, self.rows, self.paths = load_split(data_dir, self.mode,
+                                                       set_id=set_id)
 
     def __getitem__(self, index):
         # Read image (N --> batch size)
@@ -64,15 +59,13 @@ class FastTrackDataset(object):
         return batch
 
     def __len__(self):
-        return len(self.data)
+        return len(self.rows)
 
     def get_example(self, index):
-        image_filename = self.data.loc[index, Col.IMAGES]
-        image = read_image(image_filename)
+        row = self.rows[index]
+        image = read_image(self.paths[index])
 
-        bboxes = eval(self.data.loc[index, Col.COORD])
-        bboxes = np.stack(bboxes).astype(np.float32)
-        label = np.array(0)
+        bboxes, label = self.index.get(row)
         return image, bboxes, label
 
 
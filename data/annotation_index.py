@@ -0,0 +1,255 @@
+"""Annotation index
+
+Compiles the string columns of a `data_{split}.csv` file once into flat NumPy
+arrays, so that datasets can slice bounding boxes and labels of a frame
+without calling `eval()` on every sample fetch.
+
+The index of a split is a directory `index_{split}/` next to the csv file:
+
+    offsets.npy -- (N + 1,) int64, boxes of row i are bboxes[offsets[i]:offsets[i + 1]]
+    bboxes.npy  -- (R, 4) float32, [y_min, x_min, y_max, x_max]
+    labels.npy  -- (R,) int32, class indices from CLS_IDX
+    images.npy, sets.npy, videos.npy -- (N,) fixed width unicode
+    frames.npy  -- (N,) int32
+    meta.json   -- source csv and its mtime, used to detect a stale index
+    splits/     -- selected rows and image paths cached by `load_split`,
+                   cleared whenever the index is compiled again
+
+Every array is memory-mappable, so DataLoader workers share the same pages
+instead of each holding its own copy of the pandas frame.
+
+# Example
+Run command as follows to compile the index for every split in a directory:
+
+    $ python -m data.annotation_index --data-dir=dataset2/
+
+"""
+# Standard dist imports
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Project level imports
+from utils.constants import *
+
+# Module level constants
+INDEX_DIR = 'index_{}'
+META_FILE = 'meta.json'
+SPLIT_DIR = 'splits'
+ARRAYS = ('offsets', 'bboxes', 'labels', 'images', 'sets', 'videos', 'frames')
+
+
+def index_dir(data_dir, split):
+    return os.path.join(data_dir, INDEX_DIR.format(split))
+
+
+def compile_annotation_index(csv_file, out_dir, cls_idx=CLS_IDX):
+    """Compile a dataset csv file into an annotation index
+
+    Args:
+        csv_file: (str) Path to a `data_{split}.csv` file
+        out_dir: (str) Directory to write the index arrays to
+        cls_idx: (dict) Mapping from label names to class indices
+
+    Returns:
+        str: The index directory
+
+    """
+    data = pd.read_csv(csv_file, usecols=[Col.IMAGES, Col.SET, Col.VIDEO,
+                                          Col.FRAME, Col.COORD, Col.LABEL,
+                                          Col.N_LABELS])
+    n_labels = data[Col.N_LABELS].values.astype(np.int64)
+    offsets = np.zeros((len(data) + 1,), dtype=np.int64)
+    np.cumsum(n_labels, out=offsets[1:])
+    bboxes = np.empty((offsets[-1], 4), dtype=np.float32)
+    labels = np.empty((offsets[-1],), dtype=np.int32)
+
+    rows = zip(data[Col.COORD].values, data[Col.LABEL].values)
+    for i, (coord, label) in enumerate(rows):
+        # Frames without annotations are stored as '[[0, 0, 0, 0]]', ['bg']
+        if n_labels[i] == 0:
+            continue
+        start, end = offsets[i], offsets[i + 1]
+        xywh = np.array(ast.literal_eval(coord), dtype=np.float64)
+        label = ast.literal_eval(label)
+        if len(xywh) != n_labels[i] or len(label) != n_labels[i]:
+            raise ValueError('Row {} of {} has {} labels but {} boxes'.format(
+                i, csv_file, n_labels[i], len(xywh)))
+
+        # Reorder [x_min, y_min, width, height] to [y_min, x_min, y_max, x_max]
+        bboxes[start:end, 0] = xywh[:, 1]
+        bboxes[start:end, 1] = xywh[:, 0]
+        bboxes[start:end, 2] = xywh[:, 1] + xywh[:, 3]
+        bboxes[start:end, 3] = xywh[:, 0] + xywh[:, 2]
+        labels[start:end] = [cls_idx[l] for l in label]
+
+    arrays = {'offsets': offsets,
+              'bboxes': bboxes,
+              'labels': labels,
+              'images': data[Col.IMAGES].to_numpy(dtype='U'),
+              'sets': data[Col.SET].to_numpy(dtype='U'),
+              'videos': data[Col.VIDEO].to_numpy(dtype='U'),
+              'frames': data[Col.FRAME].values.astype(np.int32)}
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    # cached splits are keyed by the csv mtime, a new index makes them stale
+    shutil.rmtree(os.path.join(out_dir, SPLIT_DIR), ignore_errors=True)
+    for name in ARRAYS:
+        np.save(os.path.join(out_dir, name + '.npy'), arrays[name])
+    meta = {'csv_file': os.path.abspath(csv_file),
+            'csv_mtime': os.path.getmtime(csv_file),
+            'n_rows': len(data),
+            'n_bboxes': int(offsets[-1])}
+    # Written last, so an interrupted compile is never taken as up to date
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return out_dir
+
+
+def is_stale(csv_file, out_dir):
+    """Whether the index in `out_dir` is missing or older than `csv_file`"""
+    meta_file = os.path.join(out_dir, META_FILE)
+    if not os.path.exists(meta_file):
+        return True
+    with open(meta_file) as f:
+        meta = json.load(f)
+    return meta['csv_mtime'] != os.path.getmtime(csv_file)
+
+
+class AnnotationIndex(object):
+    """Memory-mapped annotation index of a dataset split
+
+    Bounding boxes are in [y_min, x_min, y_max, x_max] order, the order the
+    model consumes, and labels are class indices.
+    """
+
+    def __init__(self, out_dir, mmap_mode='r'):
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(out_dir, name + '.npy'),
+                                        mmap_mode=mmap_mode))
+        self.n_labels = np.diff(self.offsets)
+
+    @classmethod
+    def load(cls, data_dir, split, mmap_mode='r'):
+        """Load the index of a split, compiling it first if it is stale"""
+        csv_file = os.path.join(data_dir, 'data_{}.csv'.format(split))
+        out_dir = index_dir(data_dir, split)
+        if is_stale(csv_file, out_dir):
+            compile_annotation_index(csv_file, out_dir)
+        return cls(out_dir, mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def select(self, set_id=None, min_labels=1):
+        """Rows of the index belonging to `set_id` with enough labels
+
+        Returns:
+            numpy.ndarray: Row indices in csv order
+
+        """
+        mask = self.n_labels >= min_labels
+        if set_id is not None:
+            mask &= self.sets == set_id
+        return np.flatnonzero(mask)
+
+    def get(self, row):
+        """Bounding boxes and labels of a row
+
+        The arrays are copied out of the mapping, so callers are free to
+        modify them in place.
+
+        Returns:
+            tuple: (bboxes, labels) of shape (R, 4) and (R,)
+
+        """
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return np.array(self.bboxes[start:end]), np.array(self.labels[start:end])
+
+
+def _split_key(csv_file, split, set_id, min_labels, img_dir):
+    key = json.dumps([os.path.getmtime(csv_file), split, set_id, min_labels,
+                      img_dir])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def load_split(data_dir, split, set_id=None, img_dir=None, min_labels=1):
+    """Load the rows of a split with their image paths resolved
+
+    The selected rows and resolved paths are persisted under the index
+    directory, keyed by (csv mtime, split, set_id, min_labels, img_dir), so
+    later constructions of a dataset only map two small arrays.
+
+    Args:
+        data_dir: (str) Directory of `data_{split}.csv`
+        split: (str) Dataset split
+        set_id: (str) Only keep rows of this set. All sets if None.
+        img_dir: (str) Prefix replacing the directory of every image path.
+            Paths are kept as they are in the csv if None.
+        min_labels: (int) Only keep rows with at least this many labels
+
+    Returns:
+        tuple: (index, rows, paths) where `index` is the
+        :class:`AnnotationIndex` of the split, `rows` the selected index rows
+        and `paths` the image path of each selected row
+
+    """
+    since = time.time()
+    index = AnnotationIndex.load(data_dir, split)
+    csv_file = os.path.join(data_dir, 'data_{}.csv'.format(split))
+    out_dir = os.path.join(index_dir(data_dir, split), SPLIT_DIR,
+                           _split_key(csv_file, split, set_id, min_labels,
+                                      img_dir))
+    rows_file = os.path.join(out_dir, 'rows.npy')
+    paths_file = os.path.join(out_dir, 'paths.npy')
+    if os.path.exists(paths_file):
+        rows = np.load(rows_file, mmap_mode='r')
+        paths = np.load(paths_file, mmap_mode='r')
+        cached = True
+    else:
+        rows = index.select(set_id=set_id, min_labels=min_labels)
+        paths = index.images[rows]
+        if img_dir is not None:
+            paths = np.char.add(img_dir, [os.path.basename(p) for p in paths])
+        paths = np.asarray(paths, dtype=str)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        np.save(rows_file, rows)
+        # Written last, its presence marks a complete entry
+        np.save(paths_file, paths)
+        cached = False
+
+    logging.getLogger(__name__).info(
+        'Loaded {} split (set {}): {} rows in {:.3f} sec{}'.format(
+            split, set_id, len(rows), time.time() - since,
+            ' (cached)' if cached else ''))
+    return index, rows, paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile annotation index')
+    parser.add_argument('--data-dir', dest='data_dir', type=str,
+                        metavar='DIR', help='Directory of data_{split}.csv')
+    args = parser.parse_args()
+
+    for split in (TRAIN, VAL, TEST):
+        csv_file = os.path.join(args.data_dir, 'data_{}.csv'.format(split))
+        if not os.path.exists(csv_file):
+            continue
+        out_dir = compile_annotation_index(csv_file,
+                                           index_dir(args.data_dir, split))
+        print('Compiled {} -> {}'.format(csv_file, out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,60 +1,67 @@
 """ """
 # Standard dist imports
-import os
+import time
 
 # Third party imports
-import numpy as np
-import pandas as pd
+from PIL import Image
 
 # Project level imports
+from .annotation_index import load_split
+from .frame_store import FRAME_SHAPE, FrameStore
 from .util import read_image
 from utils.constants import *
 
 # Module level constants
-CLS_IDX = {'person': 0, 'people':1, 'person?':2, 'person-fa':0}
 #img_dir = '/data6/lekevin/fast_track/caltech-pedestrian-dataset-converter' \
 #          '/data/images/'
 # TODO get rid of top img_dir when using DSMLP
 img_dir = '/datasets/ee285f-public/caltech_pedestrians_usa/data/images/'
 
 class CaltechBboxDataset:
-    """Bounding box dataset for Caltech Pedestrian"""
+    """Bounding box dataset for Caltech Pedestrian
 
-    def __init__(self, data_dir, split=TRAIN, set_id='set00'):
+    If :obj:`use_frame_store` is set and the frame store of the split is built
+    (see :mod:`data.frame_store`), images are uint8 views of the store instead
+    of freshly decoded float32 arrays.
+    """
+
+    def __init__(self, data_dir, split=TRAIN, set_id='set00',
+                 use_frame_store=False):
         self.split = split
         if self.split == VAL:
             set_id = "set00"
-        csv_file = os.path.join(data_dir, 'data_{}.csv'.format(self.split))
-        data = pd.read_csv(csv_file)
-        if set_id is not None:
-            data = data[data[Col.SET] == set_id]
-        data[Col.IMAGES] = img_dir + data[Col.IMAGES].apply(lambda x:
-                                                            os.path.basename(x))
-        self.data = data[data[Col.N_LABELS] != 0].reset_index(drop=True)
+        since = time.time()
+        self.index, self.rows, self.paths = load_split(
+            data_dir, self.split, set_id=set_id, img_dir=img_dir)
+        self.load_time = time.time() - since
+        self.frames = None
+        if use_frame_store:
+            self.frames = FrameStore.load(data_dir, self.split)
         self.label_names = tuple(CLS_IDX.keys())
 
-
-
     def __len__(self):
-        return len(self.data)
+        return len(self.rows)
+
+    def get_size(self, index):
+        """(H, W) of an image, read from the file header only"""
+        row = self.rows[index]
+        if self.frames is not None and row in self.frames:
+            return FRAME_SHAPE[1:]
+        with Image.open(self.paths[index]) as f:
+            W, H = f.size
+        return H, W
 
     def get_example(self, index):
-        image_filename = self.data.loc[index, Col.IMAGES]
-        image = read_image(image_filename)
-
-        bboxes = np.array(eval(self.data.loc[index, Col.COORD])) #k by 4 [x_min, y_min, width, height]
-        bb_copy = bboxes.copy()
-        
-        # Reshape to be [y_min, x_min, y_max, x_max]
-        
-        bb_copy[:, 2] += bb_copy[:, 0]
-        bb_copy[:, 3] += bb_copy[:, 1]
-        bboxes[:, 0], bboxes[:, 1] = bb_copy[:, 1], bb_copy[:, 0]
-        bboxes[:, 2], bboxes[:, 3] = bb_copy[:, 3], bb_copy[:, 2]
-
-
-        label = eval(self.data.loc[index, Col.LABEL])
-        
-        bboxes = np.stack(bboxes).astype(np.float32)
-        label = np.array([CLS_IDX[i] for i in label])
+        row = self.rows[index]
+        if self.frames is not None and row in self.frames:
+            image = self.frames.read_image(row)
+        else:
+            image = read_image(self.paths[index])
+
+        bboxes, label = self.get_annotation(index)
         return image, bboxes, label
+
+    def get_annotation(self, index):
+        """Bounding boxes and labels of an image, without reading it"""
+        # bboxes are k by 4 [y_min, x_min, y_max, x_max]
+        return self.index.get(self.rows[index])
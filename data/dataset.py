@@ -1,11 +1,18 @@
 from __future__ import  absolute_import
 from __future__ import  division
+import os
+import random
+from collections import defaultdict
+
 import torch as t
+from torch.utils.data import Sampler
 from data.caltech_dataset import CaltechBboxDataset
-from skimage import transform as sktsf
 from torchvision import transforms as tvtsf
 from data import util
+from data.preprocess_cache import CACHE_DIR, PreprocessCache
+from data.resize_plan import output_size, plans
 import numpy as np
+from utils.alloc_tool import AllocationCounter
 from utils.config import opt
 
 
@@ -39,7 +46,7 @@ def caffe_normalize(img):
     return img
 
 
-def preprocess(img, min_size=600, max_size=1000):
+def preprocess(img, min_size=600, max_size=1000, out=None, x_flip=False):
     """Preprocess an image for feature extraction.
 
     The length of the shorter edge is scaled to :obj:`self.min_size`.
@@ -51,27 +58,24 @@ def preprocess(img, min_size=600, max_size=1000):
     After resizing the image, the image is subtracted by a mean image value
     :obj:`self.mean`.
 
+    Resizing and normalization run in one float32 pass using a
+    :class:`data.resize_plan.ResizePlan` cached per input shape.
+
     Args:
         img (~numpy.ndarray): An image. This is in CHW and RGB format.
             The range of its value is :math:`[0, 255]`.
+        out (~numpy.ndarray): Optional float32 buffer to write the
+            preprocessed image into.
+        x_flip (bool): Horizontally flip the image while writing it.
 
     Returns:
         ~numpy.ndarray: A preprocessed image.
 
     """
-    C, H, W = img.shape
-    scale1 = min_size / min(H, W)
-    scale2 = max_size / max(H, W)
-    scale = min(scale1, scale2)
-    img = img / 255.
-    img = sktsf.resize(img, (C, H * scale, W * scale), mode='reflect',anti_aliasing=False)
     # both the longer and shorter should be less than
     # max_size and min_size
-    if opt.caffe_pretrain:
-        normalize = caffe_normalize
-    else:
-        normalize = pytorch_normalze
-    return normalize(img)
+    plan = plans.get(img.shape, min_size, max_size, opt.caffe_pretrain)
+    return plan(img, out=out, x_flip=x_flip)
 
 
 class Transform(object):
@@ -83,16 +87,12 @@ class Transform(object):
     def __call__(self, in_data):
         img, bbox, label = in_data
         _, H, W = img.shape
-        img = preprocess(img, self.min_size, self.max_size)
+        # horizontally flip, as part of the resize so img stays contiguous
+        x_flip = random.choice([True, False])
+        img = preprocess(img, self.min_size, self.max_size, x_flip=x_flip)
         _, o_H, o_W = img.shape
         scale = o_H / H
-        bbox = util.resize_bbox(bbox, (H, W), (o_H, o_W))
-
-        # horizontally flip
-        img, params = util.random_flip(
-            img, x_random=True, return_param=True)
-        bbox = util.flip_bbox(
-            bbox, (o_H, o_W), x_flip=params['x_flip'])
+        bbox = util.transform_bbox(bbox, (H, W), (o_H, o_W), x_flip=x_flip)
 
         return img, bbox, label, scale
 
@@ -100,31 +100,166 @@ class Transform(object):
 class Dataset:
     def __init__(self, opt):
         self.opt = opt
-        self.db = CaltechBboxDataset(opt.voc_data_dir)
+        self.db = CaltechBboxDataset(opt.voc_data_dir,
+                                     use_frame_store=opt.use_frame_store)
         # self.db = VOCBboxDataset(opt.voc_data_dir)
         self.tsf = Transform(opt.min_size, opt.max_size)
+        self.alloc = AllocationCounter('Dataset.__getitem__',
+                                       enabled=opt.debug_alloc)
 
     def __getitem__(self, idx):
-        ori_img, bbox, label = self.db.get_example(idx)
-
-        img, bbox, label, scale = self.tsf((ori_img, bbox, label))
-        # TODO: check whose stride is negative to fix this instead copy all
-        # some of the strides of a given numpy array are negative.
-        return img.copy(), bbox.copy(), label.copy(), scale
+        with self.alloc:
+            ori_img, bbox, label = self.db.get_example(idx)
+            # every array returned by the transform is freshly written and
+            # contiguous, so no defensive copies are needed
+            return self.tsf((ori_img, bbox, label))
 
     def __len__(self):
         return len(self.db)
 
+    def get_size(self, idx):
+        """(H, W) of an image after preprocessing"""
+        H, W = self.db.get_size(idx)
+        o_H, o_W, _ = output_size(H, W, self.opt.min_size, self.opt.max_size)
+        return o_H, o_W
+
 
 class TestDataset:
     def __init__(self, opt, set_id='set00', split='test', use_difficult=True):
         self.opt = opt
-        self.db = CaltechBboxDataset(opt.voc_data_dir, split=split, set_id=set_id)
+        self.db = CaltechBboxDataset(opt.voc_data_dir, split=split, set_id=set_id,
+                                     use_frame_store=opt.use_frame_store)
+        self.cache = None
+        if opt.test_cache:
+            self.cache = PreprocessCache(
+                os.path.join(opt.voc_data_dir, CACHE_DIR),
+                opt.min_size, opt.max_size, opt.caffe_pretrain,
+                dtype=opt.test_cache_dtype,
+                max_bytes=opt.test_cache_max_mb * 2 ** 20)
 
     def __getitem__(self, idx):
+        if self.cache is not None:
+            img = self.cache.get(self.db.paths[idx])
+            if img is not None:
+                bbox, label = self.db.get_annotation(idx)
+                return img, self.db.get_size(idx), bbox, label
+
         ori_img, bbox, label = self.db.get_example(idx)
-        img = preprocess(ori_img)
+        img = preprocess(ori_img, self.opt.min_size, self.opt.max_size)
+        if self.cache is not None:
+            self.cache.put(self.db.paths[idx], img)
         return img, ori_img.shape[1:], bbox, label
 
     def __len__(self):
         return len(self.db)
+
+
+def collate_detection(batch):
+    """Collate :class:`Dataset` samples into a padded mini-batch.
+
+    Images are zero padded at the bottom and right to the largest image of
+    the batch. Bounding boxes and labels are padded to the largest number of
+    boxes with zeros and -1, and :obj:`n_bboxes` holds the number of valid
+    entries of each image.
+
+    Returns:
+        (~torch.Tensor, ~torch.Tensor, ~torch.Tensor, ~torch.Tensor, ~torch.Tensor):
+
+        * **imgs**: Shape :math:`(N, C, H, W)`.
+        * **bboxes**: Shape :math:`(N, R, 4)`.
+        * **labels**: Shape :math:`(N, R)`.
+        * **scales**: Shape :math:`(N,)`.
+        * **n_bboxes**: Shape :math:`(N,)`.
+
+    """
+    n = len(batch)
+    C = batch[0][0].shape[0]
+    H = max(img.shape[1] for img, _, _, _ in batch)
+    W = max(img.shape[2] for img, _, _, _ in batch)
+    R = max(len(bbox) for _, bbox, _, _ in batch)
+
+    imgs = t.zeros((n, C, H, W), dtype=t.float32)
+    bboxes = t.zeros((n, R, 4), dtype=t.float32)
+    labels = t.full((n, R), -1, dtype=t.int32)
+    scales = t.zeros((n,), dtype=t.float64)
+    n_bboxes = t.zeros((n,), dtype=t.int64)
+    for i, (img, bbox, label, scale) in enumerate(batch):
+        _, h, w = img.shape
+        imgs[i, :, :h, :w] = t.from_numpy(img)
+        bboxes[i, :len(bbox)] = t.from_numpy(bbox)
+        labels[i, :len(label)] = t.from_numpy(label.astype(np.int32))
+        scales[i] = scale
+        n_bboxes[i] = len(bbox)
+    return imgs, bboxes, labels, scales, n_bboxes
+
+
+def collate_test(batch):
+    """Collate :class:`TestDataset` samples for :meth:`FasterRCNN.predict_batch`.
+
+    Images are not padded, padding would change the predictions. They are
+    stacked when all of them have the same shape, which is the common case
+    for frames of one video.
+
+    Returns:
+        (~torch.Tensor or list, list, list, list):
+
+        * **imgs**: A tensor of shape :math:`(N, C, H, W)`, or a list of \
+            :math:`(C, H, W)` tensors if the shapes differ.
+        * **sizes**: :obj:`(H, W)` of each image before preprocessing.
+        * **bboxes**: Ground truth bounding boxes of each image.
+        * **labels**: Ground truth labels of each image.
+
+    """
+    imgs = [t.from_numpy(np.asarray(img)) for img, _, _, _ in batch]
+    if all(img.shape == imgs[0].shape for img in imgs):
+        imgs = t.stack(imgs)
+    sizes = [tuple(int(s) for s in size) for _, size, _, _ in batch]
+    bboxes = [bbox for _, _, bbox, _ in batch]
+    labels = [label for _, _, _, label in batch]
+    return imgs, sizes, bboxes, labels
+
+
+class AspectBucketSampler(Sampler):
+    """Batch sampler that only batches images of the same preprocessed shape.
+
+    Images are bucketed by :meth:`Dataset.get_size`, so the mini-batches
+    built by :func:`collate_detection` need no padding. Caltech frames all
+    fall into a single bucket.
+
+    Args:
+        dataset (Dataset): Dataset providing :meth:`get_size`.
+        batch_size (int): Number of images per batch.
+        shuffle (bool): Shuffle images within buckets and the batch order.
+        drop_last (bool): Drop the last incomplete batch of every bucket.
+
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        buckets = defaultdict(list)
+        for idx in range(len(dataset)):
+            buckets[dataset.get_size(idx)].append(idx)
+        self.buckets = list(buckets.values())
+
+    def __iter__(self):
+        batches = list()
+        for bucket in self.buckets:
+            bucket = list(bucket)
+            if self.shuffle:
+                random.shuffle(bucket)
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum((len(b) + self.batch_size - 1) // self.batch_size
+                   for b in self.buckets)
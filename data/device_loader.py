@@ -0,0 +1,143 @@
+"""Device prefetching data loader
+
+Wraps a DataLoader so that the host to device copy of the next batch runs on
+a side CUDA stream while the model works on the current one. Batches are
+staged through a small ring of pinned host buffers that are reused from
+batch to batch, so the copies are asynchronous without pinning fresh memory
+every step.
+
+On a machine without CUDA, or with a CPU device, the wrapper hands batches
+through unchanged and only keeps the stall metrics.
+
+"""
+# Standard dist imports
+import time
+
+# Third party imports
+import torch as t
+
+# Module level constants
+DEFAULT_DEPTH = 2
+
+
+class DeviceLoader(object):
+    """Prefetch batches of a DataLoader to a device
+
+    Args:
+        loader (iterable): Yields tuples of tensors and other values, e.g. a
+            :class:`torch.utils.data.DataLoader`.
+        device (str or ~torch.device): Device to copy the batches to.
+        depth (int): Number of pinned host buffers in the ring, i.e. how many
+            batches can be in flight to the device.
+        host_fields (tuple of int): Positions of batch fields that stay on
+            the host, e.g. values read by numpy code of the step.
+
+    Attributes:
+        stall_time (float): Seconds the consumer spent waiting on the loader
+            and on copies during the last iteration.
+        step_time (float): Seconds spent outside of the loader, i.e. in the
+            steps, during the last iteration.
+        n_batches (int): Batches yielded during the last iteration.
+
+    """
+
+    def __init__(self, loader, device='cuda', depth=DEFAULT_DEPTH,
+                 host_fields=()):
+        self.loader = loader
+        self.device = t.device(device)
+        self.depth = max(1, depth)
+        self.host_fields = set(host_fields)
+        self.enabled = self.device.type == 'cuda' and t.cuda.is_available()
+        if self.enabled:
+            self.stream = t.cuda.Stream(device=self.device)
+            # per slot: list of pinned buffers and the event of their copy
+            self._buffers = [list() for _ in range(self.depth)]
+            self._events = [None] * self.depth
+        self._slot = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def reset_stats(self):
+        self.stall_time = 0.
+        self.step_time = 0.
+        self.n_batches = 0
+
+    @property
+    def stall_fraction(self):
+        total = self.stall_time + self.step_time
+        return self.stall_time / total if total > 0 else 0.
+
+    def summary(self):
+        return ('[INPUT STALL] {} batches, {:.3f} sec waiting ({:.1%} of '
+                'the loop), {:.2f} ms per batch'.format(
+                    self.n_batches, self.stall_time, self.stall_fraction,
+                    1000 * self.stall_time / max(self.n_batches, 1)))
+
+    def _pinned(self, slot, i, tensor):
+        """Pinned buffer i of a slot, grown to fit tensor"""
+        buffers = self._buffers[slot]
+        if len(buffers) <= i:
+            buffers.append(None)
+        buf = buffers[i]
+        if buf is None or buf.dtype != tensor.dtype or \
+                buf.numel() < tensor.numel():
+            buf = t.empty((tensor.numel(),), dtype=tensor.dtype,
+                          pin_memory=True)
+            buffers[i] = buf
+        return buf[:tensor.numel()].view(tensor.shape)
+
+    def _to_device(self, batch):
+        slot = self._slot
+        self._slot = (slot + 1) % self.depth
+        # the slot is only rewritten once its previous copy has completed
+        if self._events[slot] is not None:
+            self._events[slot].synchronize()
+
+        n_buffers = 0
+        out = list()
+        with t.cuda.stream(self.stream):
+            for field, value in enumerate(batch):
+                if field in self.host_fields or not t.is_tensor(value):
+                    out.append(value)
+                    continue
+                host = self._pinned(slot, n_buffers, value)
+                n_buffers += 1
+                host.copy_(value)
+                out.append(host.to(self.device, non_blocking=True))
+            event = t.cuda.Event()
+            event.record(self.stream)
+        self._events[slot] = event
+        return out
+
+    def _next(self, it):
+        """Fetch the next batch and start its copy, None when exhausted"""
+        since = time.time()
+        batch = next(it, None)
+        if batch is not None and self.enabled:
+            batch = self._to_device(batch)
+        self.stall_time += time.time() - since
+        return batch
+
+    def __iter__(self):
+        self.reset_stats()
+        it = iter(self.loader)
+        batch = self._next(it)
+        while batch is not None:
+            if self.enabled:
+                since = time.time()
+                current = t.cuda.current_stream(self.device)
+                current.wait_stream(self.stream)
+                for value in batch:
+                    if t.is_tensor(value) and value.is_cuda:
+                        # memory was allocated on the side stream
+                        value.record_stream(current)
+                self.stall_time += time.time() - since
+            # start copying the next batch before the step on this one
+            next_batch = self._next(it)
+            self.n_batches += 1
+            since = time.time()
+            yield tuple(batch)
+            self.step_time += time.time() - since
+            batch = next_batch
@@ -0,0 +1,188 @@
+"""Frame store
+
+Decodes every image referenced by a dataset split once into a uint8
+memory-mapped array, so that epochs over the same frames read pixels straight
+from the OS page cache instead of decoding the PNG again.
+
+All Caltech frames are 640x480, so the store is a single fixed stride array
+of shape (S, 3, 480, 640) in CHW and RGB order. Slots are addressed by the
+row of the annotation index of the split (see `data.annotation_index`):
+
+    frames.npy -- (S, 3, H, W) uint8
+    slots.npy  -- (N,) int32, slot of each index row, -1 if not stored
+    meta.json  -- source csv mtime and image directory
+
+# Example
+Run command as follows to build the store of the training split:
+
+    $ python -m data.frame_store --data-dir=dataset2/ --split=train \
+        --img-dir=/datasets/ee285f-public/caltech_pedestrians_usa/data/images/
+
+"""
+# Standard dist imports
+import argparse
+import json
+import multiprocessing
+import os
+
+# Third party imports
+import numpy as np
+from tqdm import tqdm
+
+# Project level imports
+from .annotation_index import AnnotationIndex
+from .util import read_image
+from utils.constants import *
+
+# Module level constants
+STORE_DIR = 'frames_{}'
+META_FILE = 'meta.json'
+FRAME_SHAPE = (3, 480, 640)
+
+
+def store_dir(data_dir, split):
+    return os.path.join(data_dir, STORE_DIR.format(split))
+
+
+def _decode(args):
+    """Decode one image into its slot of the store (runs in a worker)"""
+    frames_file, slot, path = args
+    img = read_image(path, dtype=np.uint8)
+    if img.shape != FRAME_SHAPE:
+        raise ValueError('{} has shape {}, expected {}'.format(
+            path, img.shape, FRAME_SHAPE))
+    frames = np.load(frames_file, mmap_mode='r+')
+    frames[slot] = img
+    frames.flush()
+    return slot
+
+
+def build_frame_store(data_dir, split, img_dir=None, min_labels=1,
+                      num_workers=4):
+    """Decode the frames of a split into a memory-mapped store
+
+    Args:
+        data_dir: (str) Directory of `data_{split}.csv`
+        split: (str) Dataset split
+        img_dir: (str) Directory of the images. If None, the image paths of
+            the csv file are used as they are.
+        min_labels: (int) Only frames with at least this many labels are
+            stored. The datasets never read unannotated frames.
+        num_workers: (int) Number of decoding processes
+
+    Returns:
+        str: The store directory
+
+    """
+    index = AnnotationIndex.load(data_dir, split)
+    rows = index.select(min_labels=min_labels)
+    paths = [str(p) for p in index.images[rows]]
+    if img_dir is not None:
+        paths = [img_dir + os.path.basename(p) for p in paths]
+
+    out_dir = store_dir(data_dir, split)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    meta_file = os.path.join(out_dir, META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    slots = np.full((len(index),), -1, dtype=np.int32)
+    slots[rows] = np.arange(len(rows), dtype=np.int32)
+    np.save(os.path.join(out_dir, 'slots.npy'), slots)
+
+    frames_file = os.path.join(out_dir, 'frames.npy')
+    frames = np.lib.format.open_memmap(frames_file, mode='w+', dtype=np.uint8,
+                                       shape=(len(rows),) + FRAME_SHAPE)
+    del frames
+
+    jobs = [(frames_file, slot, path) for slot, path in enumerate(paths)]
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for _ in tqdm(pool.imap_unordered(_decode, jobs, chunksize=64),
+                          total=len(jobs)):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in tqdm(jobs):
+            _decode(job)
+
+    csv_file = os.path.join(data_dir, 'data_{}.csv'.format(split))
+    meta = {'csv_mtime': os.path.getmtime(csv_file),
+            'img_dir': img_dir,
+            'n_frames': len(rows),
+            'frame_shape': FRAME_SHAPE}
+    # Written last, so an interrupted build is never opened
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    return out_dir
+
+
+class FrameStore(object):
+    """Reader of a frame store
+
+    :meth:`read_image` is a drop-in for :func:`data.util.read_image`, keyed by
+    annotation index row instead of path. It returns zero-copy, read-only
+    views of the mapping in CHW and RGB order with values in [0, 255].
+    """
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.slots = np.load(os.path.join(out_dir, 'slots.npy'))
+        self.frames = np.load(os.path.join(out_dir, 'frames.npy'),
+                              mmap_mode='r')
+
+    @classmethod
+    def load(cls, data_dir, split):
+        """Open the store of a split, or return None if it is not built
+
+        A store built from an older csv is not opened either, since its slots
+        refer to rows of the old annotation index.
+        """
+        out_dir = store_dir(data_dir, split)
+        meta_file = os.path.join(out_dir, META_FILE)
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        csv_file = os.path.join(data_dir, 'data_{}.csv'.format(split))
+        if meta['csv_mtime'] != os.path.getmtime(csv_file):
+            return None
+        return cls(out_dir)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, row):
+        return self.slots[row] >= 0
+
+    def read_image(self, row):
+        slot = self.slots[row]
+        if slot < 0:
+            raise KeyError('Row {} is not in the frame store'.format(row))
+        return np.asarray(self.frames[slot])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build frame store')
+    parser.add_argument('--data-dir', dest='data_dir', type=str,
+                        metavar='DIR', help='Directory of data_{split}.csv')
+    parser.add_argument('--split', type=str, default=TRAIN,
+                        help='Dataset split')
+    parser.add_argument('--img-dir', dest='img_dir', type=str, default=None,
+                        metavar='DIR', help='Image directory')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of decoding processes')
+    args = parser.parse_args()
+
+    out_dir = build_frame_store(args.data_dir, args.split, args.img_dir,
+                                num_workers=args.workers)
+    print('Built frame store {}'.format(out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Preprocessed sample cache
+
+Evaluation preprocesses the same frames with the same settings every time it
+runs, so :class:`data.dataset.TestDataset` can keep the preprocessed images
+on disk and skip decoding and resizing on later passes.
+
+Every sample is one memory-mapped shard `<key>.npy` in the cache directory,
+keyed by image path, file mtime and the preprocessing settings (`min_size`,
+`max_size`, `caffe_pretrain`). Shards are written to a temporary file and
+renamed into place, so DataLoader workers can fill the cache concurrently
+without coordination. Shards are stored either as
+
+    float16 -- the preprocessed image, half precision
+    uint8   -- the resized image before normalization, rounded to [0, 255]
+
+The total size of the directory is capped; when it grows over the cap the
+least recently used shards are removed. Hits refresh the shard mtime, which
+is what the eviction orders by.
+
+"""
+# Standard dist imports
+import hashlib
+import json
+import os
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from .resize_plan import normalization
+
+# Module level constants
+CACHE_DIR = 'preprocessed'
+DTYPES = ('float16', 'uint8')
+SHARD_EXT = '.npy'
+# fraction of the cap written between two scans of the directory
+EVICT_EVERY = 1 / 16.
+
+
+class PreprocessCache(object):
+    """On-disk cache of preprocessed images
+
+    Args:
+        cache_dir (str): Directory of the shards.
+        min_size (int): Setting of `preprocess` the images are cached for.
+        max_size (int): Setting of `preprocess` the images are cached for.
+        caffe_pretrain (bool): Setting of `preprocess` the images are
+            cached for.
+        dtype (str): Storage type of the shards, one of :obj:`DTYPES`.
+        max_bytes (int): Size cap of the cache directory.
+
+    """
+
+    def __init__(self, cache_dir, min_size=600, max_size=1000,
+                 caffe_pretrain=False, dtype='float16', max_bytes=2 ** 33):
+        if dtype not in DTYPES:
+            raise ValueError('Unknown cache dtype {}, expected one of '
+                             '{}'.format(dtype, DTYPES))
+        self.cache_dir = cache_dir
+        self.min_size = min_size
+        self.max_size = max_size
+        self.caffe_pretrain = caffe_pretrain
+        self.dtype = dtype
+        self.max_bytes = max_bytes
+        _, gain, bias = normalization(caffe_pretrain=caffe_pretrain)
+        self.gain = gain[:, None, None]
+        self.bias = bias[:, None, None]
+        self.hits = 0
+        self.misses = 0
+        self._written = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _shard(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        key = json.dumps([str(path), mtime, self.min_size, self.max_size,
+                          self.caffe_pretrain, self.dtype])
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + SHARD_EXT
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, path, out=None):
+        """Preprocessed image of `path` as float32, or None on a miss"""
+        shard = self._shard(path)
+        try:
+            data = np.load(shard, mmap_mode='r')
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        if out is None:
+            out = np.empty(data.shape, dtype=np.float32)
+        if self.dtype == 'uint8':
+            np.multiply(data, self.gain, out=out)
+            out += self.bias
+        else:
+            out[...] = data
+        del data
+        self.hits += 1
+        try:
+            os.utime(shard)
+        except OSError:
+            pass
+        return out
+
+    def put(self, path, img):
+        """Store the preprocessed image `img` of `path`"""
+        if self.dtype == 'uint8':
+            data = np.subtract(img, self.bias)
+            data /= self.gain
+            np.rint(data, out=data)
+            data = np.clip(data, 0, 255, out=data).astype(np.uint8)
+        else:
+            data = img.astype(np.float16)
+        shard = self._shard(path)
+        tmp = '{}.{}.tmp'.format(shard, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, shard)
+
+        self._written += os.path.getsize(shard)
+        if self._written >= self.max_bytes * EVICT_EVERY:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used shards until under the cap"""
+        shards = list()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(SHARD_EXT):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            shards.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in shards)
+        for _, size, shard in sorted(shards):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(shard)
+            except OSError:
+                # already removed by another worker
+                pass
+            total -= size
+        return total
@@ -0,0 +1,202 @@
+"""Fused resize and normalize
+
+Caltech frames share one input resolution, so the bilinear interpolation of
+every output pixel is the same from frame to frame. :class:`ResizePlan`
+precomputes, per input shape, the source indices and weights of
+``skimage.transform.resize(..., mode='reflect', anti_aliasing=False)``
+and folds the per-channel normalization into them. Applying a plan is two
+separable float32 gathers written into a caller-supplied output buffer,
+instead of a float64 resize followed by separate normalization copies.
+Intermediate rows live in per-thread scratch buffers of the plan, and a
+horizontal flip is applied by gathering columns in reverse, so the only
+per-image allocation is the output itself.
+
+"""
+# Standard dist imports
+import threading
+from collections import OrderedDict
+
+# Third party imports
+import numpy as np
+
+# Module level constants
+PYTORCH_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+PYTORCH_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+CAFFE_MEAN = np.array([122.7717, 115.9465, 102.9801], dtype=np.float32)
+MAX_PLANS = 8
+
+
+def output_size(H, W, min_size=600, max_size=1000):
+    """Size of an image after scaling, as done by `preprocess`
+
+    The shorter edge is scaled to `min_size` unless the longer edge would
+    then exceed `max_size`.
+
+    Returns:
+        tuple: (o_H, o_W, scale)
+
+    """
+    scale1 = min_size / min(H, W)
+    scale2 = max_size / max(H, W)
+    scale = min(scale1, scale2)
+    return int(round(H * scale)), int(round(W * scale)), scale
+
+
+def normalization(C=3, caffe_pretrain=False):
+    """Per-channel normalization applied by `preprocess`
+
+    Output channel c is `gain[c] * img[channel[c]] + bias[c]` for an RGB
+    image `img` with values in [0, 255].
+
+    Returns:
+        tuple: (channel, gain, bias), arrays of shape (C,)
+
+    """
+    if caffe_pretrain:
+        channel = np.array([2, 1, 0])
+        gain = np.ones((C,), dtype=np.float32)
+        bias = -CAFFE_MEAN
+    else:
+        channel = np.arange(C)
+        gain = 1. / (255. * PYTORCH_STD)
+        bias = -PYTORCH_MEAN / PYTORCH_STD
+    return channel, gain.astype(np.float32), bias.astype(np.float32)
+
+
+def _axis_plan(n_in, n_out):
+    """Bilinear source indices and weights along one axis
+
+    Follows `scipy.ndimage.zoom(..., order=1, mode='mirror', grid_mode=True)`,
+    which is what skimage uses for `mode='reflect'`.
+    """
+    x = (np.arange(n_out, dtype=np.float64) + 0.5) * (n_in / n_out) - 0.5
+    if n_in > 1:
+        # mirror about the first and last pixel centers
+        period = 2 * (n_in - 1)
+        x = np.abs(x) % period
+        x = np.where(x > n_in - 1, period - x, x)
+    else:
+        x = np.zeros_like(x)
+    i0 = np.floor(x).astype(np.intp)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    w1 = x - i0
+    w0 = 1. - w1
+    return i0, i1, w0.astype(np.float32), w1.astype(np.float32)
+
+
+class ResizePlan(object):
+    """Resize and normalization of one input shape
+
+    Args:
+        in_shape (tuple): :obj:`(C, H, W)` of the input images.
+        min_size (int): See :func:`output_size`.
+        max_size (int): See :func:`output_size`.
+        caffe_pretrain (bool): Normalize for caffe pretrained weights, i.e.
+            BGR order and mean subtraction in [0, 255]. Otherwise normalize
+            with the torchvision mean and std in [0, 1].
+
+    """
+
+    def __init__(self, in_shape, min_size=600, max_size=1000,
+                 caffe_pretrain=False):
+        C, H, W = in_shape
+        self.in_shape = tuple(in_shape)
+        o_H, o_W, self.scale = output_size(H, W, min_size, max_size)
+        self.out_shape = (C, o_H, o_W)
+
+        self.y0, self.y1, wy0, wy1 = _axis_plan(H, o_H)
+        self.x0, self.x1, self.wx0, self.wx1 = _axis_plan(W, o_W)
+        # the same gather in reverse writes a horizontally flipped output
+        self.fx0, self.fx1, self.fwx0, self.fwx1 = (
+            np.ascontiguousarray(a[::-1])
+            for a in (self.x0, self.x1, self.wx0, self.wx1))
+
+        self.channel, gain, bias = normalization(C, caffe_pretrain)
+        # fold the gain into the row weights: (C, o_H, 1)
+        self.wy0 = (gain[:, None] * wy0[None]).astype(np.float32)[:, :, None]
+        self.wy1 = (gain[:, None] * wy1[None]).astype(np.float32)[:, :, None]
+        self.bias = bias.astype(np.float32)[:, None, None]
+        self._local = threading.local()
+
+    def _workspace(self, dtype):
+        """Per-thread scratch buffers, reused across calls"""
+        ws = getattr(self._local, 'buffers', None)
+        if ws is None:
+            _, o_H, o_W = self.out_shape
+            W = self.in_shape[2]
+            ws = self._local.buffers = {
+                'rows': np.empty((o_H, W), dtype=np.float32),
+                'tmp_rows': np.empty((o_H, W), dtype=np.float32),
+                'tmp_out': np.empty((o_H, o_W), dtype=np.float32)}
+        src = ws.get(dtype)
+        if src is None:
+            src = ws[dtype] = np.empty((self.out_shape[1], self.in_shape[2]),
+                                       dtype=dtype)
+        return ws, src
+
+    def __call__(self, img, out=None, x_flip=False):
+        """Resize and normalize :obj:`img` into :obj:`out`
+
+        Args:
+            img (~numpy.ndarray): Image in CHW and RGB order with values in
+                :math:`[0, 255]`, of any real dtype.
+            out (~numpy.ndarray): float32 buffer of :attr:`out_shape`. A new
+                one is allocated if it is not given.
+            x_flip (bool): Write the output horizontally flipped. The flip
+                is part of the column gather, so :obj:`out` stays
+                contiguous.
+
+        Returns:
+            ~numpy.ndarray: :obj:`out`
+
+        """
+        if img.shape != self.in_shape:
+            raise ValueError('Plan is for shape {}, got {}'.format(
+                self.in_shape, img.shape))
+        if out is None:
+            out = np.empty(self.out_shape, dtype=np.float32)
+        if x_flip:
+            x0, x1, wx0, wx1 = self.fx0, self.fx1, self.fwx0, self.fwx1
+        else:
+            x0, x1, wx0, wx1 = self.x0, self.x1, self.wx0, self.wx1
+
+        ws, src = self._workspace(img.dtype)
+        rows, tmp_rows, tmp_out = ws['rows'], ws['tmp_rows'], ws['tmp_out']
+        for c, s in enumerate(self.channel):
+            # rows: (o_H, W)
+            np.take(img[s], self.y0, axis=0, out=src, mode='clip')
+            np.multiply(src, self.wy0[c], out=rows)
+            np.take(img[s], self.y1, axis=0, out=src, mode='clip')
+            np.multiply(src, self.wy1[c], out=tmp_rows)
+            rows += tmp_rows
+            # columns, straight into the output buffer: (o_H, o_W)
+            np.take(rows, x0, axis=1, out=out[c], mode='clip')
+            out[c] *= wx0
+            np.take(rows, x1, axis=1, out=tmp_out, mode='clip')
+            tmp_out *= wx1
+            out[c] += tmp_out
+            out[c] += self.bias[c]
+        return out
+
+
+class ResizePlanCache(object):
+    """LRU cache of :class:`ResizePlan` keyed by input shape and settings"""
+
+    def __init__(self, max_plans=MAX_PLANS):
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+
+    def get(self, in_shape, min_size=600, max_size=1000, caffe_pretrain=False):
+        key = (tuple(in_shape), min_size, max_size, caffe_pretrain)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = ResizePlan(in_shape, min_size, max_size, caffe_pretrain)
+            self._plans[key] = plan
+            if len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        else:
+            self._plans.move_to_end(key)
+        return plan
+
+
+plans = ResizePlanCache()
@@ -114,6 +114,48 @@ def flip_bbox(bbox, size, y_flip=False, x_flip=False):
     return bbox
 
 
+def transform_bbox(bbox, in_size, out_size, x_flip=False):
+    """Resize and horizontally flip bounding boxes in one pass.
+
+    Equivalent to :func:`resize_bbox` followed by :func:`flip_bbox` with
+    :obj:`size=out_size`, but both are composed into a single affine map
+    of the box coordinates, so only the returned array is allocated.
+
+    Args:
+        bbox (~numpy.ndarray): An array whose shape is :math:`(R, 4)`.
+            :math:`R` is the number of bounding boxes.
+        in_size (tuple): A tuple of length 2. The height and the width
+            of the image before resized.
+        out_size (tuple): A tuple of length 2. The height and the width
+            of the image after resized.
+        x_flip (bool): Flip bounding box according to a horizontal flip of
+            the resized image.
+
+    Returns:
+        ~numpy.ndarray:
+        Bounding boxes transformed according to the given resize and flip.
+
+    """
+    y_scale = float(out_size[0]) / in_size[0]
+    x_scale = float(out_size[1]) / in_size[1]
+    if x_flip:
+        # x_min' = W - x_scale * x_max, x_max' = W - x_scale * x_min
+        order = [0, 3, 2, 1]
+        mult = np.array([y_scale, -x_scale, y_scale, -x_scale],
+                        dtype=bbox.dtype)
+        offset = np.array([0, out_size[1], 0, out_size[1]], dtype=bbox.dtype)
+    else:
+        order = [0, 1, 2, 3]
+        mult = np.array([y_scale, x_scale, y_scale, x_scale],
+                        dtype=bbox.dtype)
+        offset = None
+    out = bbox.take(order, axis=1)
+    out *= mult
+    if offset is not None:
+        out += offset
+    return out
+
+
 def crop_bbox(
         bbox, y_slice=None, x_slice=None,
         allow_outside_center=True, return_param=False):
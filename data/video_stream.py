@@ -0,0 +1,113 @@
+"""Sequential video frame stream
+
+Iterates the annotated frames of Caltech videos in temporal order, one
+(set, video) after another. A bounded pool of read-ahead threads decodes and
+preprocesses the next frames while the model runs on the current one, so
+throughput is not bound by synchronous decoding on the main thread.
+
+Batches of consecutive frames have the same layout as a DataLoader over
+:class:`data.dataset.TestDataset` collated with
+:func:`data.dataset.collate_test`, so the stream can be passed to
+:func:`eval.eval` and :func:`tools.benchmark_model.benchmark` as is.
+
+"""
+# Standard dist imports
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from data.caltech_dataset import CaltechBboxDataset
+from data.dataset import preprocess, collate_test
+from utils.constants import *
+
+
+class VideoFrameStream(object):
+    """Frames of Caltech videos in temporal order with read-ahead
+
+    Args:
+        opt (Config): Options, :obj:`voc_data_dir`, :obj:`use_frame_store`,
+            :obj:`stream_queue_depth`, :obj:`stream_workers` and
+            :obj:`test_batch_size` are used.
+        split (str): Dataset split.
+        set_id (str): Only stream videos of this set. All sets if None.
+        video (str): Only stream this video, e.g. 'V000'. All if None.
+
+    Attributes:
+        wait_time (float): Seconds the consumer spent waiting on frames
+            during the last iteration. Close to zero when read-ahead keeps
+            up with the model.
+
+    """
+
+    def __init__(self, opt, split=TEST, set_id='set00', video=None):
+        self.db = CaltechBboxDataset(opt.voc_data_dir, split=split,
+                                     set_id=set_id,
+                                     use_frame_store=opt.use_frame_store)
+        self.min_size = opt.min_size
+        self.max_size = opt.max_size
+        self.queue_depth = max(1, opt.stream_queue_depth)
+        self.num_workers = max(1, opt.stream_workers)
+        self.batch_size = max(1, opt.test_batch_size)
+
+        index, rows = self.db.index, self.db.rows
+        sets = index.sets[rows]
+        videos = index.videos[rows]
+        # positions into self.db, ordered by set, video, then frame
+        order = np.lexsort((index.frames[rows], videos, sets))
+        if video is not None:
+            order = order[videos[order] == video]
+        self.order = order
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.order)
+
+    def videos(self):
+        """(set, video) pairs in streaming order"""
+        index, rows = self.db.index, self.db.rows[self.order]
+        pairs = zip(index.sets[rows], index.videos[rows])
+        return list(dict.fromkeys((str(s), str(v)) for s, v in pairs))
+
+    def frame_ids(self):
+        """(set, video, frame) of every streamed frame, in order"""
+        index, rows = self.db.index, self.db.rows[self.order]
+        return list(zip(index.sets[rows].tolist(),
+                        index.videos[rows].tolist(),
+                        index.frames[rows].tolist()))
+
+    def _load(self, idx):
+        ori_img, bbox, label = self.db.get_example(idx)
+        img = preprocess(ori_img, self.min_size, self.max_size)
+        return img, ori_img.shape[1:], bbox, label
+
+    def __iter__(self):
+        self.wait_time = 0.
+        executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        order = iter(self.order)
+        pending = deque()
+        batch = list()
+        try:
+            # never more than queue_depth frames decoded ahead of the consumer
+            for idx in order:
+                pending.append(executor.submit(self._load, idx))
+                if len(pending) == self.queue_depth:
+                    break
+            while pending:
+                since = time.time()
+                sample = pending.popleft().result()
+                self.wait_time += time.time() - since
+                idx = next(order, None)
+                if idx is not None:
+                    pending.append(executor.submit(self._load, idx))
+                batch.append(sample)
+                if len(batch) == self.batch_size or not pending:
+                    yield collate_test(batch)
+                    batch = list()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
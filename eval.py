@@ -1,6 +1,10 @@
 from __future__ import  absolute_import
 # though cupy is not used but without this line, it raise errors...
-import cupy as cp
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
 import os
 #os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 #os.environ["CUDA_VISIBLE_DEVICES"] = "1"
@@ -10,7 +14,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from utils.config import opt
-from data.dataset import Dataset, TestDataset, inverse_normalize
+from data.dataset import Dataset, TestDataset, inverse_normalize, \
+    collate_test
+from data.video_stream import VideoFrameStream
 from model.faster_rcnn_vgg16 import FasterRCNNVGG16
 from torch.utils import data as data_
 import torch
@@ -32,15 +38,15 @@ def eval(dataloader, faster_rcnn, test_num=10000):
     print("\nEVAL")
     pred_bboxes, pred_labels, pred_scores = list(), list(), list()
     gt_bboxes, gt_labels = list(), list()
-    for ii, (imgs, sizes, gt_bboxes_, gt_labels_) in tqdm(enumerate(dataloader)):
-        sizes = [sizes[0][0].item(), sizes[1][0].item()]
-        pred_bboxes_, pred_labels_, pred_scores_ = faster_rcnn.predict(imgs, [sizes])
-        gt_bboxes += list(gt_bboxes_.numpy())
-        gt_labels += list(gt_labels_.numpy())
+    for imgs, sizes, gt_bboxes_, gt_labels_ in tqdm(dataloader):
+        pred_bboxes_, pred_labels_, pred_scores_ = \
+            faster_rcnn.predict_batch(imgs, sizes)
+        gt_bboxes += gt_bboxes_
+        gt_labels += gt_labels_
         pred_bboxes += pred_bboxes_
         pred_labels += pred_labels_
         pred_scores += pred_scores_
-        if ii == test_num: break
+        if len(pred_bboxes) > test_num: break
 
     result = eval_detection_voc(
         pred_bboxes, pred_labels, pred_scores,
@@ -51,27 +57,44 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--path")
     parser.add_argument("-s", "--set_id")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read frames in temporal order per video with read-ahead")
+    parser.add_argument("--video", help="Only evaluate this video when streaming")
+    parser.add_argument("--device", default=opt.device,
+                        help="Device to run on, e.g. cuda or cpu")
+    parser.add_argument("--num-threads", dest="num_threads", type=int,
+                        default=opt.num_threads,
+                        help="Torch threads on cpu, 0 keeps the default")
     args = parser.parse_args()
+    opt.device, opt.num_threads = args.device, args.num_threads
+    device = at.init_device()
     
-    valset = TestDataset(opt, set_id=args.set_id, split='val')
-    val_dataloader = data_.DataLoader(valset,
-                                batch_size=1,
-                                num_workers=opt.test_num_workers,
-                                shuffle=False,
-                                pin_memory=True
-                                )
+    if args.stream or opt.video_stream:
+        val_dataloader = VideoFrameStream(opt, split='val', set_id=args.set_id,
+                                          video=args.video)
+        val_db = val_dataloader.db
+    else:
+        valset = TestDataset(opt, set_id=args.set_id, split='val')
+        val_db = valset.db
+        val_dataloader = data_.DataLoader(valset,
+                                    batch_size=opt.test_batch_size,
+                                    collate_fn=collate_test,
+                                    num_workers=opt.test_num_workers,
+                                    shuffle=False,
+                                    pin_memory=True
+                                    )
 
-    print(f"VAL SET: {len(val_dataloader)} ")
+    print(f"VAL SET: {len(val_dataloader)} | LOAD TIME: {val_db.load_time:.3f} sec")
     print("Using Mask VGG") if opt.mask else print("Using normal VGG16")
     faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
     print('model construct completed')
-    trainer = FasterRCNNTrainer(faster_rcnn).cuda()
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
     best_map = 0
     lr_ = opt.lr
     
     if args.path:
         assert os.path.isfile(args.path), 'Checkpoint {} does not exist.'.format(args.path)
-        checkpoint = torch.load(args.path)['other_info']
+        checkpoint = torch.load(args.path, map_location=device)['other_info']
         best_map = checkpoint['best_map']
         trainer.load(args.path)
 
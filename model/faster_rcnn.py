@@ -2,10 +2,9 @@ from __future__ import  absolute_import
 from __future__ import division
 import torch as t
 import numpy as np
-import cupy as cp
 from utils import array_tool as at
 from model.utils.bbox_tools import loc2bbox
-from model.utils.nms import non_maximum_suppression
+from model.utils.nms import batched_non_maximum_suppression
 import numpy as np
 
 from torch import nn
@@ -85,6 +84,8 @@ class FasterRCNN(nn.Module):
         self.loc_normalize_mean = loc_normalize_mean
         self.loc_normalize_std = loc_normalize_std
         self.use_preset('evaluate')
+        # upper bound of the detections kept per image, over all classes
+        self.max_detections = None
         self.sparse = False
 
     @property
@@ -166,27 +167,23 @@ class FasterRCNN(nn.Module):
             raise ValueError('preset must be visualize or evaluate')
 
     def _suppress(self, raw_cls_bbox, raw_prob):
-        bbox = list()
-        label = list()
-        score = list()
-        # skip cls_id = 0 because it is the background class
-        for l in range(1, self.n_class):
-            cls_bbox_l = raw_cls_bbox.reshape((-1, self.n_class, 4))[:, l, :]
-            prob_l = raw_prob[:, l]
-            mask = prob_l > self.score_thresh
-            cls_bbox_l = cls_bbox_l[mask]
-            prob_l = prob_l[mask]
-            keep = non_maximum_suppression(
-                cp.array(cls_bbox_l), self.nms_thresh, prob_l)
-            keep = cp.asnumpy(keep)
-            bbox.append(cls_bbox_l[keep])
-            # The labels are in [0, self.n_class - 2].
-            label.append((l - 1) * np.ones((len(keep),)))
-            score.append(prob_l[keep])
-        bbox = np.concatenate(bbox, axis=0).astype(np.float32)
-        label = np.concatenate(label, axis=0).astype(np.int32)
-        score = np.concatenate(score, axis=0).astype(np.float32)
-        return bbox, label, score
+        n_bbox = len(raw_prob)
+        # skip cls_id = 0 because it is the background class. Candidates
+        # are ordered class by class, each by RoI, as the per class nms
+        # used to see them
+        cls_bbox = raw_cls_bbox.reshape((n_bbox, self.n_class, 4))
+        mask = raw_prob[:, 1:].T > self.score_thresh
+        label, roi = np.nonzero(mask)
+        label += 1
+        bbox = cls_bbox[roi, label].astype(np.float32, copy=False)
+        score = raw_prob[roi, label].astype(np.float32, copy=False)
+
+        keep = batched_non_maximum_suppression(
+            bbox, self.nms_thresh, score, label, limit=self.max_detections)
+        # group by class, in score order within each class
+        keep = keep[np.argsort(label[keep], kind='stable')]
+        # The labels are in [0, self.n_class - 2].
+        return bbox[keep], (label[keep] - 1).astype(np.int32), score[keep]
 
     @nograd
     def predict(self, imgs,sizes=None,visualize=False):
@@ -237,34 +234,8 @@ class FasterRCNN(nn.Module):
             scale = img.shape[3] / size[1]
             roi_cls_loc, roi_scores, rois, _ = self(img, scale=scale)
             # We are assuming that batch size is 1.
-            roi_score = roi_scores.data
-            roi_cls_loc = roi_cls_loc.data
-            roi = at.totensor(rois) / scale
-
-            # Convert predictions to bounding boxes in image coordinates.
-            # Bounding boxes are scaled to the scale of the input images.
-            mean = t.Tensor(self.loc_normalize_mean).cuda(). \
-                repeat(self.n_class)[None]
-            std = t.Tensor(self.loc_normalize_std).cuda(). \
-                repeat(self.n_class)[None]
-
-            roi_cls_loc = (roi_cls_loc * std + mean)
-            roi_cls_loc = roi_cls_loc.view(-1, self.n_class, 4)
-            roi = roi.view(-1, 1, 4).expand_as(roi_cls_loc)
-            cls_bbox = loc2bbox(at.tonumpy(roi).reshape((-1, 4)),
-                                at.tonumpy(roi_cls_loc).reshape((-1, 4)))
-            cls_bbox = at.totensor(cls_bbox)
-            cls_bbox = cls_bbox.view(-1, self.n_class * 4)
-            # clip bounding box
-            cls_bbox[:, 0::2] = (cls_bbox[:, 0::2]).clamp(min=0, max=size[0])
-            cls_bbox[:, 1::2] = (cls_bbox[:, 1::2]).clamp(min=0, max=size[1])
-
-            prob = at.tonumpy(F.softmax(at.totensor(roi_score), dim=1))
-
-            raw_cls_bbox = at.tonumpy(cls_bbox)
-            raw_prob = at.tonumpy(prob)
-
-            bbox, label, score = self._suppress(raw_cls_bbox, raw_prob)
+            bbox, label, score = self._postprocess(
+                roi_cls_loc.data, roi_scores.data, rois, size, scale)
             bboxes.append(bbox)
             labels.append(label)
             scores.append(score)
@@ -273,6 +244,130 @@ class FasterRCNN(nn.Module):
         self.train()
         return bboxes, labels, scores
 
+    @nograd
+    def predict_batch(self, imgs, sizes):
+        """Detect objects from preprocessed images, batch by batch.
+
+        Images of the same shape are stacked and go through the extractor,
+        the RPN and the head in one forward pass, with the RoIs of all of
+        them and their :obj:`roi_indices`. The results are then decoded and
+        suppressed image by image, as in :meth:`predict`, which returns the
+        same detections.
+
+        Args:
+            imgs (tensor or list): Preprocessed images, a tensor of shape
+                :math:`(N, C, H, W)` or a list of :math:`(C, H, W)` arrays or
+                tensors, possibly of different shapes.
+            sizes (list of tuples): :obj:`(H, W)` of each image before
+                preprocessing.
+
+        Returns:
+            tuple of lists: :obj:`(bboxes, labels, scores)` as returned by
+            :meth:`predict`, in the order of :obj:`imgs`.
+
+        """
+        self.eval()
+        n = len(imgs)
+        bboxes = [None] * n
+        labels = [None] * n
+        scores = [None] * n
+        groups = dict()
+        for i in range(n):
+            groups.setdefault(tuple(imgs[i].shape), list()).append(i)
+        for index in groups.values():
+            if t.is_tensor(imgs) and len(index) == n:
+                x = imgs.to(at.get_device()).float()
+            else:
+                x = t.stack([at.totensor(imgs[i]) for i in index]).float()
+            scale = [x.shape[3] / sizes[i][1] for i in index]
+            roi_cls_loc, roi_scores, rois, roi_indices = self(x, scale=scale)
+            for j, i in enumerate(index):
+                mask = roi_indices == j
+                bboxes[i], labels[i], scores[i] = self._postprocess(
+                    roi_cls_loc[mask], roi_scores[mask], rois[mask],
+                    sizes[i], scale[j])
+        self.train()
+        return bboxes, labels, scores
+
+    @nograd
+    def extract_features(self, imgs):
+        """Feature maps of preprocessed images of shape :math:`(N, C, H, W)`"""
+        return self.extractor(at.totensor(imgs).float())
+
+    @nograd
+    def predict_features(self, h, img_size, size, rois=None, shift=None):
+        """Detect objects of one image from its feature map.
+
+        With :obj:`rois`, only the head runs, on the given boxes instead of
+        the proposals of the RPN, which refines them into detections at the
+        cost of the head. :obj:`h` does not need to be the feature map of
+        this very image, e.g. a video frame can reuse the feature map of a
+        recent frame. Without :obj:`rois`, this is the same as
+        :meth:`predict` on the image :obj:`h` was extracted from.
+
+        Args:
+            h (tensor): Feature map of shape :math:`(1, C', H', W')` from
+                :meth:`extract_features`.
+            img_size (tuple): :obj:`(H, W)` of the preprocessed image.
+            size (tuple): :obj:`(H, W)` of the image before preprocessing.
+            rois (array): Boxes of shape :math:`(R, 4)` in the coordinates
+                of the image before preprocessing. Proposals of the RPN if
+                not specified.
+            shift (array): Offsets of shape :math:`(R, 4)` added to the
+                boxes regressed from each of the :obj:`rois`, e.g. the
+                motion of an object since :obj:`h` was extracted.
+
+        Returns:
+            tuple of arrays: :obj:`(bbox, label, score)` of the image.
+
+        """
+        scale = img_size[1] / size[1]
+        if rois is None:
+            _, _, rois, roi_indices, _ = self.rpn(h, img_size, scale)
+        elif len(rois) == 0:
+            return (np.zeros((0, 4), dtype=np.float32),
+                    np.zeros((0,), dtype=np.int32),
+                    np.zeros((0,), dtype=np.float32))
+        else:
+            rois = at.totensor(rois).float() * scale
+            roi_indices = t.zeros((len(rois),), dtype=t.int32,
+                                  device=rois.device)
+        roi_cls_loc, roi_scores = self.head(h, rois, roi_indices)
+        return self._postprocess(roi_cls_loc, roi_scores, rois, size, scale,
+                                 shift)
+
+    def _postprocess(self, roi_cls_loc, roi_score, rois, size, scale,
+                     shift=None):
+        """Detections of one image from the head outputs of its RoIs"""
+        roi = at.totensor(rois) / scale
+
+        # Convert predictions to bounding boxes in image coordinates.
+        # Bounding boxes are scaled to the scale of the input images.
+        mean = t.Tensor(self.loc_normalize_mean).to(roi_cls_loc.device). \
+            repeat(self.n_class)[None]
+        std = t.Tensor(self.loc_normalize_std).to(roi_cls_loc.device). \
+            repeat(self.n_class)[None]
+
+        roi_cls_loc = (roi_cls_loc * std + mean)
+        roi_cls_loc = roi_cls_loc.view(-1, self.n_class, 4)
+        roi = roi.view(-1, 1, 4).expand_as(roi_cls_loc)
+        cls_bbox = loc2bbox(at.tonumpy(roi).reshape((-1, 4)),
+                            at.tonumpy(roi_cls_loc).reshape((-1, 4)))
+        cls_bbox = at.totensor(cls_bbox)
+        cls_bbox = cls_bbox.view(-1, self.n_class * 4)
+        if shift is not None:
+            cls_bbox += at.totensor(shift).float().repeat(1, self.n_class)
+        # clip bounding box
+        cls_bbox[:, 0::2] = (cls_bbox[:, 0::2]).clamp(min=0, max=size[0])
+        cls_bbox[:, 1::2] = (cls_bbox[:, 1::2]).clamp(min=0, max=size[1])
+
+        prob = at.tonumpy(F.softmax(at.totensor(roi_score), dim=1))
+
+        raw_cls_bbox = at.tonumpy(cls_bbox)
+        raw_prob = at.tonumpy(prob)
+
+        return self._suppress(raw_cls_bbox, raw_prob)
+
     def get_optimizer(self):
         """
         return optimizer, It could be overwriten if you want to specify 
@@ -0,0 +1,146 @@
+"""Keyframe scheduling for video inference
+
+Running the whole detector on every frame of a 30 fps video is far more
+than pedestrian counting needs. :class:`KeyframeDetector` runs the
+extractor, the RPN and the head only on keyframes, and in between moves the
+tracks of :class:`model.tracker.Tracker` with their constant velocity
+motion model. Optionally, the tracks are refined by the head alone on the
+feature map of the last keyframe, which corrects them for the cost of the
+head. The head pools every track at its box on the keyframe, where the
+feature map shows it, and the boxes it regresses there are moved on by the
+motion of the track since the keyframe.
+
+Keyframes come at a fixed interval, or adaptively: a frame is then a
+keyframe when new objects or lost tracks at the last detections make the
+propagated boxes unreliable, and at the latest after the interval.
+
+Every frame, keyframe or not, returns the tracks of the tracker, so all
+frames go through the same :obj:`min_score` filter of the tracker and only
+the skipped detector runs differ.
+
+"""
+# Third party imports
+import numpy as np
+
+# Project level imports
+from model.tracker import state2bbox
+from utils import array_tool as at
+
+
+class KeyframeDetector(object):
+    """Detect objects in the frames of a video with keyframes
+
+    Call the detector on the preprocessed frames of a video in frame order,
+    and :meth:`reset` between videos.
+
+    Args:
+        faster_rcnn (FasterRCNN): The detector.
+        tracker (Tracker): Tracker of the detections.
+        interval (int): Frames from one keyframe to the next, at most when
+            :obj:`adaptive`. 1 runs the detector on every frame.
+        adaptive (bool): Also trigger keyframes on new objects and lost
+            tracks.
+        refine (bool): Refine the tracks with the head on the feature map
+            of the last keyframe.
+        new_objects (int): Adaptive trigger, tracks started by the last
+            detections.
+        uncertainty (float): Adaptive trigger, fraction of the tracks
+            without a match in the last detections.
+
+    Attributes:
+        n_frame (int): Frames seen since the last :meth:`reset`.
+        n_keyframe (int): Keyframes among them.
+
+    """
+
+    def __init__(self, faster_rcnn, tracker, interval=4, adaptive=False,
+                 refine=False, new_objects=2, uncertainty=0.5):
+        self.faster_rcnn = faster_rcnn
+        self.tracker = tracker
+        self.interval = max(1, interval)
+        self.adaptive = adaptive
+        self.refine = refine
+        self.new_objects = new_objects
+        self.uncertainty = uncertainty
+        self.reset()
+
+    def reset(self):
+        """Start a new video, its next frame is a keyframe"""
+        self.tracker.reset()
+        self.faster_rcnn.eval()
+        self.features = None
+        self.img_size = None
+        # track IDs and boxes at the last keyframe
+        self.key_ids = np.zeros((0,), dtype=np.int64)
+        self.key_bbox = np.zeros((0, 4), dtype=np.float32)
+        self.since_keyframe = 0
+        # the tracks of the first keyframe are all new, not new objects
+        self.ignore_new = True
+        self.n_frame = 0
+        self.n_keyframe = 0
+
+    def is_keyframe(self):
+        """Whether the next frame runs the whole detector"""
+        if self.features is None or self.since_keyframe >= self.interval:
+            return True
+        if not self.adaptive:
+            return False
+        tracker = self.tracker
+        if not self.ignore_new and tracker.n_new >= self.new_objects:
+            return True
+        return tracker.n_missed > self.uncertainty * max(len(tracker), 1)
+
+    def __call__(self, img, size):
+        """Detect objects in the next frame
+
+        Args:
+            img (array or tensor): Preprocessed frame of shape
+                :math:`(C, H, W)`.
+            size (tuple): :obj:`(H, W)` of the frame before preprocessing.
+
+        Returns:
+            tuple of arrays: :obj:`(bbox, label, score)` as one image of
+            :meth:`FasterRCNN.predict`, of the tracks at this frame,
+            confirmed or not.
+
+        """
+        self.n_frame += 1
+        if self.is_keyframe():
+            self.n_keyframe += 1
+            self.since_keyframe = 1
+            self.img_size = tuple(img.shape[1:])
+            self.features = self.faster_rcnn.extract_features(
+                at.totensor(img)[None])
+            bbox, label, score = self.faster_rcnn.predict_features(
+                self.features, self.img_size, size)
+            self.tracker.update(bbox, score, label)
+            self.ignore_new = self.n_keyframe == 1
+            self.key_ids = self.tracker.track_id.copy()
+            self.key_bbox = state2bbox(self.tracker.state)
+            return self._tracks(size)
+
+        self.since_keyframe += 1
+        bbox, track_id, _, _ = self.tracker.propagate(confirmed=False)
+        if self.refine:
+            self._refine(bbox, track_id, size)
+        return self._tracks(size)
+
+    def _tracks(self, size):
+        bbox, _, score, label = self.tracker.tracks(confirmed=False)
+        bbox[:, 0::2] = bbox[:, 0::2].clip(0, size[0])
+        bbox[:, 1::2] = bbox[:, 1::2].clip(0, size[1])
+        return bbox, label, score
+
+    def _refine(self, bbox, track_id, size):
+        # only tracks of the last keyframe are on its feature map, IDs are
+        # in increasing order in the tracker
+        known = np.isin(track_id, self.key_ids)
+        key_bbox = self.key_bbox[np.searchsorted(self.key_ids,
+                                                 track_id[known])]
+        shift = bbox[known] - key_bbox
+        key_bbox[:, 0::2] = key_bbox[:, 0::2].clip(0, size[0])
+        key_bbox[:, 1::2] = key_bbox[:, 1::2].clip(0, size[1])
+        bbox, label, score = self.faster_rcnn.predict_features(
+            self.features, self.img_size, size, rois=key_bbox, shift=shift)
+        self.tracker.correct(bbox, score, label)
+        self.ignore_new = False
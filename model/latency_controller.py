@@ -0,0 +1,201 @@
+"""Latency budget controller of the proposals
+
+The cost of a frame is the extractor, which is fixed for a frame size, plus
+the RPN, which grows with the pre-nms proposals sorted and suppressed, plus
+the head, which grows linearly with the post-nms RoIs through the fc layers.
+:class:`LatencyController` runs the detector frame by frame, measures the
+three stages, and sets the pre-nms and post-nms proposal counts of the next
+frame so that the frame fits a latency target. The cost per proposal of each
+stage is an exponential moving average of the measurements, so the budget
+follows the load of the machine within a few frames. When the proposal
+counts are at their lower bounds and the frame is still over budget, the
+score threshold of the detections is raised, and lowered back when there is
+room again.
+
+"""
+# Standard dist imports
+import collections
+import time
+
+# Third party imports
+import numpy as np
+import torch as t
+
+# Project level imports
+from utils import array_tool as at
+
+# Module level constants
+DEFAULT_WINDOW = 256
+# frames under this fraction of the budget lower the score threshold
+HEADROOM = 0.8
+SCORE_STEP = 0.05
+
+
+class LatencyController(object):
+    """Run the detector under a per frame latency target
+
+    Args:
+        faster_rcnn (FasterRCNN): The detector. The test proposal counts of
+            its :obj:`rpn.proposal_layer` and its :obj:`score_thresh` are
+            set before each frame, :meth:`restore` sets them back.
+        target_ms (float): Latency target of a frame in milliseconds.
+        pre_nms (tuple of ints): Bounds of the pre-nms proposals.
+        post_nms (tuple of ints): Bounds of the post-nms proposals.
+        score_thresh (tuple of floats): Bounds of the score threshold.
+        margin (float): Fraction of the target kept free for the variance
+            of the frame latency.
+        smoothing (float): Weight of the last frame in the moving averages
+            of the stage costs.
+        window (int): Frames kept for the latency percentiles of
+            :meth:`metrics`.
+
+    """
+
+    def __init__(self, faster_rcnn, target_ms, pre_nms=(1000, 6000),
+                 post_nms=(50, 300), score_thresh=(0.05, 0.3), margin=0.1,
+                 smoothing=0.3, window=DEFAULT_WINDOW):
+        self.faster_rcnn = faster_rcnn
+        self.proposal_layer = faster_rcnn.rpn.proposal_layer
+        self.target = target_ms / 1000.
+        self.pre_nms = pre_nms
+        self.post_nms = post_nms
+        self.score_bounds = score_thresh
+        self.margin = margin
+        self.smoothing = smoothing
+        self.window = window
+        self._saved = (self.proposal_layer.n_test_pre_nms,
+                       self.proposal_layer.n_test_post_nms,
+                       faster_rcnn.score_thresh)
+        self.reset()
+
+    def reset(self):
+        """Forget the measurements and start from the upper bounds"""
+        self.n_pre_nms = self.pre_nms[1]
+        self.n_post_nms = self.post_nms[1]
+        # pre-nms proposals per post-nms RoI at the upper bounds
+        self.ratio = self.pre_nms[1] / max(self.post_nms[1], 1)
+        self.score_thresh = self.score_bounds[0]
+        self.extract_time = None
+        self.rpn_cost = None
+        self.head_cost = None
+        self.last = dict(extract=0., rpn=0., head=0., total=0., rois=0)
+        self.latencies = collections.deque(maxlen=self.window)
+        self.n_frame = 0
+        self.n_over = 0
+
+    def restore(self):
+        """Set the detector back to its settings before the controller"""
+        pre_nms, post_nms, score_thresh = self._saved
+        self.proposal_layer.n_test_pre_nms = pre_nms
+        self.proposal_layer.n_test_post_nms = post_nms
+        self.faster_rcnn.score_thresh = score_thresh
+
+    def _ema(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def _sync(self, device):
+        if device.type == 'cuda':
+            t.cuda.synchronize(device)
+        return time.time()
+
+    def __call__(self, img, size):
+        """Detect objects in one frame within the budget
+
+        Args:
+            img (array or tensor): Preprocessed frame of shape
+                :math:`(C, H, W)`.
+            size (tuple): :obj:`(H, W)` of the frame before preprocessing.
+
+        Returns:
+            tuple of arrays: :obj:`(bbox, label, score)` as one image of
+            :meth:`FasterRCNN.predict`.
+
+        """
+        faster_rcnn = self.faster_rcnn
+        faster_rcnn.eval()
+        self.proposal_layer.n_test_pre_nms = self.n_pre_nms
+        self.proposal_layer.n_test_post_nms = self.n_post_nms
+        faster_rcnn.score_thresh = self.score_thresh
+
+        device = at.get_device()
+        img_size = tuple(img.shape[1:])
+        scale = img_size[1] / size[1]
+        start = self._sync(device)
+        h = faster_rcnn.extract_features(at.totensor(img)[None])
+        extracted = self._sync(device)
+        with t.no_grad():
+            _, _, rois, _, _ = faster_rcnn.rpn(h, img_size, scale)
+        proposed = self._sync(device)
+        bbox, label, score = faster_rcnn.predict_features(
+            h, img_size, size, rois=rois / scale)
+        stop = self._sync(device)
+
+        self.update(extracted - start, proposed - extracted,
+                    stop - proposed, len(rois))
+        return bbox, label, score
+
+    def update(self, extract_time, rpn_time, head_time, n_roi):
+        """Account the stage latencies of a frame and plan the next one"""
+        total = extract_time + rpn_time + head_time
+        self.n_frame += 1
+        self.n_over += total > self.target
+        self.latencies.append(total)
+        self.last = dict(extract=extract_time, rpn=rpn_time, head=head_time,
+                         total=total, rois=n_roi)
+        self.extract_time = self._ema(self.extract_time, extract_time)
+        self.rpn_cost = self._ema(self.rpn_cost,
+                                  rpn_time / max(self.n_pre_nms, 1))
+        self.head_cost = self._ema(self.head_cost, head_time / max(n_roi, 1))
+
+        # split what the extractor leaves of the budget between the stages,
+        # keeping the ratio of pre-nms to post-nms proposals
+        budget = self.target * (1. - self.margin) - self.extract_time
+        n_post = budget / (self.rpn_cost * self.ratio + self.head_cost)
+        lo, hi = self.post_nms
+        self.n_post_nms = int(np.clip(n_post, lo, hi))
+        lo, hi = self.pre_nms
+        self.n_pre_nms = int(np.clip(self.ratio * n_post, lo, hi))
+
+        planned = self.extract_time + self.rpn_cost * self.n_pre_nms + \
+            self.head_cost * self.n_post_nms
+        lo, hi = self.score_bounds
+        if planned > self.target * (1. - self.margin):
+            self.score_thresh = min(self.score_thresh + SCORE_STEP, hi)
+        elif planned < self.target * HEADROOM:
+            self.score_thresh = max(self.score_thresh - SCORE_STEP, lo)
+
+    def metrics(self):
+        """Decisions and latencies of the controller
+
+        Returns:
+            dict: The target, the proposal counts and score threshold of the
+            next frame, the stage latencies of the last frame, the moving
+            averages of the costs, the latency percentiles of the recent
+            frames in milliseconds, and the fraction of frames over the
+            target.
+
+        """
+        latencies = np.asarray(self.latencies) * 1000.
+        p50, p95, p99 = np.percentile(latencies, (50, 95, 99)) \
+            if len(latencies) else (0., 0., 0.)
+        return dict(
+            target_ms=self.target * 1000.,
+            n_pre_nms=self.n_pre_nms,
+            n_post_nms=self.n_post_nms,
+            score_thresh=self.score_thresh,
+            last_extract_ms=self.last['extract'] * 1000.,
+            last_rpn_ms=self.last['rpn'] * 1000.,
+            last_head_ms=self.last['head'] * 1000.,
+            last_total_ms=self.last['total'] * 1000.,
+            last_rois=self.last['rois'],
+            extract_ms=(self.extract_time or 0.) * 1000.,
+            rpn_us_per_proposal=(self.rpn_cost or 0.) * 1e6,
+            head_us_per_roi=(self.head_cost or 0.) * 1e6,
+            p50_ms=float(p50),
+            p95_ms=float(p95),
+            p99_ms=float(p99),
+            frames=self.n_frame,
+            over_target=self.n_over / max(self.n_frame, 1),
+        )
@@ -3,6 +3,7 @@ from torch.nn import functional as F
 import torch as t
 from torch import nn
 
+from model.utils.anchor_cache import AnchorCache
 from model.utils.bbox_tools import generate_anchor_base
 from model.utils.creator_tool import ProposalCreator
 
@@ -50,6 +51,7 @@ class RegionProposalNetwork(nn.Module):
         self.anchor_base = generate_anchor_base(
             anchor_scales=anchor_scales, ratios=ratios)
         self.feat_stride = feat_stride
+        self.anchor_cache = AnchorCache()
         self.proposal_layer = ProposalCreator(self, **proposal_creator_params)
         n_anchor = self.anchor_base.shape[0]
         self.conv1 = nn.Conv2d(in_channels, mid_channels, 3, 1, 1)
@@ -74,8 +76,9 @@ class RegionProposalNetwork(nn.Module):
                 Its shape is :math:`(N, C, H, W)`.
             img_size (tuple of ints): A tuple :obj:`height, width`,
                 which contains image size after scaling.
-            scale (float): The amount of scaling done to the input images after
-                reading them from files.
+            scale (float or sequence of floats): The amount of scaling done
+                to the input images after reading them from files, either
+                one for the whole batch or one per image.
 
         Returns:
             (~torch.autograd.Variable, ~torch.autograd.Variable, array, array, array):
@@ -86,22 +89,25 @@ class RegionProposalNetwork(nn.Module):
                 anchors. Its shape is :math:`(N, H W A, 4)`.
             * **rpn_scores**:  Predicted foreground scores for \
                 anchors. Its shape is :math:`(N, H W A, 2)`.
-            * **rois**: A bounding box array containing coordinates of \
-                proposal boxes.  This is a concatenation of bounding box \
+            * **rois**: A tensor containing coordinates of \
+                proposal boxes, on the device of :obj:`x`.  This is a \
+                concatenation of bounding box \
                 arrays from multiple images in the batch. \
                 Its shape is :math:`(R', 4)`. Given :math:`R_i` predicted \
                 bounding boxes from the :math:`i` th image, \
                 :math:`R' = \\sum _{i=1} ^ N R_i`.
-            * **roi_indices**: An array containing indices of images to \
-                which RoIs correspond to. Its shape is :math:`(R',)`.
-            * **anchor**: Coordinates of enumerated shifted anchors. \
-                Its shape is :math:`(H W A, 4)`.
+            * **roi_indices**: A tensor containing indices of images to \
+                which RoIs correspond to, on the device of :obj:`x`. \
+                Its shape is :math:`(R',)`.
+            * **anchor**: Coordinates of enumerated shifted anchors, \
+                on the device of :obj:`x`. Its shape is :math:`(H W A, 4)`. \
+                The tensor is shared through :obj:`self.anchor_cache` and \
+                must not be modified.
 
         """
         n, _, hh, ww = x.shape
-        anchor = _enumerate_shifted_anchor(
-            np.array(self.anchor_base),
-            self.feat_stride, hh, ww)
+        anchor = self.anchor_cache.get(self.anchor_base, self.feat_stride,
+                                       hh, ww, device=x.device)
 
         n_anchor = anchor.shape[0] // (hh * ww)
         h = F.relu(self.conv1(x))
@@ -121,72 +127,20 @@ class RegionProposalNetwork(nn.Module):
         roi_indices = list()
         for i in range(n):
             roi = self.proposal_layer(
-                rpn_locs[i].cpu().data.numpy(),
-                rpn_fg_scores[i].cpu().data.numpy(),
+                rpn_locs[i].detach(),
+                rpn_fg_scores[i].detach(),
                 anchor, img_size,
-                scale=scale)
-            batch_index = i * np.ones((len(roi),), dtype=np.int32)
+                scale=scale[i] if np.ndim(scale) else scale)
+            batch_index = t.full((len(roi),), i, dtype=t.int32,
+                                 device=roi.device)
             rois.append(roi)
             roi_indices.append(batch_index)
 
-        rois = np.concatenate(rois, axis=0)
-        roi_indices = np.concatenate(roi_indices, axis=0)
+        rois = t.cat(rois, dim=0)
+        roi_indices = t.cat(roi_indices, dim=0)
         return rpn_locs, rpn_scores, rois, roi_indices, anchor
 
 
-def _enumerate_shifted_anchor(anchor_base, feat_stride, height, width):
-    # Enumerate all shifted anchors:
-    #
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    # return (K*A, 4)
-
-    # !TODO: add support for torch.CudaTensor
-    # xp = cuda.get_array_module(anchor_base)
-    # it seems that it can't be boosed using GPU
-    import numpy as xp
-    shift_y = xp.arange(0, height * feat_stride, feat_stride)
-    shift_x = xp.arange(0, width * feat_stride, feat_stride)
-    shift_x, shift_y = xp.meshgrid(shift_x, shift_y)
-    shift = xp.stack((shift_y.ravel(), shift_x.ravel(),
-                      shift_y.ravel(), shift_x.ravel()), axis=1)
-
-    A = anchor_base.shape[0]
-    K = shift.shape[0]
-    anchor = anchor_base.reshape((1, A, 4)) + \
-             shift.reshape((1, K, 4)).transpose((1, 0, 2))
-    anchor = anchor.reshape((K * A, 4)).astype(np.float32)
-    return anchor
-
-
-def _enumerate_shifted_anchor_torch(anchor_base, feat_stride, height, width):
-    # Enumerate all shifted anchors:
-    #
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    # return (K*A, 4)
-
-    # !TODO: add support for torch.CudaTensor
-    # xp = cuda.get_array_module(anchor_base)
-    import torch as t
-    shift_y = t.arange(0, height * feat_stride, feat_stride)
-    shift_x = t.arange(0, width * feat_stride, feat_stride)
-    shift_x, shift_y = xp.meshgrid(shift_x, shift_y)
-    shift = xp.stack((shift_y.ravel(), shift_x.ravel(),
-                      shift_y.ravel(), shift_x.ravel()), axis=1)
-
-    A = anchor_base.shape[0]
-    K = shift.shape[0]
-    anchor = anchor_base.reshape((1, A, 4)) + \
-             shift.reshape((1, K, 4)).transpose((1, 0, 2))
-    anchor = anchor.reshape((K * A, 4)).astype(np.float32)
-    return anchor
-
-
 def normal_init(m, mean, stddev, truncated=False):
     """
     weight initalizer: truncated normal and random normal.
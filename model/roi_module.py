@@ -1,25 +1,33 @@
 from collections import namedtuple
 from string import Template
 
-import cupy, torch
-import cupy as cp
+import torch
 import torch as t
 from torch.autograd import Function
+try:
+    import cupy
+    import cupy as cp
+except ImportError:
+    # CPU only node, RoIPooling2D runs the PyTorch implementation
+    cupy = cp = None
 
 from model.utils.roi_cupy import kernel_backward, kernel_forward
 
 Stream = namedtuple('Stream', ['ptr'])
 
 
-@cupy.util.memoize(for_each_device=True)
-def load_kernel(kernel_name, code, **kwargs):
-    cp.cuda.runtime.free(0)
-    code = Template(code).substitute(**kwargs)
-    kernel_code = cupy.cuda.compile_with_cache(code)
-    return kernel_code.get_function(kernel_name)
+if cupy is not None:
+    @cupy.util.memoize(for_each_device=True)
+    def load_kernel(kernel_name, code, **kwargs):
+        cp.cuda.runtime.free(0)
+        code = Template(code).substitute(**kwargs)
+        kernel_code = cupy.cuda.compile_with_cache(code)
+        return kernel_code.get_function(kernel_name)
 
 
 CUDA_NUM_THREADS = 1024
+# elements gathered at once by roi_pooling_2d, bounds its memory use
+MAX_GATHER_ELEMENTS = 2 ** 24
 
 
 def GET_BLOCKS(N, K=CUDA_NUM_THREADS):
@@ -38,8 +46,9 @@ class RoI(Function):
         rois = rois.contiguous()
         self.in_size = B, C, H, W = x.size()
         self.N = N = rois.size(0)
-        output = t.zeros(N, C, self.outh, self.outw).cuda()
-        self.argmax_data = t.zeros(N, C, self.outh, self.outw).int().cuda()
+        output = t.zeros(N, C, self.outh, self.outw, device=x.device)
+        self.argmax_data = t.zeros(N, C, self.outh, self.outw,
+                                   dtype=t.int32, device=x.device)
         self.rois = rois
         args = [x.data_ptr(), rois.data_ptr(),
                 output.data_ptr(),
@@ -59,7 +68,7 @@ class RoI(Function):
         # TODO: input
         grad_output = grad_output.contiguous()
         B, C, H, W = self.in_size
-        grad_input = t.zeros(self.in_size).cuda()
+        grad_input = t.zeros(self.in_size, device=grad_output.device)
         stream = Stream(ptr=torch.cuda.current_stream().cuda_stream)
         args = [grad_output.data_ptr(),
                 self.argmax_data.data_ptr(),
@@ -75,14 +84,170 @@ class RoI(Function):
         return grad_input, None
 
 
+def _round(x):
+    """round() of C, half away from zero, unlike torch.round"""
+    return x.sign() * (x.abs() + 0.5).floor()
+
+
+def _roi_bins(rois, outh, outw, spatial_scale, height, width):
+    """Pooling bins of every RoI, with the arithmetic of roi_forward
+
+    Returns:
+        tuple: (hstart, hend, wstart, wend) of shapes (N, outh) and
+        (N, outw), bounds of the bins clipped to the feature map.
+
+    """
+    # float roi times double scale, rounded like the kernel
+    scaled = _round(rois[:, 1:].double() * spatial_scale).long()
+    start_w, start_h, end_w, end_h = scaled.unbind(1)
+    # Force malformed ROIs to be 1x1
+    roi_width = (end_w - start_w + 1).clamp(min=1).float()
+    roi_height = (end_h - start_h + 1).clamp(min=1).float()
+    # float32 throughout, as in the kernel
+    bin_size_h = roi_height / t.tensor(float(outh), device=rois.device)
+    bin_size_w = roi_width / t.tensor(float(outw), device=rois.device)
+    ph = t.arange(outh, dtype=t.float32, device=rois.device)
+    pw = t.arange(outw, dtype=t.float32, device=rois.device)
+
+    hstart = (ph[None] * bin_size_h[:, None]).floor().long()
+    hend = ((ph[None] + 1) * bin_size_h[:, None]).ceil().long()
+    wstart = (pw[None] * bin_size_w[:, None]).floor().long()
+    wend = ((pw[None] + 1) * bin_size_w[:, None]).ceil().long()
+    # Add roi offsets and clip to input boundaries
+    hstart = (hstart + start_h[:, None]).clamp(0, height)
+    hend = (hend + start_h[:, None]).clamp(0, height)
+    wstart = (wstart + start_w[:, None]).clamp(0, width)
+    wend = (wend + start_w[:, None]).clamp(0, width)
+    return hstart, hend, wstart, wend
+
+
+def _roi_pooling_2d_forward(x, rois, outh, outw, spatial_scale,
+                            return_argmax=True,
+                            max_elements=MAX_GATHER_ELEMENTS):
+    B, C, H, W = x.shape
+    N = rois.shape[0]
+    output = x.new_zeros((N, C, outh, outw))
+    # position of the max of each bin in the (B * H * W) plane, -1 if empty
+    argmax = t.full((N, C, outh, outw), -1, dtype=t.long, device=x.device) \
+        if return_argmax else None
+    if N == 0:
+        return output, argmax
+
+    hstart, hend, wstart, wend = _roi_bins(rois, outh, outw, spatial_scale,
+                                           H, W)
+    batch = rois[:, 0].long()
+    # pixels as rows of C channels, plus a -inf row padded positions point to
+    pad = B * H * W
+    x_flat = t.cat([x.permute(0, 2, 3, 1).reshape(pad, C),
+                    x.new_full((1, C), float('-inf'))])
+
+    # RoIs with similar bin sizes share a chunk, so bins are only padded to
+    # the largest bin of their chunk
+    kh = (hend - hstart).max(dim=1)[0].clamp(min=1)
+    kw = (wend - wstart).max(dim=1)[0].clamp(min=1)
+    order = t.argsort(kh * kw)
+    chunk = max(1, max_elements // (outh * outw * C))
+    for start in range(0, N, chunk):
+        idx = order[start:start + chunk]
+        chunk_kh, chunk_kw = int(kh[idx].max()), int(kw[idx].max())
+        rows = hstart[idx, :, None] + t.arange(chunk_kh, device=x.device)
+        cols = wstart[idx, :, None] + t.arange(chunk_kw, device=x.device)
+        valid = (rows < hend[idx, :, None])[:, :, :, None, None] & \
+            (cols < wend[idx, :, None])[:, None, None]
+        pos = (batch[idx, None, None, None, None] * H +
+               rows[:, :, :, None, None]) * W + cols[:, None, None]
+        pos = pos.masked_fill(~valid, pad)
+        # (kh * kw, n, outh, outw), h major within a bin like the kernel loop
+        pos = pos.permute(2, 4, 0, 1, 3).reshape(chunk_kh * chunk_kw, -1,
+                                                 outh, outw)
+
+        # running max over the positions of the bins, the first maximum
+        # wins as with the strict > of the kernel
+        value = x_flat[pos[0]]
+        if return_argmax:
+            # offset k of the max within the bin, a bin may span more
+            # positions than a small integer type holds
+            best = t.zeros(value.shape, dtype=t.long, device=x.device)
+        for k in range(1, len(pos)):
+            candidate = x_flat[pos[k]]
+            if return_argmax:
+                best.masked_fill_(candidate > value, k)
+            t.max(value, candidate, out=value)
+        # Define an empty pooling region to be zero
+        empty = value == float('-inf')
+        output[idx] = value.masked_fill(empty, 0).permute(0, 3, 1, 2)
+        if return_argmax:
+            best = pos[..., None].expand((-1,) + value.shape).gather(
+                0, best[None])[0]
+            argmax[idx] = best.masked_fill(empty, -1).permute(0, 3, 1, 2)
+    return output, argmax
+
+
+def _roi_pooling_2d_backward(grad_output, argmax, in_size):
+    B, C, H, W = in_size
+    grad_flat = grad_output.new_zeros((B * H * W * C,))
+    channel = t.arange(C, device=argmax.device)[None, :, None, None]
+    pooled = argmax >= 0
+    # every bin adds its gradient to the input element it pooled
+    index = (argmax * C + channel)[pooled]
+    grad_flat.scatter_add_(0, index, grad_output[pooled])
+    return grad_flat.view(B, H, W, C).permute(0, 3, 1, 2).contiguous()
+
+
+class RoIPooling2DFunction(Function):
+    """RoI max pooling in PyTorch ops, runs on any device
+
+    Bins, rounding and argmax follow the CuPy kernels of `roi_cupy.py`, so
+    outputs and gradients match the :class:`RoI` function.
+    """
+
+    @staticmethod
+    def forward(ctx, x, rois, outh, outw, spatial_scale):
+        # the argmax is only tracked when a gradient will be needed
+        output, argmax = _roi_pooling_2d_forward(
+            x.contiguous(), rois, outh, outw, spatial_scale,
+            return_argmax=ctx.needs_input_grad[0])
+        ctx.save_for_backward(argmax)
+        ctx.in_size = x.shape
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        argmax, = ctx.saved_tensors
+        grad_input = _roi_pooling_2d_backward(grad_output.contiguous(),
+                                              argmax, ctx.in_size)
+        return grad_input, None, None, None, None
+
+
+def roi_pooling_2d(x, rois, outh, outw, spatial_scale):
+    """RoI max pooling of `x` (B, C, H, W) over `rois` (N, 5)
+
+    Each RoI is [batch index, x_min, y_min, x_max, y_max] in input image
+    coordinates. Returns pooled features of shape (N, C, outh, outw).
+    """
+    return RoIPooling2DFunction.apply(x, rois, outh, outw, spatial_scale)
+
+
 class RoIPooling2D(t.nn.Module):
+    """RoI max pooling
+
+    CUDA tensors go through the CuPy kernels when cupy is available, every
+    other tensor through :func:`roi_pooling_2d`.
+    """
 
     def __init__(self, outh, outw, spatial_scale):
         super(RoIPooling2D, self).__init__()
-        self.RoI = RoI(outh, outw, spatial_scale)
+        self.outh, self.outw, self.spatial_scale = outh, outw, spatial_scale
+        # kernels are compiled on the first CUDA forward
+        self.RoI = None
 
     def forward(self, x, rois):
-        return self.RoI(x, rois)
+        if x.is_cuda and cupy is not None:
+            if self.RoI is None:
+                self.RoI = RoI(self.outh, self.outw, self.spatial_scale)
+            return self.RoI(x, rois)
+        return roi_pooling_2d(x, rois, self.outh, self.outw,
+                              self.spatial_scale)
 
 
 def test_roi_module():
@@ -126,3 +291,67 @@ def test_roi_module():
     F.sum(o_cn).backward()
     test_eq(x.grad, x_cn.grad, 'backward')
     print('test pass')
+
+
+def test_roi_pooling_2d():
+    """Check roi_pooling_2d against a loop port of the CUDA kernels"""
+    import math
+    import numpy as np
+
+    spatial_scale = 1. / 16
+
+    def c_round(v):
+        return math.floor(abs(v) + 0.5) * (1 if v >= 0 else -1)
+
+    def check(x, rois, PH, PW):
+        B, C, H, W = x.shape
+        N = len(rois)
+        x_np, rois_np = x.numpy(), rois.numpy()
+        out = np.zeros((N, C, PH, PW), dtype=np.float32)
+        grad = np.zeros((B, C, H, W), dtype=np.float32)
+        f32 = np.float32
+        for n in range(N):
+            b = int(rois_np[n, 0])
+            sw, sh, ew, eh = [c_round(float(v) * spatial_scale)
+                              for v in rois_np[n, 1:]]
+            bin_h = f32(max(eh - sh + 1, 1)) / f32(PH)
+            bin_w = f32(max(ew - sw + 1, 1)) / f32(PW)
+            for c in range(C):
+                for ph in range(PH):
+                    for pw in range(PW):
+                        hs = min(max(int(math.floor(f32(ph) * bin_h)) + sh, 0), H)
+                        he = min(max(int(math.ceil(f32(ph + 1) * bin_h)) + sh, 0), H)
+                        ws = min(max(int(math.floor(f32(pw) * bin_w)) + sw, 0), W)
+                        we = min(max(int(math.ceil(f32(pw + 1) * bin_w)) + sw, 0), W)
+                        is_empty = he <= hs or we <= ws
+                        maxval, maxidx = (0 if is_empty else -1E+37), None
+                        for h in range(hs, he):
+                            for w in range(ws, we):
+                                if x_np[b, c, h, w] > maxval:
+                                    maxval, maxidx = x_np[b, c, h, w], (h, w)
+                        out[n, c, ph, pw] = maxval
+                        if maxidx is not None:
+                            grad[(b, c) + maxidx] += 1
+
+        x.requires_grad_()
+        output = RoIPooling2D(PH, PW, spatial_scale)(x, rois)
+        output.sum().backward()
+        assert (output.detach().numpy() == out).all(), 'test failed: forward'
+        assert (x.grad.numpy() == grad).all(), 'test failed: backward'
+
+    B, N, C, H, W = 2, 16, 4, 20, 24
+    x = t.randn(B, C, H, W)
+    rois = t.zeros(N, 5)
+    rois[N // 2:, 0] = 1
+    rois[:, 1:3] = t.rand(N, 2) * 300 - 20
+    rois[:, 3:] = rois[:, 1:3] + t.rand(N, 2) * 200
+    # exact halves on the feature map, where rounding modes differ
+    rois[0, 1:] = t.tensor([8., 24., 40., 56.])
+    check(x, rois, 7, 7)
+
+    # one bin over the whole 40x40 map, its max past the first 256
+    # positions of the bin
+    x = t.randn(1, 2, 40, 40)
+    x[:, :, 30, 30] = 10.
+    check(x, t.tensor([[0., 0., 0., 639., 639.]]), 1, 1)
+    print('test pass')
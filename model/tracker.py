@@ -0,0 +1,289 @@
+"""Pedestrian tracking by detection
+
+:class:`Tracker` links the per frame detections of
+:meth:`model.faster_rcnn.FasterRCNN.predict` into tracks. Each track keeps
+its box as center, height and width with a constant velocity, which an
+alpha-beta filter corrects with the matched detection of every frame.
+Detections are associated to the predicted boxes of the tracks by their
+IoUs, greedily or with the Hungarian algorithm. Unmatched detections start
+new tracks, and tracks without a match for more than :obj:`max_age` frames
+are dropped.
+
+The state of all tracks is held in arrays and every step is vectorized over
+tracks and detections, so a frame with tens of pedestrians takes a few
+hundred microseconds on CPU, far below the time of the detector.
+
+"""
+# Third party imports
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Project level imports
+from model.utils.bbox_tools import bbox_iou
+
+# Module level constants
+GREEDY = 'greedy'
+HUNGARIAN = 'hungarian'
+
+
+def greedy_match(iou, thresh):
+    """Match rows and columns by decreasing IoU
+
+    Pairs are taken in order of decreasing IoU, skipping rows and columns
+    already matched, until no pair of at least :obj:`thresh` is left. This is
+    done in rounds of pairs that are the best of both their row and their
+    column, which are exactly the pairs the sequential greedy would take, so
+    the number of rounds is small and each of them is vectorized.
+
+    Args:
+        iou (array): IoUs of shape :math:`(T, R)`.
+        thresh (float): Minimum IoU of a match.
+
+    Returns:
+        (array, array): Row and column indices of the matches.
+
+    """
+    n_row, n_col = iou.shape
+    rows, cols = list(), list()
+    if n_row and n_col:
+        iou = np.where(iou >= thresh, iou, -1.)
+        arange = np.arange(n_row)
+        while True:
+            best_col = iou.argmax(axis=1)
+            best_row = iou.argmax(axis=0)
+            row = np.flatnonzero((best_row[best_col] == arange)
+                                 & (iou[arange, best_col] >= 0))
+            if not len(row):
+                break
+            col = best_col[row]
+            rows.append(row)
+            cols.append(col)
+            iou[row] = -1.
+            iou[:, col] = -1.
+    if not rows:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def bbox2state(bbox):
+    """(y_min, x_min, y_max, x_max) to (center y, center x, height, width)"""
+    hw = bbox[:, 2:] - bbox[:, :2]
+    return np.concatenate((bbox[:, :2] + 0.5 * hw, hw), axis=1)
+
+
+def state2bbox(state):
+    """(center y, center x, height, width) to (y_min, x_min, y_max, x_max)"""
+    half = 0.5 * state[:, 2:]
+    return np.concatenate((state[:, :2] - half, state[:, :2] + half), axis=1)
+
+
+class Tracker(object):
+    """Multi object tracker with a constant velocity motion model
+
+    Call :meth:`update` with the detections of every frame, in frame order,
+    or :meth:`propagate` for the frames without detections, and
+    :meth:`reset` between videos.
+
+    Args:
+        iou_thresh (float): Minimum IoU between the predicted box of a track
+            and a detection to associate them.
+        max_age (int): Frames a track is kept without a matched detection.
+        min_hits (int): Matched detections before a track is confirmed and
+            its ID reported.
+        min_score (float): Detections with a lower score are ignored.
+        matcher (str): :obj:`'greedy'` or :obj:`'hungarian'` association.
+        alpha (float): Gain of the position and size correction.
+        beta (float): Gain of the velocity correction.
+
+    Attributes:
+        frame_count (int): Frames seen since the last :meth:`reset`.
+        next_id (int): ID of the next new track, which is also the number
+            of tracks started since the last :meth:`reset`.
+        n_new (int): Tracks started by the last detections.
+        n_missed (int): Tracks without a match in the last detections.
+
+    """
+
+    def __init__(self, iou_thresh=0.3, max_age=5, min_hits=3, min_score=0.5,
+                 matcher=GREEDY, alpha=0.6, beta=0.2):
+        if matcher not in (GREEDY, HUNGARIAN):
+            raise ValueError('Unknown matcher {}'.format(matcher))
+        self.iou_thresh = iou_thresh
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.min_score = min_score
+        self.matcher = matcher
+        self.alpha = alpha
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        """Drop all tracks, the next frame starts a new video"""
+        self.state = np.zeros((0, 4), dtype=np.float32)
+        self.velocity = np.zeros((0, 4), dtype=np.float32)
+        self.score = np.zeros((0,), dtype=np.float32)
+        self.label = np.zeros((0,), dtype=np.int32)
+        self.track_id = np.zeros((0,), dtype=np.int64)
+        self.hits = np.zeros((0,), dtype=np.int64)
+        self.time_since_update = np.zeros((0,), dtype=np.int64)
+        self.frame_count = 0
+        self.next_id = 0
+        self.n_new = 0
+        self.n_missed = 0
+
+    def __len__(self):
+        return len(self.track_id)
+
+    @property
+    def confirmed(self):
+        """Mask of the tracks whose ID is reported"""
+        # the first frames of a video report their tracks right away
+        return (self.hits >= self.min_hits) | \
+            (self.frame_count <= self.min_hits)
+
+    def tracks(self, confirmed=True):
+        """Current tracks
+
+        Args:
+            confirmed (bool): Only return the confirmed tracks.
+
+        Returns:
+            (array, array, array, array): :obj:`(bbox, track_id, score,
+            label)` of the tracks, with boxes as :math:`(y_{min}, x_{min},
+            y_{max}, x_{max})` at the current frame and the score and label
+            of their last matched detection.
+
+        """
+        mask = self.confirmed if confirmed else slice(None)
+        return (state2bbox(self.state[mask]), self.track_id[mask],
+                self.score[mask], self.label[mask])
+
+    def predict(self):
+        """Move the tracks one frame ahead with their velocities"""
+        self.state += self.velocity
+        # a shrinking box does not go through zero size
+        np.maximum(self.state[:, 2:], 1., out=self.state[:, 2:])
+        return state2bbox(self.state)
+
+    def match(self, bbox):
+        """Associate detections to the predicted boxes of the tracks
+
+        Returns:
+            (array, array): Track and detection indices of the matches.
+
+        """
+        if not len(self) or not len(bbox):
+            empty = np.zeros((0,), dtype=np.int64)
+            return empty, empty
+        iou = bbox_iou(state2bbox(self.state), bbox)
+        if self.matcher == HUNGARIAN:
+            track, det = linear_sum_assignment(iou, maximize=True)
+            keep = iou[track, det] >= self.iou_thresh
+            return track[keep], det[keep]
+        return greedy_match(iou, self.iou_thresh)
+
+    def propagate(self, confirmed=True):
+        """Move the tracks to the next frame, which has no detections
+
+        Unlike :meth:`update` with no detections, the tracks do not age, so
+        they survive frames the detector skips. :obj:`max_age` counts the
+        frames with detections only.
+
+        Returns:
+            The tracks at the next frame, see :meth:`tracks`.
+
+        """
+        self.frame_count += 1
+        self.predict()
+        return self.tracks(confirmed)
+
+    def update(self, bbox, score, label=None):
+        """Track the detections of the next frame
+
+        Args:
+            bbox (array): Detected boxes of shape :math:`(R, 4)`, as
+                :math:`(y_{min}, x_{min}, y_{max}, x_{max})`.
+            score (array): Scores of shape :math:`(R,)`.
+            label (array): Labels of shape :math:`(R,)`, kept with the
+                tracks. Zeros if not specified.
+
+        Returns:
+            array: Track ID of each detection, of shape :math:`(R,)`. It is
+            -1 for detections that are ignored or whose track is not
+            confirmed yet.
+
+        """
+        self.frame_count += 1
+        self.predict()
+        return self.correct(bbox, score, label)
+
+    def correct(self, bbox, score, label=None):
+        """Correct the tracks at the current frame with its detections
+
+        This is :meth:`update` for a frame the tracks were already moved to
+        by :meth:`propagate`, e.g. with detections refined from the
+        propagated boxes. Arguments and return value are as in
+        :meth:`update`.
+
+        """
+        bbox = np.asarray(bbox, dtype=np.float32).reshape(-1, 4)
+        score = np.asarray(score, dtype=np.float32).reshape(-1)
+        if label is None:
+            label = np.zeros((len(bbox),), dtype=np.int32)
+        label = np.asarray(label, dtype=np.int32).reshape(-1)
+        det_track = np.full((len(bbox),), -1, dtype=np.int64)
+        valid = np.flatnonzero(score >= self.min_score)
+
+        track, det = self.match(bbox[valid])
+        det = valid[det]
+
+        # correct the matched tracks with their detections
+        residual = bbox2state(bbox[det]) - self.state[track]
+        self.state[track] += self.alpha * residual
+        self.velocity[track] += self.beta * residual
+        self.score[track] = score[det]
+        self.label[track] = label[det]
+        self.hits[track] += 1
+        self.time_since_update += 1
+        self.time_since_update[track] = 0
+        det_track[det] = track
+        self.n_missed = len(self) - len(track)
+
+        # unmatched detections start new tracks
+        unmatched = np.ones((len(bbox),), dtype=bool)
+        unmatched[det] = False
+        new = valid[unmatched[valid]]
+        n_new = len(new)
+        det_track[new] = len(self) + np.arange(n_new)
+        self.state = np.concatenate((self.state, bbox2state(bbox[new])))
+        self.velocity = np.concatenate(
+            (self.velocity, np.zeros((n_new, 4), dtype=np.float32)))
+        self.score = np.concatenate((self.score, score[new]))
+        self.label = np.concatenate((self.label, label[new]))
+        self.track_id = np.concatenate(
+            (self.track_id, self.next_id + np.arange(n_new)))
+        self.hits = np.concatenate(
+            (self.hits, np.ones((n_new,), dtype=np.int64)))
+        self.time_since_update = np.concatenate(
+            (self.time_since_update, np.zeros((n_new,), dtype=np.int64)))
+        self.next_id += n_new
+        self.n_new = n_new
+
+        ids = np.where(self.confirmed, self.track_id, -1)
+        det_ids = np.full((len(bbox),), -1, dtype=np.int64)
+        det_ids[valid] = ids[det_track[valid]]
+
+        # tracks lost for too long are dropped
+        alive = self.time_since_update <= self.max_age
+        if not alive.all():
+            self._keep(alive)
+        return det_ids
+
+    def _keep(self, mask):
+        self.state = self.state[mask]
+        self.velocity = self.velocity[mask]
+        self.score = self.score[mask]
+        self.label = self.label[mask]
+        self.track_id = self.track_id[mask]
+        self.hits = self.hits[mask]
+        self.time_since_update = self.time_since_update[mask]
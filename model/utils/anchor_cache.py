@@ -0,0 +1,113 @@
+"""Anchor grid cache
+
+The anchors of a feature map only depend on the anchor base, the feature
+stride and the size of the feature map, and Caltech frames always produce
+the same feature map. :class:`AnchorCache` keeps the enumerated anchors of
+the recently used grids, as NumPy arrays or as tensors on a device, with the
+indices of the anchors inside the image for each image size, so that the
+forward passes and the anchor targets of training build them once.
+
+"""
+# Standard dist imports
+import collections
+
+# Third party imports
+import torch as t
+
+# Project level imports
+from model.utils.bbox_tools import enumerate_shifted_anchor, get_inside_index
+
+# Module level constants
+DEFAULT_ENTRIES = 8
+
+
+class _Entry(object):
+    __slots__ = ('anchor', 'inside')
+
+    def __init__(self, anchor):
+        self.anchor = anchor
+        # inside indices per image size
+        self.inside = collections.OrderedDict()
+
+
+class AnchorCache(object):
+    """LRU cache of shifted anchors
+
+    Entries are keyed by :obj:`(feat_stride, anchor_base, height, width,
+    device)`. The cached anchors are shared between callers and must not be
+    modified.
+
+    Args:
+        max_entries (int): Number of anchor grids kept, and of image sizes
+            kept per grid for the inside indices. The least recently used
+            ones are evicted first.
+
+    """
+
+    def __init__(self, max_entries=DEFAULT_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._entries = collections.OrderedDict()
+        # entries by id of their anchors, for inside_index
+        self._by_id = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, anchor_base, feat_stride, height, width, device=None):
+        """Anchors of a (height, width) feature map
+
+        Args:
+            anchor_base (~numpy.ndarray): Anchors of a cell, (A, 4).
+            feat_stride (int): Stride of the feature map in the image.
+            height (int): Height of the feature map.
+            width (int): Width of the feature map.
+            device (str or ~torch.device): Device of the returned tensor. A
+                NumPy array is returned if not specified.
+
+        Returns:
+            array or tensor: Anchors of shape :math:`(H W A, 4)`.
+
+        """
+        if device is not None:
+            device = t.device(device)
+        key = (feat_stride, anchor_base.shape, anchor_base.tobytes(),
+               int(height), int(width), device)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.anchor
+
+        self.misses += 1
+        anchor = enumerate_shifted_anchor(anchor_base, feat_stride,
+                                          height, width)
+        if device is not None:
+            anchor = t.from_numpy(anchor).to(device)
+        entry = _Entry(anchor)
+        self._entries[key] = entry
+        self._by_id[id(anchor)] = entry
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            del self._by_id[id(evicted.anchor)]
+        return anchor
+
+    def inside_index(self, anchor, img_size):
+        """Indices of the anchors inside an image of size img_size
+
+        Cached for anchors returned by :meth:`get`, computed for others.
+        """
+        H, W = int(img_size[0]), int(img_size[1])
+        entry = self._by_id.get(id(anchor))
+        if entry is None or entry.anchor is not anchor:
+            return get_inside_index(anchor, H, W)
+        index = entry.inside.get((H, W))
+        if index is None:
+            index = get_inside_index(anchor, H, W)
+            entry.inside[(H, W)] = index
+            while len(entry.inside) > self.max_entries:
+                entry.inside.popitem(last=False)
+        else:
+            entry.inside.move_to_end((H, W))
+        return index
@@ -1,9 +1,12 @@
 import numpy as np
 import numpy as xp
+import torch as t
 
 import six
 from six import __init__
 
+from model.utils.iou_tool import iou_matrix
+
 
 def loc2bbox(src_bbox, loc):
     """Decode bounding boxes from bounding box offsets and scales.
@@ -77,6 +80,29 @@ def loc2bbox(src_bbox, loc):
     return dst_bbox
 
 
+def loc2bbox_torch(src_bbox, loc):
+    """Tensor version of :func:`loc2bbox`
+
+    Decodes on the device of the inputs, with the same float32 arithmetic.
+    """
+    if src_bbox.shape[0] == 0:
+        return loc.new_zeros((0, 4))
+    src_height = src_bbox[:, 2] - src_bbox[:, 0]
+    src_width = src_bbox[:, 3] - src_bbox[:, 1]
+    src_ctr_y = src_bbox[:, 0] + 0.5 * src_height
+    src_ctr_x = src_bbox[:, 1] + 0.5 * src_width
+    ctr_y = loc[:, 0::4] * src_height[:, None] + src_ctr_y[:, None]
+    ctr_x = loc[:, 1::4] * src_width[:, None] + src_ctr_x[:, None]
+    h = t.exp(loc[:, 2::4]) * src_height[:, None]
+    w = t.exp(loc[:, 3::4]) * src_width[:, None]
+    dst_bbox = t.empty_like(loc)
+    dst_bbox[:, 0::4] = ctr_y - 0.5 * h
+    dst_bbox[:, 1::4] = ctr_x - 0.5 * w
+    dst_bbox[:, 2::4] = ctr_y + 0.5 * h
+    dst_bbox[:, 3::4] = ctr_x + 0.5 * w
+    return dst_bbox
+
+
 def bbox2loc(src_bbox, dst_bbox):
     """Encodes the source and the destination bounding boxes to "loc".
 
@@ -142,6 +168,29 @@ def bbox2loc(src_bbox, dst_bbox):
     return loc
 
 
+def bbox2loc_torch(src_bbox, dst_bbox):
+    """Tensor version of :func:`bbox2loc`, on the device of the inputs"""
+    height = src_bbox[:, 2] - src_bbox[:, 0]
+    width = src_bbox[:, 3] - src_bbox[:, 1]
+    ctr_y = src_bbox[:, 0] + 0.5 * height
+    ctr_x = src_bbox[:, 1] + 0.5 * width
+
+    base_height = dst_bbox[:, 2] - dst_bbox[:, 0]
+    base_width = dst_bbox[:, 3] - dst_bbox[:, 1]
+    base_ctr_y = dst_bbox[:, 0] + 0.5 * base_height
+    base_ctr_x = dst_bbox[:, 1] + 0.5 * base_width
+
+    eps = t.finfo(height.dtype).eps
+    height = height.clamp(min=eps)
+    width = width.clamp(min=eps)
+
+    dy = (base_ctr_y - ctr_y) / height
+    dx = (base_ctr_x - ctr_x) / width
+    dh = t.log(base_height / height)
+    dw = t.log(base_width / width)
+    return t.stack((dy, dx, dh, dw), dim=1)
+
+
 def bbox_iou(bbox_a, bbox_b):
     """Calculate the Intersection of Unions (IoUs) between bounding boxes.
 
@@ -153,6 +202,10 @@ def bbox_iou(bbox_a, bbox_b):
     same type.
     The output is same type as the type of the inputs.
 
+    The IoUs are computed in tiles with bounded temporaries, see
+    :mod:`model.utils.iou_tool`, which also has reductions that do not
+    materialize the :math:`(N, K)` matrix.
+
     Args:
         bbox_a (array): An array whose shape is :math:`(N, 4)`.
             :math:`N` is the number of bounding boxes.
@@ -169,18 +222,7 @@ def bbox_iou(bbox_a, bbox_b):
         box in :obj:`bbox_b`.
 
     """
-    if bbox_a.shape[1] != 4 or bbox_b.shape[1] != 4:
-        raise IndexError
-
-    # top left
-    tl = xp.maximum(bbox_a[:, None, :2], bbox_b[:, :2])
-    # bottom right
-    br = xp.minimum(bbox_a[:, None, 2:], bbox_b[:, 2:])
-
-    area_i = xp.prod(br - tl, axis=2) * (tl < br).all(axis=2)
-    area_a = xp.prod(bbox_a[:, 2:] - bbox_a[:, :2], axis=1)
-    area_b = xp.prod(bbox_b[:, 2:] - bbox_b[:, :2], axis=1)
-    return area_i / (area_a[:, None] + area_b - area_i)
+    return iou_matrix(bbox_a, bbox_b)
 
 
 def __test():
@@ -191,6 +233,39 @@ if __name__ == '__main__':
     __test()
 
 
+def enumerate_shifted_anchor(anchor_base, feat_stride, height, width):
+    """Anchors of every cell of a feature map of size (height, width)
+
+    Adds the :math:`A` anchors of :obj:`anchor_base` (1, A, 4) to the
+    :math:`K` cell shifts (K, 1, 4), and returns the (K A, 4) float32
+    shifted anchors.
+    """
+    shift_y = xp.arange(0, height * feat_stride, feat_stride)
+    shift_x = xp.arange(0, width * feat_stride, feat_stride)
+    shift_x, shift_y = xp.meshgrid(shift_x, shift_y)
+    shift = xp.stack((shift_y.ravel(), shift_x.ravel(),
+                      shift_y.ravel(), shift_x.ravel()), axis=1)
+
+    A = anchor_base.shape[0]
+    K = shift.shape[0]
+    anchor = anchor_base.reshape((1, A, 4)) + \
+             shift.reshape((1, K, 4)).transpose((1, 0, 2))
+    anchor = anchor.reshape((K * A, 4)).astype(np.float32)
+    return anchor
+
+
+def get_inside_index(anchor, H, W):
+    """Indices of the anchors completely inside an image of size (H, W)
+
+    Accepts arrays and tensors, and returns indices of the same type.
+    """
+    inside = (anchor[:, 0] >= 0) & (anchor[:, 1] >= 0) & \
+        (anchor[:, 2] <= H) & (anchor[:, 3] <= W)
+    if t.is_tensor(inside):
+        return inside.nonzero()[:, 0]
+    return np.where(inside)[0]
+
+
 def generate_anchor_base(base_size=16, ratios=[0.5, 1, 2],
                          anchor_scales=[8, 16, 32]):
     """Generate anchor base windows by enumerating aspect ratio and scales.
@@ -1,8 +1,10 @@
 import numpy as np
-import cupy as cp
+import torch as t
 
-from model.utils.bbox_tools import bbox2loc, bbox_iou, loc2bbox
-from model.utils.nms import non_maximum_suppression
+from model.utils.bbox_tools import bbox2loc, bbox2loc_torch, \
+    get_inside_index, loc2bbox, loc2bbox_torch
+from model.utils.iou_tool import iou_match, iou_matrix, iou_max
+from model.utils.nms import non_maximum_suppression, top_k_order
 
 
 class ProposalTargetCreator(object):
@@ -94,9 +96,7 @@ class ProposalTargetCreator(object):
         roi = np.concatenate((roi, bbox), axis=0)
 
         pos_roi_per_image = np.round(self.n_sample * self.pos_ratio)
-        iou = bbox_iou(roi, bbox)
-        gt_assignment = iou.argmax(axis=1)
-        max_iou = iou.max(axis=1)
+        gt_assignment, max_iou = iou_max(roi, bbox)
         # Offset range of classes from [0, n_fg_class - 1] to [1, n_fg_class].
         # The label with value 0 is the background.
         gt_roi_label = label[gt_assignment] + 1
@@ -167,7 +167,7 @@ class AnchorTargetCreator(object):
         self.neg_iou_thresh = neg_iou_thresh
         self.pos_ratio = pos_ratio
 
-    def __call__(self, bbox, anchor, img_size):
+    def __call__(self, bbox, anchor, img_size, inside_index=None):
         """Assign ground truth supervision to sampled subset of anchors.
 
         Types of input arrays and output arrays are same.
@@ -184,6 +184,9 @@ class AnchorTargetCreator(object):
                 :math:`(S, 4)`.
             img_size (tuple of ints): A tuple :obj:`H, W`, which
                 is a tuple of height and width of an image.
+            inside_index (array): Indices of the anchors inside the image,
+                e.g. from :class:`model.utils.anchor_cache.AnchorCache`.
+                Computed if not given.
 
         Returns:
             (array, array):
@@ -200,7 +203,8 @@ class AnchorTargetCreator(object):
         img_H, img_W = img_size
 
         n_anchor = len(anchor)
-        inside_index = _get_inside_index(anchor, img_H, img_W)
+        if inside_index is None:
+            inside_index = get_inside_index(anchor, img_H, img_W)
         anchor = anchor[inside_index]
         argmax_ious, label = self._create_label(
             inside_index, anchor, bbox)
@@ -250,13 +254,9 @@ class AnchorTargetCreator(object):
         return argmax_ious, label
 
     def _calc_ious(self, anchor, bbox, inside_index):
-        # ious between the anchors and the gt boxes
-        ious = bbox_iou(anchor, bbox)
-        argmax_ious = ious.argmax(axis=1)
-        max_ious = ious[np.arange(len(inside_index)), argmax_ious]
-        gt_argmax_ious = ious.argmax(axis=0)
-        gt_max_ious = ious[gt_argmax_ious, np.arange(ious.shape[1])]
-        gt_argmax_ious = np.where(ious == gt_max_ious)[0]
+        # best matches between the anchors and the gt boxes, and the anchors
+        # sharing the best iou of a gt box, without the full iou matrix
+        argmax_ious, max_ious, _, gt_argmax_ious = iou_match(anchor, bbox)
 
         return argmax_ious, max_ious, gt_argmax_ious
 
@@ -276,16 +276,248 @@ def _unmap(data, count, index, fill=0):
     return ret
 
 
-def _get_inside_index(anchor, H, W):
-    # Calc indicies of anchors which are located completely inside of the image
-    # whose size is speficied.
-    index_inside = np.where(
-        (anchor[:, 0] >= 0) &
-        (anchor[:, 1] >= 0) &
-        (anchor[:, 2] <= H) &
-        (anchor[:, 3] <= W)
-    )[0]
-    return index_inside
+def _generator(device, seed, generators):
+    """Seeded generator of a device, None to use the global one"""
+    if seed is None:
+        return None
+    device = t.device(device)
+    if device not in generators:
+        generators[device] = t.Generator(device=device)
+        generators[device].manual_seed(seed)
+    return generators[device]
+
+
+def _sample(candidate, group, n_per_group, generator=None):
+    """Random subset of candidates, with at most n_per_group[g] per group g
+
+    Args:
+        candidate (tensor): Bool mask of shape :math:`(M,)`.
+        group (tensor): Group of each element, in :math:`[0, B)`.
+        n_per_group (tensor): Number of elements to keep per group,
+            :math:`(B,)`.
+        generator (~torch.Generator): Source of the random order.
+
+    Returns:
+        (tensor, tensor):
+        The bool mask of the selected elements, and the rank of each
+        element in the random order of the candidates of its group.
+
+    """
+    n_group = len(n_per_group)
+    key = t.rand(candidate.shape, device=candidate.device,
+                 generator=generator)
+    # non candidates go last within their group
+    key = key.masked_fill(~candidate, 2.)
+    order = key.argsort()
+    order = order[group[order].argsort(stable=True)]
+    counts = t.bincount(group, minlength=n_group)
+    start = counts.cumsum(0) - counts
+    rank = t.empty_like(order)
+    rank[order] = t.arange(len(order), device=order.device) - \
+        start[group[order]]
+    return candidate & (rank < n_per_group[group]), rank
+
+
+class BatchProposalTargetCreator(ProposalTargetCreator):
+    """Tensor version of :class:`ProposalTargetCreator` for a batch
+
+    Samples the RoIs of all the images of a batch at once, on the device
+    of the inputs. The ground truth is padded to :math:`R` boxes per image
+    with a mask of the valid ones.
+
+    Args:
+        seed (int): Seed of the generator of the sampling, per device. The
+            global torch generator is used if not specified.
+
+    See :class:`ProposalTargetCreator` for the other arguments.
+
+    """
+
+    def __init__(self, n_sample=128,
+                 pos_ratio=0.25, pos_iou_thresh=0.5,
+                 neg_iou_thresh_hi=0.5, neg_iou_thresh_lo=0.0,
+                 seed=None):
+        super(BatchProposalTargetCreator, self).__init__(
+            n_sample, pos_ratio, pos_iou_thresh,
+            neg_iou_thresh_hi, neg_iou_thresh_lo)
+        self.seed = seed
+        self._generators = dict()
+
+    def __call__(self, roi, roi_index, bbox, label, valid,
+                 loc_normalize_mean=(0., 0., 0., 0.),
+                 loc_normalize_std=(0.1, 0.1, 0.2, 0.2)):
+        """Assign ground truth to sampled RoIs of all images
+
+        Args:
+            roi (tensor): RoIs of all images, :math:`(R', 4)`.
+            roi_index (tensor): Image of each RoI, :math:`(R',)`.
+            bbox (tensor): Padded ground truth boxes, :math:`(B, R, 4)`.
+            label (tensor): Padded ground truth labels in
+                :math:`[0, L - 1]`, :math:`(B, R)`.
+            valid (tensor): Bool mask of the valid ground truth,
+                :math:`(B, R)`.
+            loc_normalize_mean (tuple of four floats): Mean values to
+                normalize coordinates of bouding boxes.
+            loc_normalize_std (tupler of four floats): Standard deviation of
+                the coordinates of bounding boxes.
+
+        Returns:
+            (tensor, tensor, tensor, tensor):
+            **sample_roi, sample_roi_index, gt_roi_loc, gt_roi_label** as
+            returned by :class:`ProposalTargetCreator` for each image,
+            concatenated image by image, with the index of the image of each
+            sampled RoI.
+
+        """
+        n, n_bbox = valid.shape
+        device = roi.device
+        generator = _generator(device, self.seed, self._generators)
+        gt_image = t.arange(n, device=device)[:, None].expand(n, n_bbox)
+        bbox_flat = bbox.reshape(-1, 4).to(roi.dtype)
+
+        roi = t.cat((roi, bbox_flat[valid.reshape(-1)]), dim=0)
+        roi_index = t.cat((roi_index.long(), gt_image[valid]), dim=0)
+
+        # ious with the ground truth of the same image only
+        iou = iou_matrix(roi, bbox_flat)
+        same = (roi_index[:, None] == gt_image.reshape(1, -1)) & \
+            valid.reshape(1, -1)
+        iou = iou.masked_fill(~same, -1)
+        max_iou, gt_assignment = iou.max(dim=1)
+        has_gt = max_iou >= 0
+        # RoIs of images without ground truth are background
+        max_iou = max_iou.clamp(min=0)
+        gt_roi_label = label.reshape(-1).long()[gt_assignment] + 1
+
+        n_pos = int(np.round(self.n_sample * self.pos_ratio))
+        pos = max_iou >= self.pos_iou_thresh
+        keep_pos, pos_rank = _sample(
+            pos, roi_index, t.full((n,), n_pos, device=device), generator)
+        n_neg = self.n_sample - t.bincount(roi_index[keep_pos], minlength=n)
+        neg = (max_iou < self.neg_iou_thresh_hi) & \
+            (max_iou >= self.neg_iou_thresh_lo)
+        keep_neg, neg_rank = _sample(neg, roi_index, n_neg, generator)
+
+        # image by image, positives first, each in random order
+        keep_index = (keep_pos | keep_neg).nonzero()[:, 0]
+        n_roi = len(roi)
+        key = roi_index[keep_index] * (2 * n_roi) + \
+            t.where(keep_pos[keep_index], pos_rank[keep_index],
+                    n_roi + neg_rank[keep_index])
+        keep_index = keep_index[key.argsort()]
+
+        sample_roi = roi[keep_index]
+        gt_roi_label = gt_roi_label[keep_index]
+        gt_roi_label[~keep_pos[keep_index]] = 0  # negative labels --> 0
+        gt_bbox = t.where(has_gt[keep_index, None],
+                          bbox_flat[gt_assignment[keep_index]], sample_roi)
+        gt_roi_loc = bbox2loc_torch(sample_roi, gt_bbox)
+        mean = t.tensor(loc_normalize_mean, dtype=gt_roi_loc.dtype,
+                        device=device)
+        std = t.tensor(loc_normalize_std, dtype=gt_roi_loc.dtype,
+                       device=device)
+        gt_roi_loc = (gt_roi_loc - mean) / std
+
+        return sample_roi, roi_index[keep_index].int(), gt_roi_loc, \
+            gt_roi_label
+
+
+class BatchAnchorTargetCreator(AnchorTargetCreator):
+    """Tensor version of :class:`AnchorTargetCreator` for a batch
+
+    Assigns the ground truth of all the images of a batch to the anchors at
+    once, on the device of the anchors. The ground truth is padded to
+    :math:`R` boxes per image with a mask of the valid ones.
+
+    Args:
+        seed (int): Seed of the generator of the sampling, per device. The
+            global torch generator is used if not specified.
+
+    See :class:`AnchorTargetCreator` for the other arguments.
+
+    """
+
+    def __init__(self, n_sample=256,
+                 pos_iou_thresh=0.7, neg_iou_thresh=0.3,
+                 pos_ratio=0.5, seed=None):
+        super(BatchAnchorTargetCreator, self).__init__(
+            n_sample, pos_iou_thresh, neg_iou_thresh, pos_ratio)
+        self.seed = seed
+        self._generators = dict()
+
+    def __call__(self, bbox, valid, anchor, img_size, inside_index=None):
+        """Assign ground truth supervision to anchors of all images
+
+        Args:
+            bbox (tensor): Padded ground truth boxes, :math:`(B, R, 4)`.
+            valid (tensor): Bool mask of the valid ground truth,
+                :math:`(B, R)`.
+            anchor (tensor): Coordinates of anchors, :math:`(S, 4)`.
+            img_size (tuple of ints): Height and width of the images.
+            inside_index (tensor): Indices of the anchors inside the images.
+                Computed if not given.
+
+        Returns:
+            (tensor, tensor):
+            **loc** of shape :math:`(B, S, 4)` and **label** of shape
+            :math:`(B, S)`, as returned by :class:`AnchorTargetCreator` for
+            each image.
+
+        """
+        n, n_bbox = valid.shape
+        n_anchor = len(anchor)
+        device = anchor.device
+        generator = _generator(device, self.seed, self._generators)
+        if inside_index is None:
+            inside_index = get_inside_index(anchor, *img_size)
+        anchor = anchor[inside_index]
+        n_inside = len(anchor)
+        bbox = bbox.to(anchor.dtype)
+
+        iou = iou_matrix(anchor, bbox.reshape(-1, 4))
+        iou = iou.view(n_inside, n, n_bbox).permute(1, 0, 2)
+        iou = iou.masked_fill(~valid[:, None, :], -1)
+        max_ious, argmax_ious = iou.max(dim=2)
+        # anchors sharing the best iou of a gt box
+        gt_max_ious = iou.max(dim=1)[0]
+        gt_argmax = ((iou == gt_max_ious[:, None, :]) &
+                     valid[:, None, :]).any(dim=2)
+        del iou
+
+        # label: 1 is positive, 0 is negative, -1 is dont care
+        label = t.full((n, n_inside), -1, dtype=t.int32, device=device)
+        label[max_ious < self.neg_iou_thresh] = 0
+        label[gt_argmax] = 1
+        label[max_ious >= self.pos_iou_thresh] = 1
+
+        # subsample positive and negative labels if we have too many
+        group = t.arange(n, device=device)[:, None].expand(n, n_inside)
+        group = group.reshape(-1)
+        label = label.view(-1)
+        pos = label == 1
+        n_pos = int(self.pos_ratio * self.n_sample)
+        keep, _ = _sample(pos, group, t.full((n,), n_pos, device=device),
+                          generator)
+        label[pos & ~keep] = -1
+        n_neg = self.n_sample - (label == 1).view(n, -1).sum(dim=1)
+        neg = label == 0
+        keep, _ = _sample(neg, group, n_neg, generator)
+        label[neg & ~keep] = -1
+        label = label.view(n, n_inside)
+
+        # compute bounding box regression targets, zero for images without
+        # ground truth
+        gt_bbox = t.gather(bbox, 1, argmax_ious[:, :, None].expand(-1, -1, 4))
+        anchor = anchor[None].expand(n, -1, -1)
+        gt_bbox = t.where(valid.any(dim=1)[:, None, None], gt_bbox, anchor)
+        loc = bbox2loc_torch(anchor.reshape(-1, 4), gt_bbox.reshape(-1, 4))
+
+        # map up to original set of anchors
+        out_label = t.full((n, n_anchor), -1, dtype=t.int32, device=device)
+        out_label[:, inside_index] = label
+        out_loc = t.zeros((n, n_anchor, 4), dtype=loc.dtype, device=device)
+        out_loc[:, inside_index] = loc.view(n, n_inside, 4)
+        return out_loc, out_label
 
 
 class ProposalCreator:
@@ -347,8 +579,7 @@ class ProposalCreator:
 
     def __call__(self, loc, score,
                  anchor, img_size, scale=1.):
-        """input should  be ndarray
-        Propose RoIs.
+        """Propose RoIs.
 
         Inputs :obj:`loc, score, anchor` refer to the same anchor when indexed
         by the same index.
@@ -357,14 +588,16 @@ class ProposalCreator:
         to product of the height and the width of an image and the number of
         anchor bases per pixel.
 
-        Type of the output is same as the inputs.
+        Type of the output is same as the inputs. With tensors, decoding,
+        clipping, filtering, sorting and NMS stay on the device of
+        :obj:`loc` and the RoIs are returned as a tensor on that device.
 
         Args:
-            loc (array): Predicted offsets and scaling to anchors.
+            loc (array or tensor): Predicted offsets and scaling to anchors.
                 Its shape is :math:`(R, 4)`.
-            score (array): Predicted foreground probability for anchors.
-                Its shape is :math:`(R,)`.
-            anchor (array): Coordinates of anchors. Its shape is
+            score (array or tensor): Predicted foreground probability for
+                anchors. Its shape is :math:`(R,)`.
+            anchor (array or tensor): Coordinates of anchors. Its shape is
                 :math:`(R, 4)`.
             img_size (tuple of ints): A tuple :obj:`height, width`,
                 which contains image size after scaling.
@@ -372,7 +605,7 @@ class ProposalCreator:
                 reading it from a file.
 
         Returns:
-            array:
+            array or tensor:
             An array of coordinates of proposal boxes.
             Its shape is :math:`(S, 4)`. :math:`S` is less than
             :obj:`self.n_test_post_nms` in test time and less than
@@ -390,6 +623,9 @@ class ProposalCreator:
         else:
             n_pre_nms = self.n_test_pre_nms
             n_post_nms = self.n_test_post_nms
+        if t.is_tensor(loc):
+            return self._propose_torch(loc, score, anchor, img_size, scale,
+                                       n_pre_nms, n_post_nms)
 
         # Convert anchors into proposal via bbox transformations.
         # roi = loc2bbox(anchor, loc)
@@ -409,11 +645,10 @@ class ProposalCreator:
         roi = roi[keep, :]
         score = score[keep]
 
-        # Sort all (proposal, score) pairs by score from highest to lowest.
-        # Take top pre_nms_topN (e.g. 6000).
-        order = score.ravel().argsort()[::-1]
-        if n_pre_nms > 0:
-            order = order[:n_pre_nms]
+        # Take top pre_nms_topN (e.g. 6000) (proposal, score) pairs, sorted
+        # by score from highest to lowest. Only those are sorted.
+        order = top_k_order(score.ravel(),
+                            n_pre_nms if n_pre_nms > 0 else None)
         roi = roi[order, :]
 
         # Apply nms (e.g. threshold = 0.7).
@@ -422,9 +657,34 @@ class ProposalCreator:
         # unNOTE: somthing is wrong here!
         # TODO: remove cuda.to_gpu
         keep = non_maximum_suppression(
-            cp.ascontiguousarray(cp.asarray(roi)),
+            np.ascontiguousarray(roi),
             thresh=self.nms_thresh)
         if n_post_nms > 0:
             keep = keep[:n_post_nms]
         roi = roi[keep]
         return roi
+
+    def _propose_torch(self, loc, score, anchor, img_size, scale,
+                       n_pre_nms, n_post_nms):
+        """Tensor version of :meth:`__call__`, on the device of loc"""
+        anchor = t.as_tensor(anchor, device=loc.device)
+        roi = loc2bbox_torch(anchor, loc)
+        roi[:, 0::2].clamp_(0, img_size[0])
+        roi[:, 1::2].clamp_(0, img_size[1])
+
+        min_size = self.min_size * scale
+        hs = roi[:, 2] - roi[:, 0]
+        ws = roi[:, 3] - roi[:, 1]
+        keep = ((hs >= min_size) & (ws >= min_size)).nonzero()[:, 0]
+        roi = roi[keep]
+        score = score[keep]
+
+        order = top_k_order(score, n_pre_nms if n_pre_nms > 0 else None)
+        roi = roi[order].contiguous()
+
+        # only the selected indices come back from the nms
+        keep = non_maximum_suppression(roi, thresh=self.nms_thresh)
+        if n_post_nms > 0:
+            keep = keep[:n_post_nms]
+        keep = t.from_numpy(keep).to(roi.device, dtype=t.long)
+        return roi[keep]
@@ -0,0 +1,183 @@
+"""Memory bounded IoU between sets of bounding boxes
+
+Broadcasting the IoU of :math:`N` boxes against :math:`K` boxes at once
+allocates several :math:`(N, K, 2)` temporaries, e.g. for the 17k anchors of
+a 600x800 input against the ground truth of a crowded frame. The functions
+here compute the IoUs in tiles of rows of :obj:`bbox_a` whose temporaries fit
+in a memory budget, and reduce each tile as it is computed when only the best
+matches are needed, so the :math:`(N, K)` matrix is never materialized.
+
+NumPy arrays are computed with NumPy, tensors with torch on their device.
+IoUs are the same values as :func:`model.utils.bbox_tools.bbox_iou` gave with
+a single broadcast.
+
+"""
+# Third party imports
+import numpy as np
+import torch as t
+
+# Module level constants
+DEFAULT_MAX_BYTES = 2 ** 26
+# (rows, K) temporaries alive while a tile is computed
+TILE_TEMPORARIES = 8
+
+
+def tile_rows(n_a, n_b, itemsize=4, max_bytes=None):
+    """Rows of bbox_a per tile so that the temporaries fit max_bytes"""
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+    rows = max_bytes // max(n_b * itemsize * TILE_TEMPORARIES, 1)
+    return int(min(max(rows, 1), max(n_a, 1)))
+
+
+def _iou_tile(bbox_a, bbox_b, area_b):
+    """IoUs of a few rows of bbox_a against all of bbox_b"""
+    if t.is_tensor(bbox_a):
+        tl = t.max(bbox_a[:, None, :2], bbox_b[:, :2])
+        br = t.min(bbox_a[:, None, 2:], bbox_b[:, 2:])
+        area_i = t.prod(br - tl, dim=2) * (tl < br).all(dim=2)
+        area_a = t.prod(bbox_a[:, 2:] - bbox_a[:, :2], dim=1)
+    else:
+        tl = np.maximum(bbox_a[:, None, :2], bbox_b[:, :2])
+        br = np.minimum(bbox_a[:, None, 2:], bbox_b[:, 2:])
+        area_i = np.prod(br - tl, axis=2) * (tl < br).all(axis=2)
+        area_a = np.prod(bbox_a[:, 2:] - bbox_a[:, :2], axis=1)
+    return area_i / (area_a[:, None] + area_b - area_i)
+
+
+def _iou_dtype(bbox_a, bbox_b):
+    """Type of the IoUs of bbox_a against bbox_b, as the tiles hold them"""
+    if t.is_tensor(bbox_a):
+        dtype = t.promote_types(bbox_a.dtype, bbox_b.dtype)
+        # the division of integer areas gives the default float type
+        return dtype if dtype.is_floating_point else t.get_default_dtype()
+    return np.result_type(bbox_a.dtype, bbox_b.dtype, np.float16)
+
+
+def _area(bbox):
+    if t.is_tensor(bbox):
+        return t.prod(bbox[:, 2:] - bbox[:, :2], dim=1)
+    return np.prod(bbox[:, 2:] - bbox[:, :2], axis=1)
+
+
+def iou_tiles(bbox_a, bbox_b, max_bytes=None):
+    """Iterate over the IoUs in tiles of rows
+
+    Args:
+        bbox_a (array or tensor): Boxes of shape :math:`(N, 4)`.
+        bbox_b (array or tensor): Boxes of shape :math:`(K, 4)`, of the
+            same type as :obj:`bbox_a`.
+        max_bytes (int): Memory budget of the temporaries of a tile.
+            :obj:`DEFAULT_MAX_BYTES` if not specified.
+
+    Yields:
+        (int, int, array or tensor):
+        :obj:`start, stop, iou`, where :obj:`iou` of shape
+        :math:`(stop - start, K)` holds the IoUs of
+        :obj:`bbox_a[start:stop]` against :obj:`bbox_b`.
+
+    """
+    if bbox_a.shape[1] != 4 or bbox_b.shape[1] != 4:
+        raise IndexError
+    n_a, n_b = len(bbox_a), len(bbox_b)
+    rows = tile_rows(n_a, n_b, bbox_a.dtype.itemsize, max_bytes)
+    area_b = _area(bbox_b)
+    for start in range(0, n_a, rows):
+        stop = min(start + rows, n_a)
+        yield start, stop, _iou_tile(bbox_a[start:stop], bbox_b, area_b)
+
+
+def iou_matrix(bbox_a, bbox_b, max_bytes=None):
+    """IoUs of shape (N, K), computed tile by tile into the output"""
+    n_a, n_b = len(bbox_a), len(bbox_b)
+    dtype = _iou_dtype(bbox_a, bbox_b)
+    if t.is_tensor(bbox_a):
+        iou = t.empty((n_a, n_b), dtype=dtype, device=bbox_a.device)
+    else:
+        iou = np.empty((n_a, n_b), dtype=dtype)
+    for start, stop, tile in iou_tiles(bbox_a, bbox_b, max_bytes):
+        iou[start:stop] = tile
+    return iou
+
+
+def iou_max(bbox_a, bbox_b, max_bytes=None):
+    """Best box of bbox_b for each box of bbox_a
+
+    Returns:
+        (array, array):
+        :obj:`argmax, max` of shape :math:`(N,)`: the index of the first
+        box of :obj:`bbox_b` with the highest IoU and that IoU, as
+        :obj:`iou_matrix(bbox_a, bbox_b).argmax(axis=1)` and
+        :obj:`max(axis=1)`. :math:`K` must be positive.
+
+    """
+    n_a = len(bbox_a)
+    dtype = _iou_dtype(bbox_a, bbox_b)
+    if t.is_tensor(bbox_a):
+        argmax = t.empty((n_a,), dtype=t.long, device=bbox_a.device)
+        max_ = t.empty((n_a,), dtype=dtype, device=bbox_a.device)
+    else:
+        argmax = np.empty((n_a,), dtype=np.int64)
+        max_ = np.empty((n_a,), dtype=dtype)
+    for start, stop, tile in iou_tiles(bbox_a, bbox_b, max_bytes):
+        argmax[start:stop] = tile.argmax(1)
+        max_[start:stop] = tile.max(1)[0] if t.is_tensor(tile) \
+            else tile.max(axis=1)
+    return argmax, max_
+
+
+def iou_match(bbox_a, bbox_b, max_bytes=None):
+    """Best matches in both directions, with the ties of bbox_b
+
+    As needed to assign ground truth boxes :obj:`bbox_b` to anchors
+    :obj:`bbox_a`. The reductions along both axes are done in one pass over
+    the tiles; a second pass finds the boxes of :obj:`bbox_a` that share the
+    highest IoU of a box of :obj:`bbox_b`.
+
+    Returns:
+        (array, array, array, array):
+
+        * **argmax_a, max_a**: As :func:`iou_max`, shape :math:`(N,)`.
+        * **max_b**: Highest IoU of each box of :obj:`bbox_b` over \
+            :obj:`bbox_a`, shape :math:`(K,)`.
+        * **tie_index**: Sorted indices of the boxes of :obj:`bbox_a` whose \
+            IoU with some box of :obj:`bbox_b` equals its :obj:`max_b`.
+
+    """
+    torch_input = t.is_tensor(bbox_a)
+    n_a, n_b = len(bbox_a), len(bbox_b)
+    dtype = _iou_dtype(bbox_a, bbox_b)
+    if torch_input:
+        argmax_a = t.empty((n_a,), dtype=t.long, device=bbox_a.device)
+        max_a = t.empty((n_a,), dtype=dtype, device=bbox_a.device)
+        max_b = t.full((n_b,), -float('inf'), dtype=dtype,
+                       device=bbox_a.device)
+    else:
+        argmax_a = np.empty((n_a,), dtype=np.int64)
+        max_a = np.empty((n_a,), dtype=dtype)
+        max_b = np.full((n_b,), -np.inf, dtype=dtype)
+    tiles = list()
+    for start, stop, tile in iou_tiles(bbox_a, bbox_b, max_bytes):
+        if torch_input:
+            max_a[start:stop], argmax_a[start:stop] = tile.max(1)
+            t.max(max_b, tile.max(0)[0], out=max_b)
+        else:
+            argmax_a[start:stop] = tile.argmax(axis=1)
+            max_a[start:stop] = tile.max(axis=1)
+            np.maximum(max_b, tile.max(axis=0), out=max_b)
+        # a single tile is kept for the second pass instead of recomputed
+        tiles = [(start, stop, tile)] if start == 0 and stop == n_a else None
+
+    ties = list()
+    for start, stop, tile in tiles or iou_tiles(bbox_a, bbox_b, max_bytes):
+        if torch_input:
+            ties.append((tile == max_b).any(dim=1).nonzero()[:, 0] + start)
+        else:
+            ties.append(np.flatnonzero((tile == max_b).any(axis=1)) + start)
+    if torch_input:
+        tie_index = t.cat(ties) if ties else \
+            t.zeros((0,), dtype=t.long, device=bbox_a.device)
+    else:
+        tie_index = np.concatenate(ties) if ties else \
+            np.zeros((0,), dtype=np.int64)
+    return argmax_a, max_a, max_b, tie_index
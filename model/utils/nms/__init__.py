@@ -1 +1,3 @@
-from model.utils.nms.non_maximum_suppression import non_maximum_suppression
\ No newline at end of file
+from model.utils.nms.non_maximum_suppression import non_maximum_suppression
+from model.utils.nms.non_maximum_suppression import batched_non_maximum_suppression
+from model.utils.nms.non_maximum_suppression import top_k_order
@@ -1,25 +1,47 @@
-
 import numpy as np
 
-def _nms_gpu_post( mask,
+
+def _nms_gpu_post(mask,
                   n_bbox,
-                   threads_per_block,
-                   col_blocks
+                  threads_per_block,
+                  col_blocks
                   ):
-    n_selection = 0
-    one_ull = np.array([1],dtype=np.uint64)
+    """Reduce the suppression mask of the nms kernel to the selected boxes
+
+    NumPy version of `_nms_gpu_post.pyx`. Bit `k` of
+    `mask[i * col_blocks + j]` is set if box `i` suppresses box
+    `j * threads_per_block + k`. Boxes are resolved one block of
+    `threads_per_block` at a time: the sequential dependency inside a block
+    is resolved on Python ints, visiting only the boxes that are not
+    suppressed yet, then the mask rows of the boxes kept from the block are
+    OR-reduced over all later blocks in one array operation.
+    """
+    mask = np.asarray(mask, dtype=np.uint64).reshape(n_bbox, col_blocks)
     selection = np.zeros((n_bbox,), dtype=np.int32)
+    n_selection = 0
     remv = np.zeros((col_blocks,), dtype=np.uint64)
 
-    for i in range(n_bbox):
-        nblock = i // threads_per_block
-        inblock = i % threads_per_block
-
-        if not (remv[nblock] & one_ull << inblock):
-            selection[n_selection] = i
-            n_selection += 1
+    for nblock in range(col_blocks):
+        start = nblock * threads_per_block
+        size = min(threads_per_block, n_bbox - start)
+        block = (1 << size) - 1
+        removed = int(remv[nblock])
+        rows = mask[start:start + size, nblock].tolist()
+        kept = list()
+        free = ~removed & block
+        while free:
+            # lowest box of the block that is still free
+            low = free & -free
+            inblock = low.bit_length() - 1
+            kept.append(start + inblock)
+            removed |= rows[inblock]
+            free = ~removed & block & ~((low << 1) - 1)
+        if not kept:
+            continue
 
-            index = i * col_blocks
-            for j in range(nblock, col_blocks):
-                remv[j] |= mask[index + j]
+        selection[n_selection:n_selection + len(kept)] = kept
+        n_selection += len(kept)
+        if nblock + 1 < col_blocks:
+            remv[nblock + 1:] |= np.bitwise_or.reduce(
+                mask[kept, nblock + 1:], axis=0)
     return selection, n_selection
@@ -1,28 +1,102 @@
 from __future__ import division
 import numpy as np
-import cupy as cp
 import torch as t
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, only the numpy backend is available
+    cp = None
 try:
     from ._nms_gpu_post import _nms_gpu_post
-except:
-    import warnings
-    warnings.warn('''
-    the python code for non_maximum_suppression is about 2x slow
-    It is strongly recommended to build cython code: 
-    `cd model/utils/nms/; python3 build.py build_ext --inplace''')
+except ImportError:
+    # vectorized per block of boxes, the cython build is optional
     from ._nms_gpu_post_py import _nms_gpu_post
 
+from utils import array_tool as at
+from utils.config import opt
+
+BACKENDS = ('auto', 'cpu', 'gpu')
+# boxes suppressed together by the cpu backend
+CPU_BLOCK = 64
+
+
+if cp is not None:
+    @cp.util.memoize(for_each_device=True)
+    def _load_kernel(kernel_name, code, options=()):
+        cp.cuda.runtime.free(0)
+        assert isinstance(options, tuple)
+        kernel_code = cp.cuda.compile_with_cache(code, options=options)
+        return kernel_code.get_function(kernel_name)
+
+
+def _select_backend(bbox, backend=None):
+    """Backend for an input array
 
-@cp.util.memoize(for_each_device=True)
-def _load_kernel(kernel_name, code, options=()):
-    cp.cuda.runtime.free(0)
-    assert isinstance(options, tuple)
-    kernel_code = cp.cuda.compile_with_cache(code, options=options)
-    return kernel_code.get_function(kernel_name)
+    'auto' runs CuPy arrays and CUDA tensors on the gpu, and NumPy arrays
+    on the gpu too if the configured device is a CUDA device and cupy is
+    available.
+    """
+    if backend is None:
+        backend = opt.nms_backend
+    if backend not in BACKENDS:
+        raise ValueError('Unknown nms backend {}, expected one of {}'.format(
+            backend, BACKENDS))
+    if backend == 'auto':
+        if cp is None:
+            backend = 'cpu'
+        elif t.is_tensor(bbox):
+            backend = 'gpu' if bbox.is_cuda else 'cpu'
+        elif isinstance(bbox, cp.ndarray) or at.get_device().type == 'cuda':
+            backend = 'gpu'
+        else:
+            backend = 'cpu'
+    if backend == 'gpu' and cp is None:
+        raise RuntimeError('The gpu nms backend requires cupy')
+    return backend
+
+
+def _as_array(x, backend):
+    """CuPy array of x for the gpu backend, NumPy array for the cpu one
+
+    CUDA tensors are shared with CuPy without a copy.
+    """
+    if x is None:
+        return None
+    if t.is_tensor(x):
+        x = x.detach()
+        if backend == 'gpu' and x.is_cuda:
+            return cp.asarray(x)
+        x = x.cpu().numpy()
+    if backend == 'gpu':
+        return cp.asarray(x)
+    if cp is not None:
+        return cp.asnumpy(x)
+    return x
+
+
+def top_k_order(score, k=None):
+    """Indices of the k highest scores, from the highest to the lowest
+
+    Selects the k highest scores with a partial selection (argpartition,
+    or topk for tensors) and sorts only those, instead of sorting all the
+    scores. All indices are returned if k is None or not smaller than the
+    number of scores. Accepts NumPy and CuPy arrays and tensors, and
+    returns indices of the same type.
+    """
+    n = len(score)
+    if t.is_tensor(score):
+        if k is None or k >= n:
+            return score.argsort(descending=True)
+        return score.topk(k, sorted=True)[1]
+    if k is None or k >= n:
+        return score.argsort()[::-1]
+    xp = np if cp is None else cp.get_array_module(score)
+    top = xp.argpartition(score, n - k)[n - k:]
+    return top[score[top].argsort()[::-1]]
 
 
 def non_maximum_suppression(bbox, thresh, score=None,
-                            limit=None):
+                            limit=None, backend=None):
     """Suppress bounding boxes according to their IoUs.
 
     This method checks each bounding box sequentially and selects the bounding
@@ -43,10 +117,15 @@ def non_maximum_suppression(bbox, thresh, score=None,
     :obj:`score` is a float array of shape :math:`(R,)`. Each score indicates
     confidence of prediction.
 
-    This function accepts both :obj:`numpy.ndarray` and :obj:`cupy.ndarray` as
-    an input. Please note that both :obj:`bbox` and :obj:`score` need to be
-    the same type.
-    The type of the output is the same as the input.
+    This function accepts :obj:`numpy.ndarray`, :obj:`cupy.ndarray` and
+    :obj:`torch.Tensor` as an input. Please note that both :obj:`bbox` and
+    :obj:`score` need to be the same type.
+    The output is always a :obj:`numpy.ndarray`.
+
+    Suppression runs in a CuPy kernel ('gpu') or in blocked, vectorized
+    NumPy ('cpu'). With the 'auto' backend, CuPy inputs go to the kernel,
+    and NumPy inputs too when :obj:`opt.device` is a CUDA device.
+    :obj:`opt.nms_backend` sets the default.
 
     Args:
         bbox (array): Bounding boxes to be transformed. The shape is
@@ -56,6 +135,8 @@ def non_maximum_suppression(bbox, thresh, score=None,
         limit (int): The upper bound of the number of the output bounding
             boxes. If it is not specified, this method selects as many
             bounding boxes as possible.
+        backend (str): 'auto', 'cpu' or 'gpu'. :obj:`opt.nms_backend` if
+            not specified.
 
     Returns:
         array:
@@ -67,7 +148,64 @@ def non_maximum_suppression(bbox, thresh, score=None,
 
     """
 
-    return _non_maximum_suppression_gpu(bbox, thresh, score, limit)
+    backend = _select_backend(bbox, backend)
+    bbox, score = _as_array(bbox, backend), _as_array(score, backend)
+    if backend == 'gpu':
+        return _non_maximum_suppression_gpu(bbox, thresh, score, limit)
+    return _non_maximum_suppression_cpu(bbox, thresh, score, limit)
+
+
+def batched_non_maximum_suppression(bbox, thresh, score, label,
+                                    limit=None, backend=None):
+    """Suppress bounding boxes of several classes in one pass.
+
+    Same as calling :func:`non_maximum_suppression` separately on the boxes
+    of each value of :obj:`label`, but with a single call: boxes only
+    suppress boxes of the same label. The 'gpu' backend shifts the boxes of
+    each label by a multiple of the largest coordinate so that boxes of
+    different labels never overlap (up to the float32 rounding of the
+    shifted coordinates), and runs the kernel once on all of them. The 'cpu' backend resolves the labels one after the other within
+    the call, so it never computes IoUs between labels.
+
+    Args:
+        bbox (array): Bounding boxes of shape :math:`(R, 4)`.
+        thresh (float): Threshold of IoUs.
+        score (array): Confidences of shape :math:`(R,)`.
+        label (array): Integer labels of shape :math:`(R,)`.
+        limit (int): The upper bound of the number of the output bounding
+            boxes, over all labels.
+        backend (str): 'auto', 'cpu' or 'gpu'. :obj:`opt.nms_backend` if
+            not specified.
+
+    Returns:
+        array:
+        Indices of the selected boxes, sorted by score in descending order \
+        over all labels. The dtype is :obj:`numpy.int32`.
+
+    """
+    backend = _select_backend(bbox, backend)
+    bbox, score, label = [_as_array(x, backend) for x in (bbox, score, label)]
+    if backend == 'gpu':
+        bbox = bbox.astype(np.float32, copy=False)
+        if len(bbox) == 0:
+            return np.zeros((0,), dtype=np.int32)
+        offset = (label - label.min()).astype(np.float32) * \
+            (bbox.max() - bbox.min() + 1)
+        return _non_maximum_suppression_gpu(bbox + offset[:, None], thresh,
+                                            score, limit)
+    if len(bbox) == 0:
+        return np.zeros((0,), dtype=np.int32)
+    order = np.argsort(label, kind='stable').astype(np.int32)
+    bounds = np.flatnonzero(np.diff(label[order])) + 1
+    selec = list()
+    for group in np.split(order, bounds):
+        selec.append(group[_non_maximum_suppression_cpu(
+            bbox[group], thresh, score[group], limit)])
+    selec = np.concatenate(selec)
+    if limit is not None and limit < len(selec):
+        return selec[top_k_order(score[selec], limit)]
+    # stable, so equal scores of a label keep their nms order
+    return selec[np.argsort(-score[selec], kind='stable')]
 
 
 def _non_maximum_suppression_gpu(bbox, thresh, score=None, limit=None):
@@ -77,7 +215,8 @@ def _non_maximum_suppression_gpu(bbox, thresh, score=None, limit=None):
     n_bbox = bbox.shape[0]
 
     if score is not None:
-        order = score.argsort()[::-1].astype(np.int32)
+        # every box may be visited, so all of them are ordered
+        order = top_k_order(score).astype(np.int32)
     else:
         order = cp.arange(n_bbox, dtype=np.int32)
 
@@ -176,3 +315,84 @@ def _call_nms_kernel(bbox, thresh):
     selection, n_selec = _nms_gpu_post(
         mask_host, n_bbox, threads_per_block, col_blocks)
     return selection, n_selec
+
+
+def _non_maximum_suppression_cpu(bbox, thresh, score=None, limit=None,
+                                 block=CPU_BLOCK):
+    """NumPy version of :func:`_non_maximum_suppression_gpu`
+
+    Boxes are visited in blocks of :obj:`block` in score order. Each block
+    is first tested against all boxes selected so far in one vectorized
+    IoU, then its remaining boxes are resolved sequentially against the
+    IoU mask within the block. Boxes after the block that completes
+    :obj:`limit` selections are never looked at. IoUs are computed in
+    float32 like the kernel, so both backends select the same boxes.
+    """
+    n_bbox = len(bbox)
+    if n_bbox == 0:
+        return np.zeros((0,), dtype=np.int32)
+    if limit is None or limit > n_bbox:
+        limit = n_bbox
+
+    if score is not None:
+        # every box may be visited, so all of them are ordered
+        order = top_k_order(score).astype(np.int32)
+    else:
+        order = np.arange(n_bbox, dtype=np.int32)
+
+    # coordinates as contiguous (4, R) rows for the broadcasts below
+    coord = np.ascontiguousarray(bbox[order].T, dtype=np.float32)
+    area = (coord[2] - coord[0]) * (coord[3] - coord[1])
+    # selected boxes, in the same layout
+    selec = np.empty((limit,), dtype=np.int32)
+    selec_coord = np.empty((4, limit), dtype=np.float32)
+    selec_area = np.empty((limit,), dtype=np.float32)
+    n_selec = 0
+    for start in range(0, n_bbox, block):
+        end = min(start + block, n_bbox)
+        b_coord, b_area = coord[:, start:end], area[start:end]
+        if n_selec > 0:
+            removed = (_iou_float32(selec_coord[:, :n_selec],
+                                    selec_area[:n_selec],
+                                    b_coord, b_area) >= thresh).any(axis=0)
+        else:
+            removed = np.zeros((end - start,), dtype=bool)
+        if removed.all():
+            continue
+        # overlaps within the block: (B, B)
+        over = _iou_float32(b_coord, b_area, b_coord, b_area) >= thresh
+        for i in np.flatnonzero(~removed):
+            if removed[i]:
+                continue
+            selec[n_selec] = start + i
+            selec_coord[:, n_selec] = b_coord[:, i]
+            selec_area[n_selec] = b_area[i]
+            n_selec += 1
+            if n_selec == limit:
+                return order[selec]
+            removed[i + 1:] |= over[i, i + 1:]
+
+    return order[selec[:n_selec]]
+
+
+def _iou_float32(coord_a, area_a, coord_b, area_b):
+    """IoU matrix of float32 boxes given as (4, R) coordinate rows
+
+    Same arithmetic as devIoU of the kernel, computed in place to keep the
+    number of (A, B) temporaries low.
+    """
+    a, b = coord_a[:, :, None], coord_b[:, None, :]
+    height = np.minimum(a[2], b[2])
+    tmp = np.maximum(a[0], b[0])
+    height -= tmp
+    np.maximum(height, 0, out=height)
+    width = np.minimum(a[3], b[3])
+    np.maximum(a[1], b[1], out=tmp)
+    width -= tmp
+    np.maximum(width, 0, out=width)
+    area_i = height
+    area_i *= width
+    union = np.add(area_a[:, None], area_b[None, :], out=tmp)
+    union -= area_i
+    area_i /= union
+    return area_i
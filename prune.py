@@ -1,6 +1,10 @@
 from __future__ import  absolute_import
 # though cupy is not used but without this line, it raise errors...
-import cupy as cp
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
 import os
 
 
@@ -9,7 +13,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from utils.config import opt
-from data.dataset import Dataset, TestDataset, inverse_normalize
+from data.dataset import Dataset, TestDataset, inverse_normalize, \
+    collate_test
+from data.device_loader import DeviceLoader
 from model.faster_rcnn_vgg16 import FasterRCNNVGG16
 from torch.utils import data as data_
 import torch
@@ -28,6 +34,8 @@ parser.add_argument("--prune_by_std", "-std", default=True,
 parser.add_argument("--sensitivity", "-s", type=float, default=0.25, help="Number of standard devs to scale")
 parser.add_argument("--percentile", "-p", type=float, default=5.0, help="Perecentage of weights ot prune")
 parser.add_argument("--save_path", "-sp", type=str, default="./checkpoints/final_pruned.model", help="final save path after pruning")
+parser.add_argument("--device", type=str, default=opt.device, help="Device to run on, e.g. cuda or cpu")
+parser.add_argument("--num_threads", type=int, default=opt.num_threads, help="Torch threads on cpu, 0 keeps the default")
 args = parser.parse_args()
 
 
@@ -40,9 +48,8 @@ def train(opt, faster_rcnn, dataloader, test_dataloader, trainer, lr_, best_map)
     for epoch in range(opt.epoch):
         trainer.reset_meters()
         pbar = tqdm(enumerate(dataloader), total=len(dataloader))
-        for ii, (img, bbox_, label_, scale) in pbar:
+        for ii, (img, bbox, label, scale) in pbar:
             scale = at.scalar(scale)
-            img, bbox, label = img.cuda().float(), bbox_.cuda(), label_.cuda()
             losses = trainer.train_step(img, bbox, label, scale, prune_train=True)
             if ii % 100 == 0:
                 rpnloc = losses[0].cpu().data.numpy()
@@ -60,8 +67,8 @@ def train(opt, faster_rcnn, dataloader, test_dataloader, trainer, lr_, best_map)
                 try:
                     ori_img_ = inverse_normalize(at.tonumpy(img[0]))
                     gt_img = visdom_bbox(ori_img_,
-                                        at.tonumpy(bbox_[0]),
-                                        at.tonumpy(label_[0]))
+                                        at.tonumpy(bbox[0]),
+                                        at.tonumpy(label[0]))
                     trainer.vis.img('gt_img', gt_img)
                     plt.show()
 
@@ -90,6 +97,8 @@ def train(opt, faster_rcnn, dataloader, test_dataloader, trainer, lr_, best_map)
                 trainer.vis.log(log_info)
 
 
+        print(dataloader.summary())
+
         # Save after every epoch
         epoch_path = trainer.save(epoch, best_map=0)
                 
@@ -115,15 +124,19 @@ def train(opt, faster_rcnn, dataloader, test_dataloader, trainer, lr_, best_map)
             break
 
 def main():
+    opt.device, opt.num_threads = args.device, args.num_threads
+    device = at.init_device()
     dataset = Dataset(opt)
     dataloader = data_.DataLoader(dataset, \
                                 batch_size=1, \
                                 shuffle=True, \
-                                # pin_memory=True,
                                 num_workers=opt.num_workers)
+    dataloader = DeviceLoader(dataloader, device=device,
+                              depth=opt.prefetch_depth, host_fields=(3,))
     testset = TestDataset(opt, split='val')
     test_dataloader = data_.DataLoader(testset,
-                                    batch_size=1,
+                                    batch_size=opt.test_batch_size,
+                                    collate_fn=collate_test,
                                     num_workers=opt.test_num_workers,
                                     shuffle=False, \
                                     pin_memory=True
@@ -132,13 +145,13 @@ def main():
     print(f"TRAIN SET: {len(dataloader)} | TEST SET: {len(test_dataloader)}")
     faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
     print('model construct completed')
-    trainer = FasterRCNNTrainer(faster_rcnn).cuda()
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
     best_map = 0
     lr_ = opt.lr
 
     if opt.load_path:
         assert os.path.isfile(opt.load_path), 'Checkpoint {} does not exist.'.format(opt.load_path)
-        checkpoint = torch.load(opt.load_path)['other_info']
+        checkpoint = torch.load(opt.load_path, map_location=device)['other_info']
         trainer.load(opt.load_path)
         print("="*30+"   Checkpoint   "+"="*30)
         print("Loaded checkpoint '{}' (epoch {})".format(opt.load_path, 1)) #no saved epoch, put in 1 for now
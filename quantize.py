@@ -1,10 +1,15 @@
 from __future__ import  absolute_import
 # though cupy is not used but without this line, it raise errors...
-import cupy as cp
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
 import os
 import ipdb
 import matplotlib.pyplot as plt
 from tqdm import tqdm
+from utils import array_tool as at
 from utils.config import opt
 from model.faster_rcnn_vgg16 import FasterRCNNVGG16
 import torch
@@ -18,12 +23,14 @@ parser.add_argument("--bits", "-b", type=int, default=5, help="Number of bits to
 parser.add_argument("--verbose", default=True, action='store_false', help="Print verbose or not")
 parser.add_argument("--save_path", type=str, default="./checkpoints/quantized_model.model", help="Model save path")
 parser.add_argument("--load_path", type=str, default="./checkpoints/pruned_model.model", help="Pruned model to quantize")
+parser.add_argument("--device", type=str, default=opt.device, help="Device to run on, e.g. cuda or cpu")
 parser.add_argument("--convert_sparse_dense", default=False, action='store_true', help="Save a model with SparseDenseLinear rather than MaskedLinear to save space, to use this in the future change utils/config.sparse_dense to True")
 args = parser.parse_args()
 
 def main():
+    opt.device = args.device
     faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
-    trainer = FasterRCNNTrainer(faster_rcnn).cuda()
+    trainer = FasterRCNNTrainer(faster_rcnn).to(at.init_device())
     assert os.path.isfile(args.load_path), f"Need valid checkpoint, {args.load_path} not found"
     trainer.load(args.load_path)
     '''
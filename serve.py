@@ -0,0 +1,359 @@
+"""Inference server with dynamic micro-batching
+
+Loads a checkpoint once and serves detections over plain HTTP, on a
+localhost port or a Unix socket, without any outside service.
+
+* ``POST /predict`` takes an encoded frame, e.g. JPEG or PNG, as the body
+  and returns its detections as JSON, ``{"bboxes": [[y_min, x_min, y_max,
+  x_max], ...], "labels": [...], "scores": [...]}`` in the coordinates of
+  the frame.
+* ``GET /metrics`` returns the counters and latencies of the server as
+  JSON, with the depth of the request queue and the frames in flight.
+* ``GET /health`` returns ``{"status": "ok"}``.
+
+Frames are decoded and preprocessed on a thread pool and queued. A batcher
+groups the queued frames into micro-batches of at most :obj:`max_batch`
+frames, waiting at most :obj:`max_wait_ms` for the batch to fill, and runs
+each of them through :meth:`FasterRCNN.predict_batch` on a single worker
+thread, so the event loop keeps accepting requests while the model runs.
+When :obj:`max_queue` frames are in flight, decoding or waiting for the
+model, new requests are rejected with 503 right away instead of queueing
+without bound.
+
+# Example
+Run command as follows from the project root:
+
+    $ python serve.py --path checkpoints/fasterrcnn_xxx --port 8080
+    $ python serve.py --path checkpoints/fasterrcnn_xxx --unix /tmp/frcnn.sock
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
+import argparse
+import asyncio
+import collections
+import io
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from utils.config import opt
+from data.dataset import preprocess
+from data.util import read_image
+from model.faster_rcnn_vgg16 import FasterRCNNVGG16
+from trainer import FasterRCNNTrainer
+from utils import array_tool as at
+
+# Module level constants
+MAX_BODY = 32 * 2 ** 20
+LATENCY_WINDOW = 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    """Method, path, headers and body of the next request, None at EOF"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, path, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, 'bad content-length')
+    if length < 0:
+        raise HTTPError(400, 'bad content-length')
+    if length > MAX_BODY:
+        raise HTTPError(413, 'body over {} bytes'.format(MAX_BODY))
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True, headers=None):
+    body = json.dumps(payload).encode()
+    lines = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, '')),
+             'Content-Type: application/json',
+             'Content-Length: {}'.format(len(body)),
+             'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+    for key, value in (headers or dict()).items():
+        lines.append('{}: {}'.format(key, value))
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+
+
+class InferenceServer(object):
+    """Serve the detections of a model with dynamic micro-batching
+
+    Args:
+        faster_rcnn (FasterRCNN): The detector, on its device.
+        max_batch (int): Frames per call of :meth:`predict_batch`.
+        max_wait_ms (float): Time the batcher waits for more frames after
+            the first one of a batch.
+        max_queue (int): Frames in flight, decoding or waiting for the
+            model, before requests are rejected.
+        decode_workers (int): Threads decoding and preprocessing frames.
+
+    """
+
+    def __init__(self, faster_rcnn, max_batch=8, max_wait_ms=10.,
+                 max_queue=64, decode_workers=2):
+        self.faster_rcnn = faster_rcnn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.
+        self.max_queue = max(1, max_queue)
+        self.decoder = ThreadPoolExecutor(max_workers=max(1, decode_workers))
+        # one model, one thread running it
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.in_flight = 0
+        self.counters = collections.Counter()
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started = time.time()
+
+    def _decode(self, body):
+        img = read_image(io.BytesIO(body))
+        size = img.shape[1:]
+        return preprocess(img, opt.min_size, opt.max_size), size
+
+    def _predict(self, imgs, sizes):
+        return self.faster_rcnn.predict_batch(imgs, sizes)
+
+    async def batcher(self):
+        """Run the queued frames through the model in micro-batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            imgs = [img for img, _, _ in batch]
+            sizes = [size for _, size, _ in batch]
+            self.counters['batches'] += 1
+            self.batch_sizes.append(len(batch))
+            try:
+                bboxes, labels, scores = await loop.run_in_executor(
+                    self.worker, self._predict, imgs, sizes)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), bbox, label, score in \
+                    zip(batch, bboxes, labels, scores):
+                if not future.done():
+                    future.set_result(dict(bboxes=bbox.tolist(),
+                                           labels=label.tolist(),
+                                           scores=score.tolist()))
+
+    async def predict(self, body):
+        """Detections of an encoded frame"""
+        # frames being decoded count against the limit too, the queue alone
+        # does not bound the work accepted
+        if self.in_flight >= self.max_queue:
+            raise HTTPError(503, 'queue full')
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                img, size = await loop.run_in_executor(self.decoder,
+                                                       self._decode, body)
+            except Exception:
+                raise HTTPError(400, 'cannot decode image')
+            future = loop.create_future()
+            self.queue.put_nowait((img, size, future))
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       self.queue.qsize())
+            return await future
+        finally:
+            self.in_flight -= 1
+
+    def metrics(self):
+        """Counters, queue depth and latencies of the server"""
+        latencies = np.asarray(self.latencies) * 1000.
+        p50, p95, p99 = np.percentile(latencies, (50, 95, 99)) \
+            if len(latencies) else (0., 0., 0.)
+        batch_sizes = np.asarray(self.batch_sizes)
+        return dict(
+            queue_depth=self.queue.qsize() if self.queue else 0,
+            in_flight=self.in_flight,
+            max_queue_depth=self.max_queue_depth,
+            queue_capacity=self.max_queue,
+            requests=self.counters['requests'],
+            completed=self.counters['completed'],
+            rejected=self.counters['rejected'],
+            errors=self.counters['errors'],
+            batches=self.counters['batches'],
+            mean_batch_size=float(batch_sizes.mean())
+            if len(batch_sizes) else 0.,
+            p50_ms=float(p50),
+            p95_ms=float(p95),
+            p99_ms=float(p99),
+            uptime_sec=time.time() - self.started,
+        )
+
+    async def handle(self, reader, writer):
+        """Serve the requests of one connection"""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HTTPError as e:
+                    write_response(writer, e.status, dict(error=str(e)),
+                                   keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status, payload, extra = await self.route(method, path, body)
+                write_response(writer, status, payload, keep_alive, extra)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        path = path.split('?')[0]
+        if path == '/predict':
+            if method != 'POST':
+                return 405, dict(error='POST an encoded frame'), None
+            self.counters['requests'] += 1
+            since = time.time()
+            try:
+                result = await self.predict(body)
+            except HTTPError as e:
+                key = 'rejected' if e.status == 503 else 'errors'
+                self.counters[key] += 1
+                extra = {'Retry-After': 1} if e.status == 503 else None
+                return e.status, dict(error=str(e)), extra
+            except Exception as e:
+                self.counters['errors'] += 1
+                return 500, dict(error=repr(e)), None
+            self.counters['completed'] += 1
+            self.latencies.append(time.time() - since)
+            return 200, result, None
+        if path == '/metrics':
+            return 200, self.metrics(), None
+        if path == '/health':
+            return 200, dict(status='ok'), None
+        return 404, dict(error='unknown path {}'.format(path)), None
+
+    async def start(self, host='127.0.0.1', port=8080, unix=None):
+        """Start serving, returns the :class:`asyncio.Server`"""
+        if unix and os.path.lexists(unix):
+            # only a stale socket of an earlier server is replaced
+            if not stat.S_ISSOCK(os.lstat(unix).st_mode):
+                raise FileExistsError(
+                    '{} exists and is not a socket'.format(unix))
+            os.remove(unix)
+        # bounded by the frames in flight, see predict
+        self.queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self.batcher())
+        if unix:
+            return await asyncio.start_unix_server(self.handle, path=unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        self._batcher.cancel()
+        self.decoder.shutdown(wait=False)
+        self.worker.shutdown(wait=True)
+
+
+async def serve(server, host, port, unix):
+    listener = await server.start(host, port, unix)
+    print('Serving on {}'.format(unix or '{}:{}'.format(host, port)))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", help="Checkpoint of the detector")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", help="Serve on this Unix socket instead")
+    parser.add_argument("--max-batch", dest="max_batch", type=int,
+                        default=opt.serve_max_batch)
+    parser.add_argument("--max-wait-ms", dest="max_wait_ms", type=float,
+                        default=opt.serve_max_wait_ms)
+    parser.add_argument("--max-queue", dest="max_queue", type=int,
+                        default=opt.serve_max_queue)
+    parser.add_argument("--device", default=opt.device,
+                        help="Device to run on, e.g. cuda or cpu")
+    parser.add_argument("--num-threads", dest="num_threads", type=int,
+                        default=opt.num_threads,
+                        help="Torch threads on cpu, 0 keeps the default")
+    args = parser.parse_args()
+    opt.device, opt.num_threads = args.device, args.num_threads
+
+    device = at.init_device()
+    faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
+    if args.path:
+        assert os.path.isfile(args.path), \
+            'Checkpoint {} does not exist.'.format(args.path)
+        trainer.load(args.path)
+    else:
+        print("No checkpoint specified, serving untrained detections")
+    faster_rcnn.use_preset('evaluate')
+
+    server = InferenceServer(faster_rcnn, max_batch=args.max_batch,
+                             max_wait_ms=args.max_wait_ms,
+                             max_queue=args.max_queue)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Benchmark keyframe scheduling of video inference
+
+Runs :class:`model.keyframe.KeyframeDetector` over the frames of Caltech
+videos in temporal order for a range of keyframe intervals, and reports for
+each of them the mAP of the tracks of every frame, computed with
+:func:`utils.eval_tool.eval_detection_voc`, against the throughput. Interval
+1 runs the whole detector on every frame and is the baseline. Keyframes are
+scored on their tracks too, so every interval sees the same score filter of
+the tracker.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.benchmark_keyframe --path checkpoints/fasterrcnn_xxx \\
+        --set_id set06 --intervals 1 2 4 8 16 --refine
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
+import argparse
+import os
+import time
+
+# Third party imports
+from tqdm import tqdm
+
+# Project level imports
+from utils.config import opt
+from data.video_stream import VideoFrameStream
+from model.faster_rcnn_vgg16 import FasterRCNNVGG16
+from model.keyframe import KeyframeDetector
+from model.tracker import Tracker
+from trainer import FasterRCNNTrainer
+from utils import array_tool as at
+from utils.eval_tool import eval_detection_voc
+
+
+def run(stream, detector, test_num=10000):
+    """Detect the frames of the stream and evaluate the detections
+
+    Returns:
+        dict: mAP, number of frames and keyframes, and the seconds spent in
+        the detector and in total.
+
+    """
+    frame_ids = stream.frame_ids()
+    pred_bboxes, pred_labels, pred_scores = list(), list(), list()
+    gt_bboxes, gt_labels = list(), list()
+    n_frame, n_keyframe = 0, 0
+    detect_time = 0.
+    video = None
+    since = time.time()
+    for imgs, sizes, gt_bboxes_, gt_labels_ in tqdm(stream):
+        for img, size in zip(imgs, sizes):
+            set_id, video_id, _ = frame_ids[n_frame]
+            if (set_id, video_id) != video:
+                detector.reset()
+                video = (set_id, video_id)
+            n_keyframe += detector.is_keyframe()
+
+            start = time.time()
+            bbox, label, score = detector(img, size)
+            detect_time += time.time() - start
+
+            pred_bboxes.append(bbox)
+            pred_labels.append(label)
+            pred_scores.append(score)
+            n_frame += 1
+        gt_bboxes += gt_bboxes_
+        gt_labels += gt_labels_
+        if n_frame > test_num:
+            break
+    total_time = time.time() - since
+
+    n = len(pred_bboxes)
+    result = eval_detection_voc(
+        pred_bboxes, pred_labels, pred_scores,
+        gt_bboxes[:n], gt_labels[:n], use_07_metric=True)
+    return dict(map=result['map'], frames=n_frame, keyframes=n_keyframe,
+                detect_time=detect_time, total_time=total_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", help="Checkpoint of the detector")
+    parser.add_argument("-s", "--set_id", default='set06')
+    parser.add_argument("--video", help="Only run this video, e.g. V000")
+    parser.add_argument("--split", default='test')
+    parser.add_argument("--intervals", type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16],
+                        help="Keyframe intervals, max intervals if adaptive")
+    parser.add_argument("--adaptive", action="store_true",
+                        default=opt.key_adaptive,
+                        help="Trigger keyframes on new objects and lost tracks")
+    parser.add_argument("--refine", action="store_true",
+                        default=opt.key_refine,
+                        help="Refine the propagated boxes with the head")
+    parser.add_argument("--test_num", type=int, default=opt.test_num)
+    parser.add_argument("--device", default=opt.device,
+                        help="Device to run on, e.g. cuda or cpu")
+    parser.add_argument("--num-threads", dest="num_threads", type=int,
+                        default=opt.num_threads,
+                        help="Torch threads on cpu, 0 keeps the default")
+    args = parser.parse_args()
+    opt.device, opt.num_threads = args.device, args.num_threads
+    device = at.init_device()
+
+    stream = VideoFrameStream(opt, split=args.split, set_id=args.set_id,
+                              video=args.video)
+    print(f"FRAMES: {len(stream)} | VIDEOS: {len(stream.videos())}")
+
+    faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
+    if args.path:
+        assert os.path.isfile(args.path), \
+            'Checkpoint {} does not exist.'.format(args.path)
+        trainer.load(args.path)
+    else:
+        print("No checkpoint specified, benchmarking untrained detections")
+    faster_rcnn.use_preset('evaluate')
+
+    tracker = Tracker(iou_thresh=opt.track_iou_thresh,
+                      max_age=opt.track_max_age,
+                      min_hits=opt.track_min_hits,
+                      min_score=opt.track_min_score,
+                      matcher=opt.track_matcher)
+    results = list()
+    for interval in args.intervals:
+        detector = KeyframeDetector(faster_rcnn, tracker, interval=interval,
+                                    adaptive=args.adaptive,
+                                    refine=args.refine,
+                                    new_objects=opt.key_new_objects,
+                                    uncertainty=opt.key_uncertainty)
+        results.append((interval, run(stream, detector, args.test_num)))
+
+    print('[ADAPTIVE] {} | [REFINE] {}'.format(args.adaptive, args.refine))
+    print('{:>8} {:>9} {:>8} {:>12} {:>14}'.format(
+        'interval', 'keyframes', 'mAP', 'detector FPS', 'end to end FPS'))
+    for interval, result in results:
+        n = result['frames']
+        print('{:>8} {:>9} {:>8.4f} {:>12.2f} {:>14.2f}'.format(
+            interval, result['keyframes'], result['map'],
+            n / max(result['detect_time'], 1e-9),
+            n / max(result['total_time'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,11 @@
 from __future__ import  absolute_import
 
 # Standard dist imports
-import cupy as cp
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
 import logging
 import os
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -16,34 +20,46 @@ from tqdm import tqdm
 # Project level imports
 from core.logger import Logger
 from utils.config import opt
-from data.dataset import TestDataset
+from data.dataset import TestDataset, collate_test
+from data.video_stream import VideoFrameStream
 from model.faster_rcnn_vgg16 import FasterRCNNVGG16
+from model.latency_controller import LatencyController
 from torch.utils import data as data_
 from trainer import FasterRCNNTrainer
+from utils import array_tool as at
 from utils.eval_tool import AverageMeter
 
 # Module level constants
 FPS = 'fps'
 
-def benchmark(benchmarker, dataloader, faster_rcnn, test_num=1000):
+def benchmark(benchmarker, dataloader, faster_rcnn, test_num=1000,
+              controller=None):
     logger = logging.getLogger(__name__)
     Logger.section_break(title='Benchmark Begin')
 
-    since = time.time()
+    n_img = 0
     for ii, \
         (imgs, sizes, gt_bboxes_, gt_labels_) in tqdm(enumerate(dataloader)):
-        sizes = [sizes[0][0].item(), sizes[1][0].item()]
         since = time.time()
-        pred_bboxes_, pred_labels_, pred_scores_ = faster_rcnn.predict(imgs,
-                                                                       [sizes])
-
-        benchmarker[FPS].update(1/(time.time() - since))
+        if controller is None:
+            pred_bboxes_, pred_labels_, pred_scores_ = \
+                faster_rcnn.predict_batch(imgs, sizes)
+        else:
+            # frame by frame, each under the latency target
+            for img, size in zip(imgs, sizes):
+                controller(img, size)
+
+        # images per second of the batch, weighted by its number of images
+        benchmarker[FPS].update(len(sizes)/(time.time() - since), len(sizes))
+        n_img += len(sizes)
 
         if ii % 10 == 0:
             logger.info('{:5}: FPS {t.val:.3f} ({t.avg:.3f})'.
-                        format(ii, t=benchmarker[FPS]))
+                        format(n_img, t=benchmarker[FPS]))
+            if controller is not None:
+                logger.info('{:5}: SLO {}'.format(n_img, controller.metrics()))
 
-        if ii == test_num:
+        if n_img > test_num:
             break
 
     return benchmarker
@@ -65,13 +81,17 @@ def main(**kwargs):
 
 
     # Load dataset
-    dataset = TestDataset(opt, split='test')
-    dataloader = data_.DataLoader(dataset,
-                                       batch_size=1,
-                                       num_workers=opt.test_num_workers,
-                                       shuffle=False,
-                                       pin_memory=True
-                                       )
+    if opt.video_stream:
+        dataloader = VideoFrameStream(opt, split='test')
+    else:
+        dataset = TestDataset(opt, split='test')
+        dataloader = data_.DataLoader(dataset,
+                                           batch_size=opt.test_batch_size,
+                                           collate_fn=collate_test,
+                                           num_workers=opt.test_num_workers,
+                                           shuffle=False,
+                                           pin_memory=True
+                                           )
 
     logger.info(f"DATASET SIZE: {len(dataloader)}")
     logger.info("Using Mask VGG") if opt.mask else logger.info("Using normal VGG16")
@@ -79,7 +99,7 @@ def main(**kwargs):
 
     # Construct model
     faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
-    trainer = FasterRCNNTrainer(faster_rcnn).cuda()
+    trainer = FasterRCNNTrainer(faster_rcnn).to(at.init_device())
     Logger.section_break(title='Model')
     logger.info(str(faster_rcnn))
 
@@ -97,8 +117,22 @@ def main(**kwargs):
     # Benchmark dataset
     fps = AverageMeter()
     benchmarker = {FPS: fps}
-    result = benchmark(benchmarker, dataloader, faster_rcnn, test_num=1000)
+    controller = None
+    if opt.slo_target_ms:
+        controller = LatencyController(faster_rcnn, opt.slo_target_ms,
+                                       pre_nms=opt.slo_pre_nms,
+                                       post_nms=opt.slo_post_nms,
+                                       score_thresh=opt.slo_score_thresh,
+                                       margin=opt.slo_margin)
+    result = benchmark(benchmarker, dataloader, faster_rcnn, test_num=1000,
+                       controller=controller)
     Logger.section_break('Benchmark completed')
+    if controller is not None:
+        for k, v in controller.metrics().items():
+            logger.info('[SLO] {}: {}'.format(k, v))
+        controller.restore()
+    if opt.video_stream:
+        logger.info('[STREAM WAIT] {:.3f} sec'.format(dataloader.wait_time))
     model_parameters = filter(lambda p: p.requires_grad, faster_rcnn.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])
     logger.info('[PARAMETERS] {params}'.format(params=params))
@@ -0,0 +1,86 @@
+"""Benchmark non-maximum suppression backends
+
+Times `model.utils.nms.non_maximum_suppression` on synthetic proposals for
+each backend that can run on this machine, and checks that the backends
+select the same boxes.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.benchmark_nms --sizes 300 2000 12000 --limit 2000
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+import argparse
+import time
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from model.utils.nms import non_maximum_suppression
+from model.utils.nms.non_maximum_suppression import cp
+
+# Module level constants
+IMG_SIZE = (600, 800)
+
+
+def random_proposals(n_bbox, seed=0):
+    """Proposal-like boxes, clustered around a few objects"""
+    rng = np.random.RandomState(seed)
+    H, W = IMG_SIZE
+    n_objects = max(n_bbox // 50, 1)
+    centers = rng.rand(n_objects, 2) * np.array([H, W])
+    center = centers[rng.randint(0, n_objects, n_bbox)] + \
+        rng.randn(n_bbox, 2) * 16
+    size = rng.rand(n_bbox, 2) * np.array([200, 100]) + 16
+    bbox = np.hstack((center - size / 2, center + size / 2))
+    score = rng.rand(n_bbox)
+    return bbox.astype(np.float32), score.astype(np.float32)
+
+
+def time_backend(backend, bbox, score, thresh, limit, repeat):
+    if backend == 'gpu':
+        bbox, score = cp.asarray(bbox), cp.asarray(score)
+    # warm up, compiles the kernel on the gpu
+    keep = non_maximum_suppression(bbox, thresh, score, limit,
+                                   backend=backend)
+    since = time.time()
+    for _ in range(repeat):
+        non_maximum_suppression(bbox, thresh, score, limit, backend=backend)
+    return (time.time() - since) / repeat, keep
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nms backends')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[300, 2000, 12000], help='Numbers of boxes')
+    parser.add_argument('--thresh', type=float, default=0.7,
+                        help='IoU threshold')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Maximum number of selected boxes')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Timed runs per size')
+    args = parser.parse_args()
+
+    backends = ['cpu'] if cp is None else ['cpu', 'gpu']
+    print('{:>8} {:>8} {:>10} {:>10}'.format('boxes', 'backend', 'kept',
+                                             'ms'))
+    for n_bbox in args.sizes:
+        bbox, score = random_proposals(n_bbox)
+        selections = list()
+        for backend in backends:
+            sec, keep = time_backend(backend, bbox, score, args.thresh,
+                                     args.limit, args.repeat)
+            selections.append(keep)
+            print('{:>8} {:>8} {:>10} {:>10.3f}'.format(n_bbox, backend,
+                                                        len(keep), 1000 * sec))
+        if len(selections) > 1 and \
+                not np.array_equal(selections[0], selections[1]):
+            print('WARNING: backends disagree on {} boxes'.format(n_bbox))
+
+
+if __name__ == '__main__':
+    main()
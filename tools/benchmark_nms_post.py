@@ -0,0 +1,93 @@
+"""Benchmark the reduction of the nms kernel mask
+
+Builds the suppression bitmask the CuPy nms kernel would produce for
+synthetic proposals, on the CPU, and times `_nms_gpu_post` on it: the NumPy
+version, and the Cython extension if it is built.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.benchmark_nms_post --sizes 300 1000 2000 6000 12000
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+import argparse
+import time
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from model.utils.nms._nms_gpu_post_py import _nms_gpu_post as post_numpy
+from model.utils.nms.non_maximum_suppression import _iou_float32
+from tools.benchmark_nms import random_proposals
+try:
+    from model.utils.nms._nms_gpu_post import _nms_gpu_post as post_cython
+except ImportError:
+    post_cython = None
+
+# Module level constants
+THREADS_PER_BLOCK = 64
+
+
+def kernel_mask(bbox, thresh, threads_per_block=THREADS_PER_BLOCK):
+    """Suppression mask of sorted boxes, laid out like the kernel output"""
+    n_bbox = len(bbox)
+    col_blocks = -(-n_bbox // threads_per_block)
+    coord = np.ascontiguousarray(bbox.T, dtype=np.float32)
+    area = (coord[2] - coord[0]) * (coord[3] - coord[1])
+    mask = np.zeros((n_bbox, col_blocks * threads_per_block), dtype=bool)
+    # row by row to keep memory bounded at 12000 boxes
+    for i in range(n_bbox):
+        mask[i, i + 1:n_bbox] = _iou_float32(
+            coord[:, i:i + 1], area[i:i + 1],
+            coord[:, i + 1:], area[i + 1:])[0] >= thresh
+    mask = np.packbits(mask.reshape(n_bbox, col_blocks, threads_per_block),
+                       axis=2, bitorder='little')
+    mask = mask.view('<u8').reshape(-1).astype(np.uint64)
+    return mask, col_blocks
+
+
+def time_post(post, mask, n_bbox, col_blocks, repeat):
+    selection, n_selection = post(mask, n_bbox, THREADS_PER_BLOCK, col_blocks)
+    since = time.time()
+    for _ in range(repeat):
+        post(mask, n_bbox, THREADS_PER_BLOCK, col_blocks)
+    return (time.time() - since) / repeat, selection[:n_selection]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark _nms_gpu_post')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[300, 1000, 2000, 6000, 12000],
+                        help='Numbers of boxes')
+    parser.add_argument('--thresh', type=float, default=0.7,
+                        help='IoU threshold')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Timed runs per size')
+    args = parser.parse_args()
+
+    posts = [('numpy', post_numpy)]
+    if post_cython is not None:
+        posts.append(('cython', post_cython))
+    print('{:>8} {:>8} {:>10} {:>10}'.format('boxes', 'impl', 'kept', 'ms'))
+    for n_bbox in args.sizes:
+        bbox, score = random_proposals(n_bbox)
+        mask, col_blocks = kernel_mask(bbox[score.argsort()[::-1]],
+                                       args.thresh)
+        selections = list()
+        for name, post in posts:
+            sec, keep = time_post(post, mask, n_bbox, col_blocks, args.repeat)
+            selections.append(keep)
+            print('{:>8} {:>8} {:>10} {:>10.3f}'.format(n_bbox, name,
+                                                        len(keep), 1000 * sec))
+        if len(selections) > 1 and \
+                not np.array_equal(selections[0], selections[1]):
+            print('WARNING: implementations disagree on {} boxes'.format(
+                n_bbox))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark the per class suppression of FasterRCNN.predict
+
+Times :meth:`model.faster_rcnn.FasterRCNN._suppress`, which suppresses all
+foreground classes in one batched nms call, against the former loop with one
+nms call per class, on synthetic head outputs at the 'evaluate' preset
+(score_thresh 0.05), and checks that both return the same detections.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.benchmark_suppress --rois 300 1000 --n_class 4
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+import argparse
+import time
+from types import SimpleNamespace
+
+# Third party imports
+import numpy as np
+
+# Project level imports
+from model.faster_rcnn import FasterRCNN
+from model.utils.nms import non_maximum_suppression
+from tools.benchmark_nms import random_proposals
+
+
+def head_outputs(n_roi, n_class, seed=0):
+    """Class boxes and probabilities like the ones predict suppresses"""
+    rng = np.random.RandomState(seed)
+    roi, _ = random_proposals(n_roi, seed)
+    cls_bbox = roi[:, None, :] + \
+        rng.randn(n_roi, n_class, 4).astype(np.float32) * 4
+    logit = rng.randn(n_roi, n_class).astype(np.float32) * 2
+    prob = np.exp(logit - logit.max(axis=1, keepdims=True))
+    prob /= prob.sum(axis=1, keepdims=True)
+    return cls_bbox.reshape((n_roi, -1)), prob.astype(np.float32)
+
+
+def suppress_per_class(model, raw_cls_bbox, raw_prob):
+    """One nms call per class, the former implementation of _suppress"""
+    bbox = list()
+    label = list()
+    score = list()
+    for l in range(1, model.n_class):
+        cls_bbox_l = raw_cls_bbox.reshape((-1, model.n_class, 4))[:, l, :]
+        prob_l = raw_prob[:, l]
+        mask = prob_l > model.score_thresh
+        cls_bbox_l = cls_bbox_l[mask]
+        prob_l = prob_l[mask]
+        keep = non_maximum_suppression(cls_bbox_l, model.nms_thresh, prob_l)
+        bbox.append(cls_bbox_l[keep])
+        label.append((l - 1) * np.ones((len(keep),)))
+        score.append(prob_l[keep])
+    bbox = np.concatenate(bbox, axis=0).astype(np.float32)
+    label = np.concatenate(label, axis=0).astype(np.int32)
+    score = np.concatenate(score, axis=0).astype(np.float32)
+    return bbox, label, score
+
+
+def time_suppress(suppress, model, raw_cls_bbox, raw_prob, repeat):
+    out = suppress(model, raw_cls_bbox, raw_prob)
+    since = time.time()
+    for _ in range(repeat):
+        suppress(model, raw_cls_bbox, raw_prob)
+    return (time.time() - since) / repeat, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark _suppress')
+    parser.add_argument('--rois', type=int, nargs='+', default=[300, 1000],
+                        help='Numbers of RoIs per image')
+    parser.add_argument('--n_class', type=int, default=4,
+                        help='Number of classes including the background')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Timed runs per size')
+    args = parser.parse_args()
+
+    # attributes of the 'evaluate' preset
+    model = SimpleNamespace(n_class=args.n_class, nms_thresh=0.3,
+                            score_thresh=0.05, max_detections=None)
+    impls = [('per class', suppress_per_class),
+             ('batched', FasterRCNN._suppress)]
+    print('{:>8} {:>10} {:>8} {:>10}'.format('rois', 'impl', 'kept', 'ms'))
+    for n_roi in args.rois:
+        raw_cls_bbox, raw_prob = head_outputs(n_roi, args.n_class)
+        outs = list()
+        for name, suppress in impls:
+            sec, out = time_suppress(suppress, model, raw_cls_bbox, raw_prob,
+                                     args.repeat)
+            outs.append(out)
+            print('{:>8} {:>10} {:>8} {:>10.3f}'.format(n_roi, name,
+                                                        len(out[0]),
+                                                        1000 * sec))
+        if not all(np.array_equal(a, b) for a, b in zip(*outs)):
+            print('WARNING: implementations disagree on {} rois'.format(
+                n_roi))
+
+
+if __name__ == '__main__':
+    main()
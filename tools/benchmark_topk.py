@@ -0,0 +1,89 @@
+"""Benchmark the pre-nms proposal selection
+
+Times the selection of the `n_pre_nms` highest scored anchors that
+:class:`model.utils.creator_tool.ProposalCreator` passes to nms, for the
+number of anchors of several input sizes: a sort of all the scores against
+`top_k_order`, which partially selects the top scores and sorts only those,
+with NumPy arrays and with tensors.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.benchmark_topk --sizes 600x800 800x1066 1200x1600 \
+        --k 6000 12000
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+import argparse
+import time
+
+# Third party imports
+import numpy as np
+import torch as t
+
+# Project level imports
+from model.utils.nms import top_k_order
+
+# Module level constants
+FEAT_STRIDE = 16
+N_ANCHOR_BASE = 9
+
+
+def n_anchors(size):
+    """Number of anchors of the feature map of an input of size HxW"""
+    H, W = [int(v) for v in size.split('x')]
+    return -(-H // FEAT_STRIDE) * -(-W // FEAT_STRIDE) * N_ANCHOR_BASE
+
+
+def full_sort(score, k):
+    if t.is_tensor(score):
+        return score.argsort(descending=True)[:k]
+    return score.argsort()[::-1][:k]
+
+
+def time_select(select, score, k, repeat):
+    select(score, k)
+    if t.is_tensor(score) and score.is_cuda:
+        t.cuda.synchronize()
+    since = time.time()
+    for _ in range(repeat):
+        select(score, k)
+    if t.is_tensor(score) and score.is_cuda:
+        t.cuda.synchronize()
+    return (time.time() - since) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark top-k selection')
+    parser.add_argument('--sizes', nargs='+',
+                        default=['600x800', '800x1066', '1200x1600'],
+                        help='Input sizes HxW')
+    parser.add_argument('--k', type=int, nargs='+', default=[6000, 12000],
+                        help='Numbers of selected anchors, n_pre_nms')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='Timed runs per size')
+    args = parser.parse_args()
+
+    inputs = [('numpy', lambda score: score)]
+    inputs.append(('cpu', t.from_numpy))
+    if t.cuda.is_available():
+        inputs.append(('cuda', lambda score: t.from_numpy(score).cuda()))
+    print('{:>10} {:>8} {:>6} {:>6} {:>10} {:>10}'.format(
+        'size', 'anchors', 'k', 'input', 'sort ms', 'top-k ms'))
+    rng = np.random.RandomState(0)
+    for size in args.sizes:
+        n = n_anchors(size)
+        score = rng.rand(n).astype(np.float32)
+        for k in args.k:
+            for name, convert in inputs:
+                x = convert(score)
+                sec_sort = time_select(full_sort, x, k, args.repeat)
+                sec_topk = time_select(top_k_order, x, k, args.repeat)
+                print('{:>10} {:>8} {:>6} {:>6} {:>10.3f} {:>10.3f}'.format(
+                    size, n, k, name, 1000 * sec_sort, 1000 * sec_topk))
+
+
+if __name__ == '__main__':
+    main()
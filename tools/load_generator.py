@@ -0,0 +1,145 @@
+"""Load generator of the inference server
+
+Sends frames to :mod:`serve` from a number of concurrent clients, each on
+its own keep-alive connection, and reports the throughput, the latency
+percentiles of the answered requests and the number of retries, then the
+metrics of the server. Rejected requests are retried after a back off, and
+the latency of a request runs from its first attempt to its answer.
+
+# Example
+Run command as follows from the project root, with the server running:
+
+    $ python -m tools.load_generator --port 8080 --concurrency 16 \\
+        --requests 1000 --image dataset2/images/set06_V000_1.jpg
+    $ python -m tools.load_generator --unix /tmp/frcnn.sock
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+import argparse
+import asyncio
+import io
+import json
+import time
+
+# Third party imports
+import numpy as np
+from PIL import Image
+
+# Module level constants
+# size of the Caltech frames
+FRAME_SIZE = (480, 640)
+
+
+def synthetic_frame(seed=0):
+    """A random JPEG encoded frame"""
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 256, FRAME_SIZE + (3,), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+async def connect(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def request(reader, writer, method, path, body=b''):
+    """Status and JSON payload of one request on an open connection"""
+    head = '{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n' \
+           'Content-Type: application/octet-stream\r\n\r\n'.format(
+               method, path, len(body))
+    writer.write(head.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(args, body, todo, latencies, statuses):
+    """Send requests until none are left, returns the number of retries"""
+    retries = 0
+    reader, writer = await connect(args)
+    try:
+        while todo:
+            todo.pop()
+            since = time.time()
+            while True:
+                status, _ = await request(reader, writer, 'POST', '/predict',
+                                          body)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status != 503:
+                    break
+                # backpressure, back off and retry the request
+                retries += 1
+                await asyncio.sleep(args.backoff_ms / 1000.)
+            if status == 200:
+                latencies.append(time.time() - since)
+    finally:
+        writer.close()
+    return retries
+
+
+async def run(args, body):
+    # warm up the server, its first batches allocate
+    todo = list(range(args.warmup))
+    await asyncio.gather(*[client(args, body, todo, list(), dict())
+                           for _ in range(min(args.concurrency, 2))])
+
+    todo = list(range(args.requests))
+    latencies, statuses = list(), dict()
+    since = time.time()
+    retries = await asyncio.gather(*[client(args, body, todo, latencies,
+                                            statuses)
+                                     for _ in range(args.concurrency)])
+    elapsed = time.time() - since
+
+    reader, writer = await connect(args)
+    _, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    return latencies, statuses, sum(retries), elapsed, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", help="Connect to this Unix socket instead")
+    parser.add_argument("--image", help="Frame to send, random if not set")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=8)
+    parser.add_argument("--backoff-ms", dest="backoff_ms", type=float,
+                        default=10.)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            body = f.read()
+    else:
+        body = synthetic_frame()
+
+    latencies, statuses, retries, elapsed, metrics = asyncio.run(
+        run(args, body))
+    latencies = np.asarray(latencies) * 1000.
+    print('[REQUESTS] {} in {:.2f} sec | [RETRIES] {} | [STATUS] {}'.format(
+        args.requests, elapsed, retries, statuses))
+    print('[THROUGHPUT] {:.2f} frames/sec'.format(len(latencies) / elapsed))
+    if len(latencies):
+        print('[LATENCY] p50 {:.1f} | p95 {:.1f} | p99 {:.1f} | max {:.1f} '
+              'ms'.format(*np.percentile(latencies, (50, 95, 99, 100))))
+    print('[SERVER] {}'.format(json.dumps(metrics)))
+
+
+if __name__ == '__main__':
+    main()
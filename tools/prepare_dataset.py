@@ -15,8 +15,11 @@ import argparse
 import glob
 import json
 import logging
+import multiprocessing
 import os
 import sys
+import time
+from contextlib import contextmanager
 sys.path.insert(0, os.path.abspath(os.path.pardir))
 from PIL import Image
 
@@ -30,6 +33,7 @@ from utils.constants import *
 
 # Module level constants
 DEBUG = False
+ANNOTATION_COLS = [Col.COORD, Col.LABEL, Col.OCCL, Col.HIDE, Col.LOCK]
 
 
 def parse_cmds():
@@ -38,6 +42,10 @@ def parse_cmds():
                         help='Path to download dataset')
     parser.add_argument('--data-dir', dest='data_dir',
                         type=str, metavar='DIR', help='Data directory')
+    parser.add_argument('--check-valid', dest='check_valid',
+                        action='store_true', help='Verify every image')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes used to verify images')
     args = parser.parse_args(sys.argv[1:])
     return args
 
@@ -60,25 +68,57 @@ def main():
     Logger.section_break(title='Generate Dataset')
 
     # Initialize DatasetGenerator
-    datagen = DatasetGenerator (src_dir, logger)
+    datagen = DatasetGenerator (src_dir, logger, check_valid=args.check_valid,
+                                num_workers=args.workers)
     datagen.generate()
     dataset = datagen.dataset_df
 
     # Partition dataset
-    datagen.train_test_split(dataset)
+    with datagen.timer('train_test_split'):
+        datagen.train_test_split(dataset)
 
     # Save dataset
     output_filename = os.path.join(dest_dir, 'data_{}.csv')
-    datagen.save(output_filename)
+    with datagen.timer('save'):
+        datagen.save(output_filename)
+    datagen.report_timing()
+
+
+def _verify_image(path):
+    """Check an image file can be parsed (runs in a worker)"""
+    try:
+        with Image.open(path) as im:
+            im.verify()
+        return True
+    except (IOError, SyntaxError):
+        return False
 
 
 class DatasetGenerator(object):
     """Generates datasets"""
-    def __init__(self, src_dir, logger, check_valid=False):
+    def __init__(self, src_dir, logger, check_valid=False, num_workers=None):
         self.src_dir = src_dir
         self.logger = logger
         self.check_valid = check_valid
+        self.num_workers = num_workers
         self.dataset = {}
+        self.timing = []
+
+    @contextmanager
+    def timer(self, phase):
+        """Time a phase of the generation for :meth:`report_timing`"""
+        since = time.time()
+        yield
+        elapsed = time.time() - since
+        self.timing.append((phase, elapsed))
+        self.logger.info('[TIME] {}: {:.3f} sec'.format(phase, elapsed))
+
+    def report_timing(self):
+        Logger.section_break('Timing')
+        for phase, elapsed in self.timing:
+            self.logger.info('{:<20} {:10.3f} sec'.format(phase, elapsed))
+        self.logger.info('{:<20} {:10.3f} sec'.format(
+            'total', sum(e for _, e in self.timing)))
 
     def generate(self):
         """ Generates dataset
@@ -90,13 +130,17 @@ class DatasetGenerator(object):
             None
 
         """
-        self.images = self._get_images_paths()
+        with self.timer('get_images_paths'):
+            self.images = self._get_images_paths()
 
-        self.annotations = self._get_annotations()
+        with self.timer('get_annotations'):
+            self.annotations = self._get_annotations()
 
-        self._prepare_dataset()
+        with self.timer('prepare_dataset'):
+            self._prepare_dataset()
 
-        self._report_distribution()
+        with self.timer('report_distribution'):
+            self._report_distribution()
 
     def train_test_split(self, dataset):
         """ Splits dataset into train, val, test partitions
@@ -120,15 +164,13 @@ class DatasetGenerator(object):
         dataset[Col.PHASE] = dataset[Col.SET].map(map_phase)
 
         # groupby sets 10% of each as valid
-        self.train_set = dataset[dataset[Col.PHASE] == TRAIN]
+        train_set = dataset[dataset[Col.PHASE] == TRAIN]
         self.test_set = dataset[dataset[Col.PHASE] == TEST]
-        grouped_sets = self.train_set.groupby(Col.SET)
-        self.val_set = pd.DataFrame()
-        for s, s_df in grouped_sets:
-            sample_size = int(np.floor(.10*s_df.shape[0]))
-            temp = s_df.sample(n=sample_size)
-            self.train_set = self.train_set.drop(temp.index)
-            self.val_set = self.val_set.append(temp, ignore_index=True)
+        samples = [s_df.sample(n=int(np.floor(.10*s_df.shape[0])))
+                   for s, s_df in train_set.groupby(Col.SET)]
+        val_set = pd.concat(samples) if samples else train_set.iloc[:0]
+        self.train_set = train_set.drop(val_set.index)
+        self.val_set = val_set.reset_index(drop=True)
 
     def save(self, output_filename):
         """ Save dataset
@@ -151,85 +193,87 @@ class DatasetGenerator(object):
             dataset[phase].to_csv(output_filename.format(phase), index=False)
 
     def _get_images_paths(self):
-        """Get image files from data directory"""
+        """Get image files from data directory
+
+        With :obj:`check_valid`, every image is verified on a process pool.
+        """
+        images = glob.glob(os.path.join(self.src_dir, 'data', 'images', '*'))
         if self.check_valid:
-            images = glob.glob(os.path.join(self.src_dir, 'data', 'images', '*'))
-            valid_imgs = []
-            invalid_count = 0
+            pool = multiprocessing.Pool(self.num_workers)
+            try:
+                valid = pool.map(_verify_image, images, chunksize=256)
+            finally:
+                pool.close()
+                pool.join()
+
             Logger.section_break('Invalid Images')
-            for i in images:
-                try:
-                    im = Image.open(i)
-                    im.verify()
-                    valid_imgs.append((i, True))
-                except (IOError, SyntaxError):
-                    self.logger.info(i)
-                    valid_imgs.append((i, False))
-                    invalid_count += 1
-
-            self.logger.info('Total invalid images: {}'.format(invalid_count))
+            invalid_imgs = [i for i, v in zip(images, valid) if not v]
+            for i in invalid_imgs:
+                self.logger.info(i)
+            self.logger.info('Total invalid images: {}'.format(
+                len(invalid_imgs)))
 
         else:
-            images = glob.glob(os.path.join(self.src_dir, 'data', 'images', '*'))
-            valid_imgs = [(i, True) for i in images]
+            valid = [True] * len(images)
 
         self.logger.info ('')
         self.logger.info ('Total images retrieved: {}'.format (len (images)))
-        return valid_imgs
+        return pd.DataFrame({Col.IMAGES: images, Col.VALID: valid})
 
     def _get_annotations(self):
-        return json.load(open(os.path.join(self.src_dir,
-                                           'data/annotations.json')))
+        """Flatten annotations.json into one row per annotated frame
+
+        Returns:
+            pandas.DataFrame: Columns set, video, frame and one list per
+            frame for each of the annotation columns
+
+        """
+        with open(os.path.join(self.src_dir, 'data/annotations.json')) as f:
+            annotations = json.load(f)
+
+        columns = {c: [] for c in [Col.SET, Col.VIDEO, Col.FRAME] +
+                   ANNOTATION_COLS}
+        for set_id, videos in annotations.items():
+            for video, video_data in videos.items():
+                for frame, data in video_data[Col.FRAME + 's'].items():
+                    columns[Col.SET].append(set_id)
+                    columns[Col.VIDEO].append(video)
+                    columns[Col.FRAME].append(int(frame))
+                    columns[Col.COORD].append([datum['pos'] for datum in data])
+                    columns[Col.LABEL].append([datum['lbl'] for datum in data])
+                    columns[Col.OCCL].append([datum['occl'] for datum in data])
+                    columns[Col.HIDE].append([datum['hide'] for datum in data])
+                    columns[Col.LOCK].append([datum['hide'] for datum in data])
+        annotations = pd.DataFrame(columns)
+        annotations[Col.N_LABELS] = annotations[Col.COORD].str.len()
+        return annotations
 
     def _prepare_dataset(self):
-        self.dataset[Col.IMAGES] = np.array(self.images)[:, 0]
-        self.dataset[Col.VALID] = np.array(self.images)[:, 1]
-        self.dataset_df = pd.DataFrame(self.dataset)
+        self.dataset_df = self.images
 
         # Split image filenames and clean up strings
         self._clean_up_filenames()
 
-        # Grab coordinates and labels
-        self.dataset_df = self.dataset_df.astype(object)
-        coord = []
-        lbl = []
-        n_lbls = []
-        occl = []
-        hide = []
-        lock = []
-        for idx, row in self.dataset_df.iterrows():
-            data = self.annotations[row[Col.SET]][row[Col.VIDEO]][
-                Col.FRAME + 's']
-            if str(row[Col.FRAME]) in data:
-                data = data[str(row[Col.FRAME])]
-                coordinates = [datum['pos'] for datum in data]
-                label = [datum['lbl'] for datum in data]
-                occlusion = [datum['occl'] for datum in data]
-                hiding = [datum['hide'] for datum in data]
-                locked = [datum['hide'] for datum in data]
-                n_lbls.append(len(coordinates))
-                coord.append(coordinates)
-                lbl.append(label)
-                occl.append(occlusion)
-                hide.append(hiding)
-                lock.append(locked)
-            else:
-                n_lbls.append(0)
-                coord.append(np.nan)
-                lbl.append(['bg'])
-                occl.append([0])
-                hide.append([0])
-                lock.append([0])
-        self.dataset_df[Col.COORD] = coord
-        self.dataset_df[Col.LABEL] = lbl
-        self.dataset_df[Col.N_LABELS] = n_lbls
-        self.dataset_df[Col.OCCL] = occl
-        self.dataset_df[Col.HIDE] = hide
-        self.dataset_df[Col.LOCK] = lock
+        # Join coordinates and labels of annotated frames
+        self.dataset_df = self.dataset_df.merge(
+            self.annotations, how='left', on=[Col.SET, Col.VIDEO, Col.FRAME])
+        self.dataset_df = self.dataset_df[
+            [Col.IMAGES, Col.VALID, Col.SET, Col.VIDEO, Col.FRAME, Col.COORD,
+             Col.LABEL, Col.N_LABELS, Col.OCCL, Col.HIDE, Col.LOCK]]
 
         self.logger.info('Loaded annotations. Number of frames w/out '
                          'annotations\n{}'.format(self.dataset_df.isna().sum()))
 
+        # Frames without annotations
+        missing = self.dataset_df[Col.N_LABELS].isna().values
+        self.dataset_df[Col.N_LABELS] = self.dataset_df[Col.N_LABELS].fillna(
+            0).astype(int)
+        self.dataset_df = self.dataset_df.astype(object)
+        for col, fill in [(Col.LABEL, ['bg']), (Col.OCCL, [0]),
+                          (Col.HIDE, [0]), (Col.LOCK, [0])]:
+            self.dataset_df[col] = [fill if m else v for m, v in
+                                    zip(missing, self.dataset_df[col].values)]
+
         # Clean up nan values
         self._convert_nans()
 
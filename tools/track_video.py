@@ -0,0 +1,142 @@
+"""Track pedestrians through Caltech videos
+
+Runs the detector over the frames of a video in temporal order, with
+:class:`data.video_stream.VideoFrameStream`, and links the detections of
+every frame into tracks with :class:`model.tracker.Tracker`. The tracker is
+reset at the start of every video. Reports the frame rate of the tracker
+alone and of the whole pipeline, reading, detection and tracking, and
+optionally writes the tracked boxes to a csv file.
+
+# Example
+Run command as follows from the project root:
+
+    $ python -m tools.track_video --path checkpoints/fasterrcnn_xxx \\
+        --set_id set06 --video V000 --out tracks.csv
+
+"""
+from __future__ import  absolute_import
+
+# Standard dist imports
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
+import argparse
+import csv
+import os
+import time
+
+# Third party imports
+import numpy as np
+from tqdm import tqdm
+
+# Project level imports
+from utils.config import opt
+from data.video_stream import VideoFrameStream
+from model.faster_rcnn_vgg16 import FasterRCNNVGG16
+from model.tracker import Tracker
+from trainer import FasterRCNNTrainer
+from utils import array_tool as at
+
+# Module level constants
+CSV_HEADER = ['set', 'video', 'frame', 'track_id', 'ymin', 'xmin', 'ymax',
+              'xmax', 'score']
+
+
+def track(stream, faster_rcnn, tracker, writer=None):
+    """Detect and track every frame of the stream
+
+    Returns:
+        dict: Number of frames and tracks, and the seconds spent in the
+        detector, in the tracker and in total.
+
+    """
+    frame_ids = stream.frame_ids()
+    n_frame, n_track = 0, 0
+    detect_time, track_time = 0., 0.
+    video = None
+    since = time.time()
+    for imgs, sizes, _, _ in tqdm(stream):
+        start = time.time()
+        pred_bboxes, _, pred_scores = faster_rcnn.predict_batch(imgs, sizes)
+        detect_time += time.time() - start
+
+        for bbox, score in zip(pred_bboxes, pred_scores):
+            set_id, video_id, frame = frame_ids[n_frame]
+            n_frame += 1
+            if (set_id, video_id) != video:
+                n_track += tracker.next_id
+                tracker.reset()
+                video = (set_id, video_id)
+
+            start = time.time()
+            ids = tracker.update(bbox, score)
+            track_time += time.time() - start
+
+            if writer is not None:
+                for i in np.flatnonzero(ids >= 0):
+                    writer.writerow([set_id, video_id, frame, ids[i]]
+                                    + bbox[i].tolist() + [score[i]])
+    total_time = time.time() - since
+    n_track += tracker.next_id
+    return dict(frames=n_frame, tracks=n_track, detect_time=detect_time,
+                track_time=track_time, total_time=total_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--path", help="Checkpoint of the detector")
+    parser.add_argument("-s", "--set_id", default='set06')
+    parser.add_argument("--video", help="Only track this video, e.g. V000")
+    parser.add_argument("--split", default='test')
+    parser.add_argument("--out", help="Write the tracked boxes to this csv")
+    parser.add_argument("--matcher", default=opt.track_matcher,
+                        choices=['greedy', 'hungarian'])
+    parser.add_argument("--device", default=opt.device,
+                        help="Device to run on, e.g. cuda or cpu")
+    parser.add_argument("--num-threads", dest="num_threads", type=int,
+                        default=opt.num_threads,
+                        help="Torch threads on cpu, 0 keeps the default")
+    args = parser.parse_args()
+    opt.device, opt.num_threads = args.device, args.num_threads
+    device = at.init_device()
+
+    stream = VideoFrameStream(opt, split=args.split, set_id=args.set_id,
+                              video=args.video)
+    print(f"FRAMES: {len(stream)} | VIDEOS: {len(stream.videos())}")
+
+    faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
+    if args.path:
+        assert os.path.isfile(args.path), \
+            'Checkpoint {} does not exist.'.format(args.path)
+        trainer.load(args.path)
+    else:
+        print("No checkpoint specified, tracking untrained detections")
+    faster_rcnn.use_preset('evaluate')
+
+    tracker = Tracker(iou_thresh=opt.track_iou_thresh,
+                      max_age=opt.track_max_age,
+                      min_hits=opt.track_min_hits,
+                      min_score=opt.track_min_score,
+                      matcher=args.matcher)
+
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            result = track(stream, faster_rcnn, tracker, writer)
+    else:
+        result = track(stream, faster_rcnn, tracker)
+
+    n = result['frames']
+    print('[FRAMES] {} | [TRACKS] {}'.format(n, result['tracks']))
+    print('[TRACKER FPS] {:.1f}'.format(n / max(result['track_time'], 1e-9)))
+    print('[DETECTOR FPS] {:.2f}'.format(n / max(result['detect_time'], 1e-9)))
+    print('[END TO END FPS] {:.2f}'.format(n / max(result['total_time'], 1e-9)))
+    print('[STREAM WAIT] {:.3f} sec'.format(stream.wait_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 from __future__ import  absolute_import
 # though cupy is not used but without this line, it raise errors...
-import cupy as cp
+try:
+    import cupy as cp
+except ImportError:
+    # CPU only node, see opt.device
+    cp = None
 import os
 
 import ipdb
@@ -8,7 +12,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from utils.config import opt
-from data.dataset import Dataset, TestDataset, inverse_normalize
+from data.dataset import Dataset, TestDataset, inverse_normalize, \
+    AspectBucketSampler, collate_detection, collate_test
+from data.device_loader import DeviceLoader
 from model.faster_rcnn_vgg16 import FasterRCNNVGG16
 from torch.utils import data as data_
 import torch
@@ -28,15 +34,15 @@ def eval(dataloader, faster_rcnn, test_num=10000):
     print("\nEVAL")
     pred_bboxes, pred_labels, pred_scores = list(), list(), list()
     gt_bboxes, gt_labels = list(), list()
-    for ii, (imgs, sizes, gt_bboxes_, gt_labels_) in tqdm(enumerate(dataloader)):
-        sizes = [sizes[0][0].item(), sizes[1][0].item()]
-        pred_bboxes_, pred_labels_, pred_scores_ = faster_rcnn.predict(imgs, [sizes])
-        gt_bboxes += list(gt_bboxes_.numpy())
-        gt_labels += list(gt_labels_.numpy())
+    for imgs, sizes, gt_bboxes_, gt_labels_ in tqdm(dataloader):
+        pred_bboxes_, pred_labels_, pred_scores_ = \
+            faster_rcnn.predict_batch(imgs, sizes)
+        gt_bboxes += gt_bboxes_
+        gt_labels += gt_labels_
         pred_bboxes += pred_bboxes_
         pred_labels += pred_labels_
         pred_scores += pred_scores_
-        if ii == test_num: break
+        if len(pred_bboxes) > test_num: break
 
     result = eval_detection_voc(
         pred_bboxes, pred_labels, pred_scores,
@@ -49,14 +55,13 @@ def train(opt, faster_rcnn, dataloader,  val_dataloader,
     for epoch in range(start_epoch, start_epoch+opt.epoch):
         trainer.reset_meters()
         pbar = tqdm(enumerate(dataloader), total=len(dataloader))
-        for ii, (img, bbox_, label_, scale) in pbar:
+        for ii, (img, bbox, label, scale, n_bbox) in pbar:
             # Currently configured to predict (y_min, x_min, y_max, x_max)
-#             bbox_tmp = bbox_.clone()
-#             bbox_ = transform_bbox(bbox_)
-            scale = at.scalar(scale)
+            # img, bbox and label are already on the GPU, see DeviceLoader
+            scale = at.tonumpy(scale)
 
-            img, bbox, label = img.cuda().float(), bbox_.cuda(), label_.cuda()
-            losses = trainer.train_step(img, bbox, label, scale)
+            losses = trainer.train_step(img, bbox, label, scale,
+                                        n_bboxes=n_bbox)
             if ii % 100 == 0:
                 rpnloc = losses[0].cpu().data.numpy()
                 rpncls = losses[1].cpu().data.numpy()
@@ -89,8 +94,8 @@ def train(opt, faster_rcnn, dataloader,  val_dataloader,
                 try:
                     ori_img_ = inverse_normalize(at.tonumpy(img[0]))
                     gt_img = visdom_bbox(ori_img_,
-                                        at.tonumpy(bbox_[0]),
-                                        at.tonumpy(label_[0]))
+                                        at.tonumpy(bbox[0][:n_bbox[0]]),
+                                        at.tonumpy(label[0][:n_bbox[0]]))
                     trainer.vis.img('gt_img', gt_img)
                     plt.show()
 
@@ -119,6 +124,13 @@ def train(opt, faster_rcnn, dataloader,  val_dataloader,
                 trainer.vis.log(log_info)
 
 
+        print(dataloader.summary())
+        # with workers, each of them prints the counts of its own samples
+        if opt.debug_alloc and not opt.num_workers:
+            alloc = dataloader.loader.dataset.alloc
+            print(alloc.summary())
+            alloc.reset()
+
         # Save after every epoch
         epoch_path = trainer.save(epoch, best_map=0)
                 
@@ -149,16 +161,21 @@ def train(opt, faster_rcnn, dataloader,  val_dataloader,
 
 def main():
     print(opt._parse_all())
+    device = at.init_device()
     dataset = Dataset(opt)
+    sampler = AspectBucketSampler(dataset, opt.batch_size, shuffle=True)
     dataloader = data_.DataLoader(dataset, \
-                                batch_size=1, \
-                                shuffle=True, \
-                                # pin_memory=True,
+                                batch_sampler=sampler, \
+                                collate_fn=collate_detection, \
                                 num_workers=opt.num_workers)
+    # scale and n_bbox are read by numpy code of the step, keep them on host
+    dataloader = DeviceLoader(dataloader, device=device,
+                              depth=opt.prefetch_depth, host_fields=(3, 4))
 
     valset = TestDataset(opt, split='val')
     val_dataloader = data_.DataLoader(valset,
-                                    batch_size=1,
+                                    batch_size=opt.test_batch_size,
+                                    collate_fn=collate_test,
                                     num_workers=opt.test_num_workers,
                                     shuffle=False, \
                                     pin_memory=True
@@ -166,16 +183,18 @@ def main():
 
     testset = TestDataset(opt, split='test')
     test_dataloader = data_.DataLoader(testset,
-                                    batch_size=1,
+                                    batch_size=opt.test_batch_size,
+                                    collate_fn=collate_test,
                                     num_workers=opt.test_num_workers,
                                     shuffle=False, \
                                     pin_memory=True
                                     )
     print(f"TRAIN SET: {len(dataloader)} | VAL SET: {len(val_dataloader)} | TEST SET: {len(test_dataloader)}")
+    print(f"LOAD TIME: TRAIN {dataset.db.load_time:.3f} | VAL {valset.db.load_time:.3f} | TEST {testset.db.load_time:.3f} sec")
     print("Using Mask VGG") if opt.mask else print("Using normal VGG16")
     faster_rcnn = FasterRCNNVGG16(mask=opt.mask)
     print('model construct completed')
-    trainer = FasterRCNNTrainer(faster_rcnn).cuda()
+    trainer = FasterRCNNTrainer(faster_rcnn).to(device)
     trainer.vis.text(dataset.db.label_names, win='labels')
     best_map = 0
     lr_ = opt.lr
@@ -183,7 +202,7 @@ def main():
 
     if opt.load_path:
         assert os.path.isfile(opt.load_path), 'Checkpoint {} does not exist.'.format(opt.load_path)
-        checkpoint = torch.load(opt.load_path)['other_info']
+        checkpoint = torch.load(opt.load_path, map_location=device)['other_info']
         if opt.use_simple:
             start_epoch = 0
             best_map = 0
@@ -3,7 +3,8 @@ import os
 from collections import namedtuple
 import time
 from torch.nn import functional as F
-from model.utils.creator_tool import AnchorTargetCreator, ProposalTargetCreator
+from model.utils.creator_tool import BatchAnchorTargetCreator, \
+    BatchProposalTargetCreator
 
 from torch import nn
 import torch as t
@@ -51,8 +52,10 @@ class FasterRCNNTrainer(nn.Module):
         self.roi_sigma = opt.roi_sigma
 
         # target creator create gt_bbox gt_label etc as training targets. 
-        self.anchor_target_creator = AnchorTargetCreator()
-        self.proposal_target_creator = ProposalTargetCreator()
+        self.anchor_target_creator = BatchAnchorTargetCreator(
+            seed=opt.target_seed)
+        self.proposal_target_creator = BatchProposalTargetCreator(
+            seed=opt.target_seed)
 
         self.loc_normalize_mean = faster_rcnn.loc_normalize_mean
         self.loc_normalize_std = faster_rcnn.loc_normalize_std
@@ -67,7 +70,7 @@ class FasterRCNNTrainer(nn.Module):
         self.meters = {k: AverageValueMeter() for k in LossTuple._fields}  # average loss
         self.sparse = False
 
-    def forward(self, imgs, bboxes, labels, scale):
+    def forward(self, imgs, bboxes, labels, scale, n_bboxes=None):
         """Forward Faster R-CNN and calculate losses.
 
         Here are notations used.
@@ -75,7 +78,10 @@ class FasterRCNNTrainer(nn.Module):
         * :math:`N` is the batch size.
         * :math:`R` is the number of bounding boxes per image.
 
-        Currently, only :math:`N=1` is supported.
+        The extractor, the RPN convolutions and the head run once for the
+        whole batch. Anchor and proposal targets are created for all images
+        at once on the device, and the sampled RoIs of all images go through
+        the head together with their :obj:`roi_indices`.
 
         Args:
             imgs (~torch.autograd.Variable): A variable with a batch of images.
@@ -86,15 +92,22 @@ class FasterRCNNTrainer(nn.Module):
                 the definition, which means that the range of the value
                 is :math:`[0, L - 1]`. :math:`L` is the number of foreground
                 classes.
-            scale (float): Amount of scaling applied to
-                the raw image during preprocessing.
+            scale (float or array): Amount of scaling applied to
+                the raw image during preprocessing, one for the batch or
+                one per image.
+            n_bboxes (array): Number of valid bounding boxes of each image
+                when :obj:`bboxes` and :obj:`labels` are padded. Its shape is
+                :math:`(N,)`. If :obj:`None`, all :math:`R` boxes are valid.
 
         Returns:
             namedtuple of 5 losses
         """
-        n = bboxes.shape[0]
-        if n != 1:
-            raise ValueError('Currently only batch size 1 is supported.')
+        n, n_bbox = bboxes.shape[:2]
+        valid = t.arange(n_bbox, device=bboxes.device)[None, :]
+        if n_bboxes is None:
+            valid = valid.expand(n, n_bbox) < n_bbox
+        else:
+            valid = valid < t.as_tensor(n_bboxes, device=bboxes.device)[:, None]
 
         _, _, H, W = imgs.shape
         img_size = (H, W)
@@ -103,37 +116,39 @@ class FasterRCNNTrainer(nn.Module):
 
         rpn_locs, rpn_scores, rois, roi_indices, anchor = \
             self.faster_rcnn.rpn(features, img_size, scale)
+        inside_index = self.faster_rcnn.rpn.anchor_cache.inside_index(
+            anchor, img_size)
 
-        # Since batch size is one, convert variables to singular form
-        bbox = bboxes[0]
-        label = labels[0]
-        rpn_score = rpn_scores[0]
-        rpn_loc = rpn_locs[0]
-        roi = rois
+        # Create targets for all images at once.
+        # it's fine to break the computation graph of rois,
+        # consider them as constant input
+        sample_roi, sample_roi_index, gt_roi_loc, gt_roi_label = \
+            self.proposal_target_creator(
+                rois,
+                roi_indices,
+                bboxes,
+                labels,
+                valid,
+                self.loc_normalize_mean,
+                self.loc_normalize_std)
+        gt_rpn_loc, gt_rpn_label = self.anchor_target_creator(
+            bboxes,
+            valid,
+            anchor,
+            img_size,
+            inside_index)
 
         # Sample RoIs and forward
-        # it's fine to break the computation graph of rois, 
-        # consider them as constant input
-        sample_roi, gt_roi_loc, gt_roi_label = self.proposal_target_creator(
-            roi,
-            at.tonumpy(bbox),
-            at.tonumpy(label),
-            self.loc_normalize_mean,
-            self.loc_normalize_std)
-        # NOTE it's all zero because now it only support for batch=1 now
-        sample_roi_index = t.zeros(len(sample_roi))
         roi_cls_loc, roi_score = self.faster_rcnn.head(
             features,
             sample_roi,
             sample_roi_index)
 
         # ------------------ RPN losses -------------------#
-        gt_rpn_loc, gt_rpn_label = self.anchor_target_creator(
-            at.tonumpy(bbox),
-            anchor,
-            img_size)
-        gt_rpn_label = at.totensor(gt_rpn_label).long()
-        gt_rpn_loc = at.totensor(gt_rpn_loc)
+        rpn_score = rpn_scores.view(-1, 2)
+        rpn_loc = rpn_locs.view(-1, 4)
+        gt_rpn_label = gt_rpn_label.view(-1).long()
+        gt_rpn_loc = gt_rpn_loc.view(-1, 4)
         rpn_loc_loss = _fast_rcnn_loc_loss(
             rpn_loc,
             gt_rpn_loc,
@@ -141,7 +156,7 @@ class FasterRCNNTrainer(nn.Module):
             self.rpn_sigma)
 
         # NOTE: default value of ignore_index is -100 ...
-        rpn_cls_loss = F.cross_entropy(rpn_score, gt_rpn_label.cuda(), ignore_index=-1)
+        rpn_cls_loss = F.cross_entropy(rpn_score, gt_rpn_label, ignore_index=-1)
         _gt_rpn_label = gt_rpn_label[gt_rpn_label > -1]
         _rpn_score = at.tonumpy(rpn_score)[at.tonumpy(gt_rpn_label) > -1]
         self.rpn_cm.add(at.totensor(_rpn_score, False), _gt_rpn_label.data.long())
@@ -149,10 +164,8 @@ class FasterRCNNTrainer(nn.Module):
         # ------------------ ROI losses (fast rcnn loss) -------------------#
         n_sample = roi_cls_loc.shape[0]
         roi_cls_loc = roi_cls_loc.view(n_sample, -1, 4)
-        roi_loc = roi_cls_loc[t.arange(0, n_sample).long().cuda(), \
-                              at.totensor(gt_roi_label).long()]
-        gt_roi_label = at.totensor(gt_roi_label).long()
-        gt_roi_loc = at.totensor(gt_roi_loc)
+        roi_loc = roi_cls_loc[t.arange(0, n_sample, device=roi_cls_loc.device), \
+                              gt_roi_label]
 
         roi_loc_loss = _fast_rcnn_loc_loss(
             roi_loc.contiguous(),
@@ -160,7 +173,7 @@ class FasterRCNNTrainer(nn.Module):
             gt_roi_label.data,
             self.roi_sigma)
 
-        roi_cls_loss = nn.CrossEntropyLoss()(roi_score, gt_roi_label.cuda())
+        roi_cls_loss = nn.CrossEntropyLoss()(roi_score, gt_roi_label)
 
         self.roi_cm.add(at.totensor(roi_score, False), gt_roi_label.data.long())
 
@@ -169,9 +182,10 @@ class FasterRCNNTrainer(nn.Module):
 
         return LossTuple(*losses)
 
-    def train_step(self, imgs, bboxes, labels, scale, prune_train=False):
+    def train_step(self, imgs, bboxes, labels, scale, prune_train=False,
+                   n_bboxes=None):
         self.optimizer.zero_grad()
-        losses = self.forward(imgs, bboxes, labels, scale)
+        losses = self.forward(imgs, bboxes, labels, scale, n_bboxes)
         losses.total_loss.backward()
         if prune_train:
             for name, m in self.named_modules():
@@ -342,7 +356,7 @@ class FasterRCNNTrainer(nn.Module):
         return self
 
     def load(self, path, load_optimizer=False, parse_opt=False, debug=False, simple=opt.use_simple,):
-        state_dict = t.load(path)
+        state_dict = t.load(path, map_location=at.get_device())
         if 'model' in state_dict:
             sd = self.generate_state_dict(state_dict['model'], simple, debug)
             self.faster_rcnn.load_state_dict(sd)
@@ -400,11 +414,11 @@ def _smooth_l1_loss(x, t, in_weight, sigma):
 
 
 def _fast_rcnn_loc_loss(pred_loc, gt_loc, gt_label, sigma):
-    in_weight = t.zeros(gt_loc.shape).cuda()
+    in_weight = t.zeros(gt_loc.shape, device=gt_loc.device)
     # Localization loss is calculated only for positive rois.
     # NOTE:  unlike origin implementation, 
     # we don't need inside_weight and outside_weight, they can calculate by gt_label
-    in_weight[(gt_label > 0).view(-1, 1).expand_as(in_weight).cuda()] = 1
+    in_weight[(gt_label > 0).view(-1, 1).expand_as(in_weight)] = 1
     loc_loss = _smooth_l1_loss(pred_loc, gt_loc, in_weight.detach(), sigma)
     # Normalize by total number of negtive and positive rois.
     loc_loss /= ((gt_label >= 0).sum().float()) # ignore gt_label==-1 for rpn_loss
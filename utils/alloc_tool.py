@@ -0,0 +1,68 @@
+"""
+tools to count memory allocated per sample in debug mode
+"""
+import tracemalloc
+
+
+class AllocationCounter(object):
+    """Counts memory allocated while a block runs.
+
+    Used as a context manager around a per-sample code path. While enabled,
+    :mod:`tracemalloc` is started, which NumPy reports its array buffers to,
+    and the peak and retained bytes of every run are recorded. A summary is
+    printed every :obj:`report_every` runs by the process the counter runs
+    in, e.g. each DataLoader worker. When disabled the counter does nothing,
+    so it can stay in the hot path.
+
+    Args:
+        name (str): Name of the counted code path, used in reports.
+        enabled (bool): Whether to count at all, e.g. :obj:`opt.debug_alloc`.
+        report_every (int): Log a summary every this many runs.
+
+    """
+
+    def __init__(self, name, enabled=True, report_every=100):
+        self.name = name
+        self.enabled = enabled
+        self.report_every = report_every
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.peak = 0
+        self.max_peak = 0
+        self.total_peak = 0
+        self.retained = 0
+
+    def __enter__(self):
+        if self.enabled:
+            if hasattr(tracemalloc, 'reset_peak'):
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            else:
+                # Python < 3.9, restarting the trace resets the peak
+                tracemalloc.stop()
+                tracemalloc.start()
+            self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc):
+        if not self.enabled:
+            return False
+        current, peak = tracemalloc.get_traced_memory()
+        self.count += 1
+        self.peak = peak - self._start
+        self.max_peak = max(self.max_peak, self.peak)
+        self.total_peak += self.peak
+        self.retained = current - self._start
+        if self.report_every and self.count % self.report_every == 0:
+            print(self.summary())
+        return False
+
+    def summary(self):
+        mean = self.total_peak / max(self.count, 1)
+        return ('[ALLOC] {}: {} runs, peak {:.2f} MB mean / {:.2f} MB max, '
+                '{:.2f} MB retained by last run'.format(
+                    self.name, self.count, mean / 2 ** 20,
+                    self.max_peak / 2 ** 20, self.retained / 2 ** 20))
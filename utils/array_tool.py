@@ -1,9 +1,34 @@
 """
 tools to convert specified type
 """
+import warnings
+
 import torch as t
 import numpy as np
 
+from utils.config import opt
+
+
+def get_device():
+    """torch.device of :obj:`opt.device`, cpu when CUDA is not available"""
+    device = t.device(opt.device)
+    if device.type == 'cuda' and not t.cuda.is_available():
+        return t.device('cpu')
+    return device
+
+
+def init_device():
+    """Resolve :obj:`opt.device` and apply :obj:`opt.num_threads`
+
+    Called once by the scripts before building the model.
+    """
+    device = get_device()
+    if device.type != t.device(opt.device).type:
+        warnings.warn('CUDA is not available, running on cpu')
+    if opt.num_threads > 0:
+        t.set_num_threads(opt.num_threads)
+    return device
+
 
 def tonumpy(data):
     if isinstance(data, np.ndarray):
@@ -13,12 +38,13 @@ def tonumpy(data):
 
 
 def totensor(data, cuda=True):
+    """Tensor of data, on the configured device unless cuda is False"""
     if isinstance(data, np.ndarray):
         tensor = t.from_numpy(data)
     if isinstance(data, t.Tensor):
         tensor = data.detach()
     if cuda:
-        tensor = tensor.cuda()
+        tensor = tensor.to(get_device())
     return tensor
 
 
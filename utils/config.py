@@ -13,8 +13,18 @@ class Config:
     voc_data_dir = 'dataset2/'
     min_size = 600  # image resize
     max_size = 1000 # image resize
+    batch_size = 1 # images per training step, bucketed by preprocessed shape
     num_workers = 4
     test_num_workers = 4
+    test_batch_size = 4 # images per forward pass in evaluation and benchmarks
+    use_frame_store = False # read decoded frames from voc_data_dir/frames_{split}
+    video_stream = False # evaluate/benchmark frames in temporal order per video
+    stream_queue_depth = 8 # frames decoded ahead of the model
+    stream_workers = 2 # read-ahead threads
+    prefetch_depth = 2 # training batches in flight to the GPU
+    test_cache = False # cache preprocessed test images in voc_data_dir/preprocessed
+    test_cache_dtype = 'float16' # 'float16' or 'uint8' shards
+    test_cache_max_mb = 8192 # size cap of the test cache
 
     # sigma for l1_smooth_loss
     rpn_sigma = 3.
@@ -41,8 +51,33 @@ class Config:
     use_adam = False # Use Adam optimizer
     use_chainer = False # try match everything as chainer
     use_drop = False # use dropout in RoIHead
+    target_seed = None # seed of the anchor and roi target sampling, None for unseeded
+    # device
+    device = 'cuda' # 'cuda', 'cuda:N' or 'cpu', cpu if CUDA is not available
+    num_threads = 0 # torch.set_num_threads for cpu execution, 0 keeps the default
+
+    # inference
+    nms_backend = 'auto' # 'cpu', 'gpu', or 'auto' to pick by array type and device
+    slo_target_ms = None # per frame latency target of benchmark_model, None to disable
+    slo_pre_nms = (1000, 6000) # bounds of the pre-nms proposals under the target
+    slo_post_nms = (50, 300) # bounds of the post-nms proposals under the target
+    slo_score_thresh = (0.05, 0.3) # bounds of the detection score threshold
+    slo_margin = 0.1 # fraction of the target kept free for latency variance
+
+    # tracking
+    track_iou_thresh = 0.3 # minimum IoU of a detection with a predicted track box
+    track_max_age = 5 # frames a track is kept without a matched detection
+    track_min_hits = 3 # matched detections before a track ID is reported
+    track_min_score = 0.5 # detections with a lower score are not tracked
+    track_matcher = 'greedy' # 'greedy' or 'hungarian' association
+    key_adaptive = False # also trigger keyframes on new objects and lost tracks
+    key_refine = False # refine propagated boxes with the head between keyframes
+    key_new_objects = 2 # adaptive trigger, tracks started by the last detections
+    key_uncertainty = 0.5 # adaptive trigger, fraction of tracks without a match
+
     # debug
     debug_file = '/tmp/debugf'
+    debug_alloc = False # print memory allocated per training sample
     test_num = 10000
     # model
     load_path = None#'/datasets/home/98/898/cjgunthe/Fast-Pedestrian-Tracking/checkpoints/fasterrcnn_12131543_0_test_run'
@@ -50,6 +85,11 @@ class Config:
 
     # benchmark
     benchmark_path = None
+
+    # serving
+    serve_max_batch = 8 # frames per batched predict of serve.py
+    serve_max_wait_ms = 10 # wait for a batch to fill after its first frame
+    serve_max_queue = 64 # frames in flight before requests get 503
     '''
     Pruning Configs
     '''
@@ -2,6 +2,8 @@ TRAIN = 'train'
 VAL = 'val'
 TEST = 'test'
 
+CLS_IDX = {'person': 0, 'people':1, 'person?':2, 'person-fa':0}
+
 class Col():
     IMAGES = 'images'
     LABEL = 'label'
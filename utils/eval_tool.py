@@ -5,7 +5,7 @@ import itertools
 import numpy as np
 import six
 
-from model.utils.bbox_tools import bbox_iou
+from model.utils.iou_tool import iou_max
 
 
 def eval_detection_voc(
@@ -191,11 +191,9 @@ def calc_detection_voc_prec_rec(
             gt_bbox_l = gt_bbox_l.copy()
             gt_bbox_l[:, 2:] += 1
 
-            iou = bbox_iou(pred_bbox_l, gt_bbox_l)
-            gt_index = iou.argmax(axis=1)
+            gt_index, max_iou = iou_max(pred_bbox_l, gt_bbox_l)
             # set -1 if there is no matching ground truth
-            gt_index[iou.max(axis=1) < iou_thresh] = -1
-            del iou
+            gt_index[max_iou < iou_thresh] = -1
 
             selec = np.zeros(gt_bbox_l.shape[0], dtype=bool)
             for gt_idx in gt_index: